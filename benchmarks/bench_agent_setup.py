@@ -0,0 +1,108 @@
+"""
+1ターンあたりのAgentExecutor準備コストを計測するmicro-benchmark
+
+毎ターンAgentExecutorを作り直していた従来の方法と、
+TriPalEngineで一度だけ作成したAgentExecutorを使い回す現在の方法を比較します。
+LLMへのリクエストは行わないため、API keyは不要です。
+
+usage:
+    $ python benchmarks/bench_agent_setup.py [--turns 200]
+"""
+
+import argparse
+import os
+import statistics
+import sys
+import time
+from typing import Callable
+
+# srcをimportできるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# LLM clientの作成に必要な環境変数(実際の通信は行わない)
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "dummy")
+os.environ.setdefault("AZURE_OPENAI_API_DEPLOYMENT", "dummy")
+os.environ.setdefault("AZURE_OPENAI_API_BASE", "https://example.invalid")
+
+from langchain.agents import AgentExecutor  # noqa: E402
+from langchain.agents.format_scratchpad import (  # noqa: E402
+    format_to_openai_function_messages,
+)
+from langchain.agents.output_parsers import OpenAIFunctionsAgentOutputParser  # noqa: E402
+from langchain_core.utils.function_calling import convert_to_openai_function  # noqa: E402
+
+from tripalgpt import TriPalEngine, TriPalGPT  # noqa: E402
+
+
+def legacy_turn_setup(engine: TriPalEngine, session: TriPalGPT) -> None:
+    """
+    従来の_create_agent_executorと同じ処理を毎ターン行う
+    """
+    def history(x: dict) -> dict:
+        return {"chat_history": session._load_memory()}
+
+    model_with_tools = engine.model_16k.bind(
+        functions=[convert_to_openai_function(t) for t in engine.tools]
+    )
+    agent = (
+        {
+            "input": lambda x: x["input"],
+            "agent_scratchpad": lambda x: format_to_openai_function_messages(
+                x["intermediate_steps"]
+            ),
+            "chat_history": lambda x: history(x)["chat_history"],
+        }
+        | engine.prompt
+        | model_with_tools
+        | OpenAIFunctionsAgentOutputParser()
+    )
+    AgentExecutor.from_agent_and_tools(agent=agent, tools=engine.tools)
+
+
+def shared_turn_setup(engine: TriPalEngine, session: TriPalGPT) -> None:
+    """
+    共有のAgentExecutorを取得し、履歴を入力として渡す準備のみを行う
+    """
+    _ = engine.agent_executor
+    _ = {"input": "東京に行きたい", "chat_history": session._load_memory()}
+
+
+def measure(
+    setup: Callable[[TriPalEngine, TriPalGPT], None],
+    engine: TriPalEngine,
+    session: TriPalGPT,
+    turns: int,
+) -> list[float]:
+    # 初回のみ発生するコストを除くため、1回空打ちする
+    setup(engine, session)
+
+    elapsed = []
+    for _ in range(turns):
+        start = time.perf_counter()
+        setup(engine, session)
+        elapsed.append((time.perf_counter() - start) * 1_000_000)
+    return elapsed
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--turns", type=int, default=200)
+    args = parser.parse_args()
+
+    engine = TriPalEngine()
+    session = TriPalGPT(engine=engine)
+
+    for name, setup in (
+        ("legacy (per turn)", legacy_turn_setup),
+        ("shared (per process)", shared_turn_setup),
+    ):
+        elapsed = measure(setup, engine, session, args.turns)
+        print(
+            f"{name:<22} mean: {statistics.mean(elapsed):10.1f} us"
+            f"  p50: {statistics.median(elapsed):10.1f} us"
+            f"  max: {max(elapsed):10.1f} us"
+        )
+
+
+if __name__ == "__main__":
+    main()
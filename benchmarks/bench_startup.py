@@ -0,0 +1,155 @@
+"""
+scale-to-zeroからの起動を想定した、cold startの所要時間を計測するbenchmark
+
+- importtime: `import app`にかかる時間と、時間のかかっているmoduleの一覧
+- ready: uvicornを起動してから、"/"が最初に200を返すまでの時間
+
+CIで利用するための判定(どちらかを満たさない場合は、終了コード1で終了します)
+- --baseline-src: 比較対象(mainなど)のsrcも同じ環境で計測し、readyが
+  baselineの(1 + --max-regression)倍 + --slack秒を超えていないか。
+  runnerの性能の差に影響されないように、こちらを主に使う
+- --max-seconds: readyの絶対値の上限(大きな劣化を検知するための余裕のある値)
+
+usage:
+    $ python benchmarks/bench_startup.py [--baseline-src ../main/src] [--max-seconds 3.0] [--top 15] [--runs 3]
+"""
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import time
+
+import httpx
+
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src")
+
+# 起動するだけなので、実際のAzureの設定は不要
+DUMMY_ENV = {
+    "AZURE_OPENAI_API_KEY": "dummy",
+    "AZURE_OPENAI_API_DEPLOYMENT": "dummy",
+    "AZURE_OPENAI_API_BASE": "https://example.invalid",
+}
+
+
+def _env() -> dict[str, str]:
+    return {**DUMMY_ENV, **os.environ, "PYTHONUNBUFFERED": "1"}
+
+
+def measure_importtime(src_dir: str, top: int) -> float:
+    """
+    `python -X importtime -c "import app"`の結果から、時間のかかったmoduleを表示する
+
+    :param src_dir: appのあるdirectory
+    :return: import appの合計時間(秒)
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import app"],
+        cwd=src_dir,
+        env=_env(),
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+
+    # "import time: self [us] | cumulative | imported package"
+    rows: list[tuple[int, str]] = []
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        _self_us, cumulative, name = line.split(":", 1)[1].split("|")
+        rows.append((int(cumulative), name.rstrip()))
+
+    total = next((us for us, name in rows if name.strip() == "app"), 0)
+    print(f"import app: {total / 1e6:.3f}s")
+    for us, name in sorted(rows, reverse=True)[:top]:
+        print(f"  {us / 1e3:9.1f}ms  {name}")
+    return total / 1e6
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def measure_ready(src_dir: str, timeout: float) -> float:
+    """
+    uvicornを起動して、"/"が最初に200を返すまでの時間を計測する
+
+    :param src_dir: appのあるdirectory
+    :return: 起動からの時間(秒)
+    """
+    port = _free_port()
+    started = time.perf_counter()
+    server = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "app:app", "--port", str(port)],
+        cwd=src_dir,
+        env=_env(),
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.DEVNULL,
+    )
+    try:
+        with httpx.Client(timeout=1.0) as client:
+            while time.perf_counter() - started < timeout:
+                if server.poll() is not None:
+                    raise RuntimeError(f"uvicorn exited with code {server.returncode}")
+                try:
+                    if client.get(f"http://127.0.0.1:{port}/").status_code == 200:
+                        return time.perf_counter() - started
+                except httpx.TransportError:
+                    pass
+                time.sleep(0.01)
+        raise TimeoutError(f"server was not ready within {timeout}s")
+    finally:
+        server.terminate()
+        server.wait()
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--baseline-src", help="比較対象のsrc directory")
+    parser.add_argument("--max-regression", type=float, default=0.25)
+    parser.add_argument("--slack", type=float, default=0.15, help="許容する差(秒)")
+    parser.add_argument("--max-seconds", type=float, default=None)
+    parser.add_argument("--top", type=int, default=15)
+    parser.add_argument("--runs", type=int, default=3)
+    args = parser.parse_args()
+
+    measure_importtime(SRC_DIR, args.top)
+    timeout = max((args.max_seconds or 0) * 10, 10.0)
+
+    # 1回目はbytecodeのcompileを含むので、最も速かった回で判定する
+    # baselineと交互に計測して、runnerの負荷の変動の影響を揃える
+    readies: list[float] = []
+    baseline_readies: list[float] = []
+    for _ in range(args.runs):
+        readies.append(measure_ready(SRC_DIR, timeout))
+        if args.baseline_src:
+            baseline_readies.append(measure_ready(args.baseline_src, timeout))
+    best = min(readies)
+    print("ready: " + ", ".join(f"{ready:.3f}s" for ready in readies))
+
+    failed = False
+    if baseline_readies:
+        baseline = min(baseline_readies)
+        limit = baseline * (1 + args.max_regression) + args.slack
+        print("baseline ready: " + ", ".join(f"{ready:.3f}s" for ready in baseline_readies))
+        if best > limit:
+            print(f"FAIL: ready {best:.3f}s > baseline {baseline:.3f}s (limit {limit:.3f}s)")
+            failed = True
+        else:
+            print(f"OK: ready {best:.3f}s <= baseline {baseline:.3f}s (limit {limit:.3f}s)")
+    if args.max_seconds is not None:
+        if best > args.max_seconds:
+            print(f"FAIL: ready {best:.3f}s > {args.max_seconds:.3f}s")
+            failed = True
+        else:
+            print(f"OK: ready {best:.3f}s <= {args.max_seconds:.3f}s")
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+"""
+streaming方式ごとの、tokenあたりのoverheadとメモリ使用量を計測するbenchmark
+
+fakeのLLM(遅延なし)で複数回のTool呼び出しを含むAgentの実行を行い、
+"astream_log"(RunLogPatchの整形)と"callback"(Queueへの直接送信)を比較します。
+
+usage:
+    $ python benchmarks/bench_streaming.py [--tool-steps 5] [--tokens 1500] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import os
+import statistics
+import time
+import tracemalloc
+
+# --tool-steps回のToolの呼び出しを全て行うように、Agentの1ターンの予算を外す
+os.environ.setdefault("TRIPAL_AGENT_MAX_ITERATIONS", "100")
+os.environ.setdefault("TRIPAL_AGENT_MAX_TOOL_CALLS", "100")
+
+from fake_llm import create_fake_engine  # noqa: E402
+from tripalgpt import StreamMode, TriPalGPT  # noqa: E402
+
+
+async def run_once(engine, mode: StreamMode) -> tuple[int, float, int]:
+    session = TriPalGPT(engine=engine, stream_mode=mode)
+
+    tracemalloc.start()
+    start = time.perf_counter()
+    tokens = 0
+    async for _ in session.get_async_generator_output("東京に行きたい"):
+        tokens += 1
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return tokens, elapsed, peak
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--tool-steps", type=int, default=5)
+    parser.add_argument("--tokens", type=int, default=1500)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    engine = create_fake_engine(tool_steps=args.tool_steps, answer_tokens=args.tokens)
+
+    mode: StreamMode
+    for mode in ("astream_log", "callback"):
+        results = [await run_once(engine, mode) for _ in range(args.runs)]
+        tokens = results[0][0]
+        per_token_us = [elapsed / tokens * 1_000_000 for _, elapsed, _ in results]
+        peak_kib = [peak / 1024 for _, _, peak in results]
+        print(
+            f"{mode:<12} tokens: {tokens:6d}"
+            f"  per token: {statistics.median(per_token_us):8.1f} us"
+            f"  turn: {statistics.median(e for _, e, _ in results) * 1000:8.1f} ms"
+            f"  peak memory: {statistics.median(peak_kib):10.1f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,82 @@
+"""
+1ターンあたりのLLMの往復回数と所要時間を、Toolの呼び出し方ごとに比較するbenchmark
+
+fakeのLLM(1往復ごとにfirst-token-delay秒)とfakeのTools(1回ごとにtool-delay秒)で、
+Location_InformationとReservation_Informationの両方を使うターンを実行します。
+- sequential: 1回の応答で1つのToolを呼び出す(functions方式と同じ。2往復 + 回答)
+- parallel: 1回の応答で2つのToolを呼び出す(parallel tool calls。1往復 + 回答)
+
+usage:
+    $ python benchmarks/bench_tool_calls.py [--first-token-delay 0.5] [--tool-delay 0.3] [--runs 5]
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+from typing import Any
+
+from langchain_core.callbacks import AsyncCallbackHandler
+
+from fake_llm import create_fake_engine
+from tripalgpt import TriPalGPT
+
+# 名前: (応答ごとのtool call数, Toolを呼び出す応答の数)
+SCENARIOS = {
+    "sequential": (1, 2),
+    "parallel": (2, 1),
+}
+
+
+class _RoundCounter(AsyncCallbackHandler):
+    """
+    LLMの呼び出し回数を数えるcallback
+    """
+
+    def __init__(self) -> None:
+        self.rounds = 0
+
+    async def on_chat_model_start(self, *args: Any, **kwargs: Any) -> None:
+        self.rounds += 1
+
+
+async def run_once(engine, counter: _RoundCounter) -> tuple[int, float]:
+    session = TriPalGPT(engine=engine, stream_mode="callback")
+
+    counter.rounds = 0
+    start = time.perf_counter()
+    async for _ in session.get_async_generator_output("浅草の観光スポットと近くのホテルを教えて"):
+        pass
+    return counter.rounds, time.perf_counter() - start
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--first-token-delay", type=float, default=0.5)
+    parser.add_argument("--tool-delay", type=float, default=0.3)
+    parser.add_argument("--tokens", type=int, default=200)
+    parser.add_argument("--runs", type=int, default=5)
+    args = parser.parse_args()
+
+    for name, (parallel_tools, tool_steps) in SCENARIOS.items():
+        engine = create_fake_engine(
+            tool_steps=tool_steps,
+            answer_tokens=args.tokens,
+            parallel_tools=parallel_tools,
+            first_token_delay=args.first_token_delay,
+            tool_delay=args.tool_delay,
+        )
+        counter = _RoundCounter()
+        # bind()したmodelも同じinstanceを参照しているので、後からcallbackを足せる
+        engine.model_16k.callbacks = [counter]
+
+        results = [await run_once(engine, counter) for _ in range(args.runs)]
+        print(
+            f"{name:<10} tool calls: {parallel_tools * tool_steps}"
+            f"  LLM round trips: {statistics.median(r for r, _ in results):4.1f}"
+            f"  turn: {statistics.median(e for _, e in results) * 1000:8.1f} ms"
+        )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,99 @@
+"""
+/chatの送信方式ごとの、end-to-endの所要時間とプロセスあたりのthroughputを計測するbenchmark
+
+fakeのLLMで応答を生成し、WebSocketの代わりに送信回数を数えるだけの関数へ送信します。
+- legacy: 1tokenごとに0.03秒待ってから送信する(従来の方式)
+- coalesced: stream_sender.send_coalescedでtokenをまとめて送信する
+
+usage:
+    $ python benchmarks/bench_ws_sender.py [--sessions 50] [--tokens 1500] [--token-delay 0.002]
+    $ python benchmarks/bench_ws_sender.py --flush-interval 0 --pacing 0.03
+"""
+
+import argparse
+import asyncio
+import statistics
+import time
+
+from fake_llm import create_fake_engine
+from stream_sender import (
+    STREAM_FLUSH_INTERVAL,
+    STREAM_MAX_FRAME_BYTES,
+    STREAM_PACING,
+    send_coalesced,
+)
+from tripalgpt import TriPalGPT
+
+
+async def legacy_send(session: TriPalGPT, send) -> tuple[int, int]:
+    tokens = 0
+    async for output in session.get_async_generator_output("東京に行きたい"):
+        await asyncio.sleep(0.03)
+        await send(output)
+        await asyncio.sleep(0)
+        tokens += 1
+    return tokens, tokens
+
+
+async def coalesced_send(session: TriPalGPT, send, args) -> tuple[int, int]:
+    stats = await send_coalesced(
+        send=send,
+        tokens=session.get_async_generator_output("東京に行きたい"),
+        flush_interval=args.flush_interval,
+        max_frame_bytes=args.max_frame_bytes,
+        pacing=args.pacing,
+    )
+    return stats.tokens, stats.frames
+
+
+async def run(mode: str, engine, args) -> None:
+    async def send(text: str) -> None:
+        await asyncio.sleep(0)
+
+    async def one_session() -> tuple[float, int, int]:
+        session = TriPalGPT(engine=engine)
+        start = time.perf_counter()
+        if mode == "legacy":
+            tokens, frames = await legacy_send(session, send)
+        else:
+            tokens, frames = await coalesced_send(session, send, args)
+        return time.perf_counter() - start, tokens, frames
+
+    start = time.perf_counter()
+    results = await asyncio.gather(*(one_session() for _ in range(args.sessions)))
+    wall = time.perf_counter() - start
+
+    latencies = sorted(r[0] for r in results)
+    tokens = sum(r[1] for r in results)
+    frames = sum(r[2] for r in results)
+    print(
+        f"{mode:<10} sessions: {args.sessions:4d}"
+        f"  e2e p50: {statistics.median(latencies):7.2f} s"
+        f"  e2e max: {latencies[-1]:7.2f} s"
+        f"  throughput: {tokens / wall:9.1f} tokens/s"
+        f"  frames: {frames:8d}"
+    )
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--tokens", type=int, default=1500)
+    parser.add_argument("--token-delay", type=float, default=0.002)
+    parser.add_argument("--flush-interval", type=float, default=STREAM_FLUSH_INTERVAL)
+    parser.add_argument("--max-frame-bytes", type=int, default=STREAM_MAX_FRAME_BYTES)
+    parser.add_argument("--pacing", type=float, default=STREAM_PACING)
+    parser.add_argument("--skip-legacy", action="store_true")
+    args = parser.parse_args()
+
+    engine = create_fake_engine(
+        tool_steps=1, answer_tokens=args.tokens, token_delay=args.token_delay
+    )
+
+    if not args.skip_legacy:
+        await run("legacy", engine, args)
+    await run("coalesced", engine, args)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,235 @@
+"""
+benchmark用の、通信を行わないfakeのLLMとTools
+
+TriPalEngineのmodelとtoolsを差し替えることで、
+Azure OpenAIやTripadvisor・Rakutenのquotaを使わずにAgentExecutorを動かせます。
+"""
+
+import asyncio
+import json
+import os
+import sys
+from typing import Any, AsyncIterator, Iterator
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src"))
+
+# LLM clientの作成に必要な環境変数(実際の通信は行わない)
+os.environ.setdefault("AZURE_OPENAI_API_KEY", "dummy")
+os.environ.setdefault("AZURE_OPENAI_API_DEPLOYMENT", "dummy")
+os.environ.setdefault("AZURE_OPENAI_API_BASE", "https://example.invalid")
+# 先読みは本物のTripadvisor・Rakutenを呼び出すので、benchmarkでは行わない
+os.environ.setdefault("TRIPAL_PREFETCH", "0")
+
+from langchain_core.callbacks import (  # noqa: E402
+    AsyncCallbackManagerForLLMRun,
+    CallbackManagerForLLMRun,
+)
+from langchain_core.language_models.chat_models import (  # noqa: E402
+    BaseChatModel,
+    agenerate_from_stream,
+    generate_from_stream,
+)
+from langchain_core.messages import (  # noqa: E402
+    AIMessage,
+    AIMessageChunk,
+    BaseMessage,
+    HumanMessage,
+)
+from langchain_core.outputs import ChatGenerationChunk, ChatResult  # noqa: E402
+from langchain_core.tools import StructuredTool  # noqa: E402
+
+from func_call_tools.reservations import TravelReservationSchema  # noqa: E402
+from func_call_tools.suggestions import TravelProposalSchema  # noqa: E402
+from tripalgpt import TriPalEngine  # noqa: E402
+
+
+# astream_logのpath判定("/logs/AzureChatOpenAI")に合わせるため、同じclass名にしている
+class AzureChatOpenAI(BaseChatModel):
+    """
+    tool_steps回だけToolを呼び出してから、answer_tokens個のtokenで回答するfake model
+
+    1回の応答で、parallel_tools個のtool call(Location_InformationとReservation_Informationを交互に)
+    を返します。Toolが渡されていない呼び出し(要約など)には、すぐに回答します。
+    """
+
+    tool_steps: int = 3
+    parallel_tools: int = 1
+    answer_tokens: int = 1500
+    token_delay: float = 0.0
+    # 応答の最初のchunkを返すまでの時間(LLMの1往復の遅延)
+    first_token_delay: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-azure-chat-openai"
+
+    def _tool_rounds(self, messages: list[BaseMessage]) -> int:
+        """
+        今回のターン(最後のuserの発言以降)で、Toolを呼び出した応答の数
+        """
+        rounds = 0
+        for message in reversed(messages):
+            if isinstance(message, HumanMessage):
+                break
+            if isinstance(message, AIMessage) and message.additional_kwargs.get("tool_calls"):
+                rounds += 1
+        return rounds
+
+    def _tool_calls(self, round_index: int) -> list[dict[str, Any]]:
+        tool_calls = []
+        for i in range(self.parallel_tools):
+            if i % 2 == 0:
+                name, arguments = "Location_Information", {"loc_search": "東京の観光スポット"}
+            else:
+                name, arguments = "Reservation_Information", {"keyword": "浅草"}
+            tool_calls.append(
+                {
+                    "index": i,
+                    "id": f"call_{round_index}_{i}",
+                    "type": "function",
+                    "function": {
+                        "name": name,
+                        "arguments": json.dumps(arguments, ensure_ascii=False),
+                    },
+                }
+            )
+        return tool_calls
+
+    def _chunks(
+        self, messages: list[BaseMessage], kwargs: dict[str, Any]
+    ) -> Iterator[ChatGenerationChunk]:
+        rounds = self._tool_rounds(messages)
+        # tool_choice="none"(Agentの予算を使い切った後)の場合は、必ず回答する
+        can_call_tools = bool(kwargs.get("tools")) and kwargs.get("tool_choice") != "none"
+        if rounds < self.tool_steps and can_call_tools:
+            yield ChatGenerationChunk(
+                message=AIMessageChunk(
+                    content="", additional_kwargs={"tool_calls": self._tool_calls(rounds)}
+                )
+            )
+            return
+        for i in range(self.answer_tokens):
+            yield ChatGenerationChunk(message=AIMessageChunk(content=f"t{i % 10}"))
+
+    def _stream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> Iterator[ChatGenerationChunk]:
+        for chunk in self._chunks(messages, kwargs):
+            if run_manager:
+                run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    async def _astream(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> AsyncIterator[ChatGenerationChunk]:
+        if self.first_token_delay:
+            await asyncio.sleep(self.first_token_delay)
+        for chunk in self._chunks(messages, kwargs):
+            if self.token_delay:
+                await asyncio.sleep(self.token_delay)
+            if run_manager:
+                await run_manager.on_llm_new_token(chunk.text, chunk=chunk)
+            yield chunk
+
+    def _generate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: CallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return generate_from_stream(self._stream(messages, stop, run_manager, **kwargs))
+
+    async def _agenerate(
+        self,
+        messages: list[BaseMessage],
+        stop: list[str] | None = None,
+        run_manager: AsyncCallbackManagerForLLMRun | None = None,
+        **kwargs: Any,
+    ) -> ChatResult:
+        return await agenerate_from_stream(
+            self._astream(messages, stop, run_manager, **kwargs)
+        )
+
+
+def _fake_location_info(loc_search: str = "", category: str = "") -> dict[str, Any]:
+    return {
+        f"{loc_search} {i}": {"name": f"{loc_search} {i}", "address": "東京都"}
+        for i in range(10)
+    }
+
+
+def _fake_reserve_location(keyword: str = "", pref_code: str = "") -> dict[str, Any]:
+    return {f"{keyword} ホテル {i}": {"hotel_info": {"hotelName": keyword}} for i in range(10)}
+
+
+def _with_delay(func: Any, delay: float) -> Any:
+    """
+    外部APIの待ち時間の代わりに、delay秒待ってから結果を返す非同期版の関数を作る
+    """
+
+    async def coroutine(**kwargs: Any) -> Any:
+        await asyncio.sleep(delay)
+        return func(**kwargs)
+
+    return coroutine
+
+
+def create_fake_engine(
+    tool_steps: int = 3,
+    answer_tokens: int = 1500,
+    token_delay: float = 0.0,
+    parallel_tools: int = 1,
+    first_token_delay: float = 0.0,
+    tool_delay: float = 0.0,
+    chat_answer_tokens: int = 100,
+) -> TriPalEngine:
+    """
+    fakeのmodelとtoolsに差し替えたTriPalEngineを作成する
+
+    雑談用の速いmodel(model_fast)は、Toolを呼び出さずにchat_answer_tokens個のtokenで回答します。
+    """
+    engine = TriPalEngine()
+    engine.model_16k = AzureChatOpenAI(
+        tool_steps=tool_steps,
+        parallel_tools=parallel_tools,
+        answer_tokens=answer_tokens,
+        token_delay=token_delay,
+        first_token_delay=first_token_delay,
+    )
+    engine.tools = [
+        StructuredTool.from_function(
+            name="Location_Information",
+            func=_fake_location_info,
+            coroutine=_with_delay(_fake_location_info, tool_delay),
+            description="fake",
+            args_schema=TravelProposalSchema,
+        ),
+        StructuredTool.from_function(
+            name="Reservation_Information",
+            func=_fake_reserve_location,
+            coroutine=_with_delay(_fake_reserve_location, tool_delay),
+            description="fake",
+            args_schema=TravelReservationSchema,
+        ),
+    ]
+    engine.agent_executor = engine._create_agent_executor()
+    # 長いセッションで古いターンを要約する場合も、Azure OpenAIには接続しない
+    engine.summarizer = engine._create_summarizer()
+    engine.model_fast = AzureChatOpenAI(
+        tool_steps=0,
+        answer_tokens=chat_answer_tokens,
+        token_delay=token_delay,
+        first_token_delay=first_token_delay,
+    )
+    engine.chat_chain = engine._create_chat_chain()
+    engine.router.classifier = engine._create_router_classifier()
+    return engine
@@ -0,0 +1,312 @@
+"""
+負荷試験用の、Azure OpenAI・Tripadvisor・Rakutenの代わりをするローカルのserver
+
+本物と同じ形式のレスポンスを、設定した遅延で返します。
+- Azure OpenAI: POST /openai/deployments/{deployment}/chat/completions
+  最初の発言にはtool call(Location_Information / Reservation_Information)を、
+  Toolの結果を受け取った後は回答をtokenごとにstreaming(SSE)で返す
+  toolsが渡された場合は、1回の応答で両方のToolを呼び出す(parallel tool calls。--no-parallel-toolsで1つ)
+  functionsが渡された場合は、従来のfunction callで1つのToolを呼び出す
+- Tripadvisor: GET /tripadvisor/location/search, GET /tripadvisor/location/{id}/details
+- Rakuten: GET /rakuten/Travel/KeywordHotelSearch/20170426
+
+TriPal側は以下の環境変数で、このserverに向けます(load_chat.pyが設定します)。
+    AZURE_OPENAI_API_BASE=http://127.0.0.1:{port}
+    TRIPADVISOR_API_BASE=http://127.0.0.1:{port}/tripadvisor
+    RAKUTEN_API_BASE=http://127.0.0.1:{port}/rakuten
+
+usage:
+    $ python benchmarks/fake_upstreams.py [--port 8100] [--first-token-latency 0.3]
+        [--token-interval 0.01] [--answer-tokens 200] [--upstream-latency 0.05]
+        [--no-parallel-tools]
+"""
+
+import argparse
+import asyncio
+import json
+import random
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Any, AsyncIterator
+
+import uvicorn
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+
+
+@dataclass
+class FakeSettings:
+    # 最初のtoken(chunk)を返すまでの時間(秒)
+    first_token_latency: float = 0.3
+    # tokenごとの間隔(秒)
+    token_interval: float = 0.01
+    # 回答のtoken数
+    answer_tokens: int = 200
+    # 最初の発言で、Toolを呼び出す割合
+    function_call_rate: float = 1.0
+    # toolsが渡された場合に、1回の応答で両方のToolを呼び出すかどうか
+    parallel_tools: bool = True
+    # Tripadvisor・Rakutenのレスポンスの遅延(秒)
+    upstream_latency: float = 0.05
+    # Tripadvisorの検索結果の件数
+    search_results: int = 10
+
+
+settings = FakeSettings()
+app = FastAPI()
+
+# 回答として返すtoken(日本語の文章を細かく区切ったもの)
+ANSWER_PIECES = [
+    "東京", "で", "おすすめ", "の", "観光", "スポット", "を", "ご紹介", "します", "。",
+    "\n\n", "1", ".", " **", "浅草", "寺", "**", "\n", "   ", "- ", "住所", ": ",
+    "東京都", "台東区", "浅草", "2", "-", "3", "-", "1", "\n", "   ", "- ", "説明",
+    ": ", "東京", "最古", "の", "寺院", "で", "、", "雷門", "が", "有名", "です", "。",
+    "\n\n",
+]
+RESERVATION_WORDS = ("ホテル", "宿", "旅館", "予約", "泊")
+
+
+def _chunk(completion_id: str, delta: dict[str, Any], finish_reason: str | None = None) -> str:
+    body = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": "gpt-35-turbo-16k",
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(body, ensure_ascii=False)}\n\n"
+
+
+def _choose_calls(body: dict[str, Any]) -> list[tuple[str, dict[str, str]]]:
+    """
+    Toolを呼び出すかどうかと、その内容を決める
+
+    最後のmessageがuserの発言で、toolsかfunctionsが渡されている場合のみ呼び出します。
+    (tool_choice="none"の場合は呼び出さない)
+    """
+    messages = body.get("messages", [])
+    if not (body.get("tools") or body.get("functions")):
+        return []
+    if body.get("tool_choice") == "none":
+        return []
+    if not messages or messages[-1].get("role") != "user":
+        return []
+    if random.random() >= settings.function_call_rate:
+        return []
+
+    user_input = str(messages[-1].get("content") or "")
+    location = ("Location_Information", {"loc_search": user_input[:20], "category": ""})
+    reservation = ("Reservation_Information", {"keyword": user_input[:20], "pref_code": ""})
+    if body.get("tools") and settings.parallel_tools:
+        return [location, reservation]
+    if any(word in user_input for word in RESERVATION_WORDS):
+        return [reservation]
+    return [location]
+
+
+async def _stream_function_call(
+    completion_id: str, name: str, arguments: dict[str, str]
+) -> AsyncIterator[str]:
+    await asyncio.sleep(settings.first_token_latency)
+    yield _chunk(
+        completion_id,
+        {"role": "assistant", "content": None, "function_call": {"name": name, "arguments": ""}},
+    )
+    serialized = json.dumps(arguments, ensure_ascii=False)
+    for i in range(0, len(serialized), 8):
+        await asyncio.sleep(settings.token_interval)
+        yield _chunk(completion_id, {"function_call": {"arguments": serialized[i : i + 8]}})
+    yield _chunk(completion_id, {}, finish_reason="function_call")
+    yield "data: [DONE]\n\n"
+
+
+async def _stream_tool_calls(
+    completion_id: str, calls: list[tuple[str, dict[str, str]]]
+) -> AsyncIterator[str]:
+    await asyncio.sleep(settings.first_token_latency)
+    yield _chunk(completion_id, {"role": "assistant", "content": None})
+    for index, (name, arguments) in enumerate(calls):
+        yield _chunk(
+            completion_id,
+            {
+                "tool_calls": [
+                    {
+                        "index": index,
+                        "id": f"call_{uuid.uuid4().hex[:12]}",
+                        "type": "function",
+                        "function": {"name": name, "arguments": ""},
+                    }
+                ]
+            },
+        )
+        serialized = json.dumps(arguments, ensure_ascii=False)
+        for i in range(0, len(serialized), 8):
+            await asyncio.sleep(settings.token_interval)
+            yield _chunk(
+                completion_id,
+                {"tool_calls": [{"index": index, "function": {"arguments": serialized[i : i + 8]}}]},
+            )
+    yield _chunk(completion_id, {}, finish_reason="tool_calls")
+    yield "data: [DONE]\n\n"
+
+
+async def _stream_answer(completion_id: str) -> AsyncIterator[str]:
+    await asyncio.sleep(settings.first_token_latency)
+    yield _chunk(completion_id, {"role": "assistant", "content": ""})
+    for i in range(settings.answer_tokens):
+        yield _chunk(completion_id, {"content": ANSWER_PIECES[i % len(ANSWER_PIECES)]})
+        await asyncio.sleep(settings.token_interval)
+    yield _chunk(completion_id, {}, finish_reason="stop")
+    yield "data: [DONE]\n\n"
+
+
+@app.post("/openai/deployments/{deployment}/chat/completions")
+async def chat_completions(deployment: str, request: Request):
+    body = await request.json()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex[:12]}"
+    calls = _choose_calls(body)
+
+    if body.get("stream"):
+        if calls and body.get("tools"):
+            stream = _stream_tool_calls(completion_id, calls)
+        elif calls:
+            stream = _stream_function_call(completion_id, *calls[0])
+        else:
+            stream = _stream_answer(completion_id)
+        return StreamingResponse(stream, media_type="text/event-stream")
+
+    # streamingでない場合は、全体をまとめて返す
+    await asyncio.sleep(
+        settings.first_token_latency + settings.token_interval * settings.answer_tokens
+    )
+    if calls and body.get("tools"):
+        message = {
+            "role": "assistant",
+            "content": None,
+            "tool_calls": [
+                {
+                    "id": f"call_{uuid.uuid4().hex[:12]}",
+                    "type": "function",
+                    "function": {
+                        "name": name,
+                        "arguments": json.dumps(arguments, ensure_ascii=False),
+                    },
+                }
+                for name, arguments in calls
+            ],
+        }
+        finish_reason = "tool_calls"
+    elif calls:
+        message = {
+            "role": "assistant",
+            "content": None,
+            "function_call": {
+                "name": calls[0][0],
+                "arguments": json.dumps(calls[0][1], ensure_ascii=False),
+            },
+        }
+        finish_reason = "function_call"
+    else:
+        content = "".join(
+            ANSWER_PIECES[i % len(ANSWER_PIECES)] for i in range(settings.answer_tokens)
+        )
+        message = {"role": "assistant", "content": content}
+        finish_reason = "stop"
+    return JSONResponse(
+        {
+            "id": completion_id,
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": "gpt-35-turbo-16k",
+            "choices": [{"index": 0, "message": message, "finish_reason": finish_reason}],
+            "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+        }
+    )
+
+
+@app.get("/tripadvisor/location/search")
+async def tripadvisor_search(searchQuery: str = "") -> JSONResponse:
+    await asyncio.sleep(settings.upstream_latency)
+    data = [
+        {
+            "location_id": str(1000 + i),
+            "name": f"{searchQuery} スポット{i}",
+            "address_obj": {"country": "日本", "address_string": f"東京都千代田区{i}-1-1"},
+        }
+        for i in range(settings.search_results)
+    ]
+    return JSONResponse({"data": data})
+
+
+@app.get("/tripadvisor/location/{location_id}/details")
+async def tripadvisor_details(location_id: str) -> JSONResponse:
+    await asyncio.sleep(settings.upstream_latency)
+    return JSONResponse(
+        {
+            "location_id": location_id,
+            "name": f"スポット{location_id}",
+            "description": "歴史のある人気の観光スポットです。" * 5,
+            "web_url": f"https://www.tripadvisor.jp/{location_id}",
+            "address_obj": {"country": "日本", "address_string": "東京都千代田区1-1-1"},
+            "phone": "+81 3-0000-0000",
+            "website": "https://example.com",
+            "hours": {"weekday_text": ["月曜日: 9:00～17:00", "火曜日: 9:00～17:00"]},
+        }
+    )
+
+
+@app.get("/rakuten/Travel/KeywordHotelSearch/20170426")
+async def rakuten_keyword_search(keyword: str = "") -> JSONResponse:
+    await asyncio.sleep(settings.upstream_latency)
+    hotels = [
+        [
+            {
+                "hotelBasicInfo": {
+                    "hotelName": f"{keyword} ホテル{i}",
+                    "hotelSpecial": "駅から徒歩5分。",
+                    "postalCode": "100-0001",
+                    "address1": "東京都",
+                    "address2": f"千代田区{i}-1-1",
+                    "telephoneNo": "03-0000-0000",
+                    "hotelInformationUrl": f"https://travel.rakuten.co.jp/HOTEL/{i}/",
+                    "planListUrl": f"https://travel.rakuten.co.jp/HOTEL/{i}/plan/",
+                    "hotelMinCharge": 8000 + i * 500,
+                    "access": "JR東京駅から徒歩5分",
+                }
+            }
+        ]
+        for i in range(15)
+    ]
+    return JSONResponse({"pagingInfo": {"recordCount": len(hotels)}, "hotels": hotels})
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8100)
+    parser.add_argument("--first-token-latency", type=float, default=settings.first_token_latency)
+    parser.add_argument("--token-interval", type=float, default=settings.token_interval)
+    parser.add_argument("--answer-tokens", type=int, default=settings.answer_tokens)
+    parser.add_argument("--function-call-rate", type=float, default=settings.function_call_rate)
+    parser.add_argument("--upstream-latency", type=float, default=settings.upstream_latency)
+    parser.add_argument(
+        "--no-parallel-tools",
+        dest="parallel_tools",
+        action="store_false",
+        help="toolsが渡されても、1回の応答で1つのToolだけを呼び出す",
+    )
+    args = parser.parse_args()
+
+    settings.first_token_latency = args.first_token_latency
+    settings.token_interval = args.token_interval
+    settings.answer_tokens = args.answer_tokens
+    settings.function_call_rate = args.function_call_rate
+    settings.upstream_latency = args.upstream_latency
+    settings.parallel_tools = args.parallel_tools
+
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,346 @@
+"""
+/chatの負荷試験。N個のWebSocketセッションを同時に開き、ターンごとの所要時間を計測する
+
+fake_upstreams.pyのserverとTriPal(uvicorn)をローカルで起動し、
+Azure OpenAI・Tripadvisor・Rakutenのquotaを使わずに計測します。
+--urlを指定した場合は、起動済みのserverに接続します。
+
+計測する値
+- ttft: メッセージを送ってから、最初のdelta frameを受け取るまでの時間
+- turn: メッセージを送ってから、end frameを受け取るまでの時間
+- tokens/sec: 最初のdeltaからendまでの、応答のtoken数(cl100k_base。取得できない場合は文字数)/秒
+- rss/session: 全セッションが接続中のserverのRSSの増分 / セッション数
+
+usage:
+    $ python benchmarks/load_chat.py [--sessions 50] [--turns 2] [--answer-tokens 200]
+    $ python benchmarks/load_chat.py --url ws://127.0.0.1:8000/chat --pid 12345
+    $ python benchmarks/load_chat.py --sessions 100 --json result.json
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from dataclasses import asdict, dataclass, field
+
+import httpx
+import tiktoken
+import websockets
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SRC_DIR = os.path.join(ROOT_DIR, "src")
+BENCH_DIR = os.path.join(ROOT_DIR, "benchmarks")
+
+MESSAGES = [
+    "東京でおすすめの観光スポットを教えて",
+    "浅草の近くでおすすめのホテルを予約したい",
+    "京都で紅葉がきれいな場所はどこ？",
+]
+
+# 初回の利用時に読み込む(Noneは未読込、Falseは読み込めなかったことを示す)
+_encoding: "tiktoken.Encoding | bool | None" = None
+
+
+def _count_tokens(text: str) -> int:
+    """
+    応答のtoken数(cl100k_base)を数える
+
+    encodingのfileはnetworkから取得するため、取得できない環境では文字数で代用します。
+    """
+    global _encoding
+    if _encoding is None:
+        try:
+            _encoding = tiktoken.get_encoding("cl100k_base")
+        except Exception as e:
+            print(f"tiktoken encoding is unavailable, counting characters instead: {e}")
+            _encoding = False
+    if _encoding is False:
+        return len(text)
+    return len(_encoding.encode(text))
+
+
+@dataclass
+class TurnResult:
+    ttft: float | None = None
+    turn: float = 0.0
+    tokens: int = 0
+    tokens_per_sec: float = 0.0
+    error: str | None = None
+
+
+@dataclass
+class Report:
+    sessions: int = 0
+    turns: int = 0
+    errors: int = 0
+    ttft: dict[str, float] = field(default_factory=dict)
+    turn: dict[str, float] = field(default_factory=dict)
+    tokens_per_sec: dict[str, float] = field(default_factory=dict)
+    rss_per_session_kib: float | None = None
+    wall: float = 0.0
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+def _rss_kib(pid: int) -> int | None:
+    """
+    プロセスのRSS(KiB)を取得する。Linux以外ではNone
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1])
+    except OSError:
+        return None
+    return None
+
+
+def _percentiles(values: list[float]) -> dict[str, float]:
+    if not values:
+        return {}
+    values = sorted(values)
+
+    def at(q: float) -> float:
+        return values[min(len(values) - 1, int(q * len(values)))]
+
+    return {
+        "mean": statistics.fmean(values),
+        "p50": at(0.50),
+        "p90": at(0.90),
+        "p99": at(0.99),
+        "max": values[-1],
+    }
+
+
+def _wait_ready(url: str, process: subprocess.Popen, timeout: float = 60.0) -> None:
+    deadline = time.perf_counter() + timeout
+    while time.perf_counter() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError(f"{url} exited with code {process.returncode}")
+        try:
+            httpx.get(url, timeout=1.0)
+            return
+        except httpx.TransportError:
+            time.sleep(0.05)
+    raise TimeoutError(f"{url} was not ready within {timeout}s")
+
+
+def start_servers(args: argparse.Namespace, workdir: str) -> tuple[list[subprocess.Popen], str, int]:
+    """
+    fakeの外部APIと、それに向けたTriPalを起動する
+
+    :return: 起動したプロセス, /chatのURL, TriPalのpid
+    """
+    fake_port, app_port = _free_port(), _free_port()
+    fake = subprocess.Popen(
+        [
+            sys.executable,
+            os.path.join(BENCH_DIR, "fake_upstreams.py"),
+            "--port", str(fake_port),
+            "--first-token-latency", str(args.first_token_latency),
+            "--token-interval", str(args.token_interval),
+            "--answer-tokens", str(args.answer_tokens),
+            "--function-call-rate", str(args.function_call_rate),
+            "--upstream-latency", str(args.upstream_latency),
+            *([] if args.parallel_tools else ["--no-parallel-tools"]),
+        ],
+    )
+    fake_base = f"http://127.0.0.1:{fake_port}"
+    env = {
+        **os.environ,
+        "AZURE_OPENAI_API_KEY": "dummy",
+        "AZURE_OPENAI_API_DEPLOYMENT": "fake",
+        "AZURE_OPENAI_API_BASE": fake_base,
+        "TRIPADVISOR_API_KEY": "dummy",
+        "TRIPADVISOR_API_BASE": f"{fake_base}/tripadvisor",
+        "RAKUTEN_APPLICATION_ID": "dummy",
+        "RAKUTEN_AFFILIATE_ID": "dummy",
+        "RAKUTEN_API_BASE": f"{fake_base}/rakuten",
+        # 計測ごとに空のcacheとlogから始める
+        "TRIPAL_CACHE_DB": os.path.join(workdir, "tool_cache.sqlite3"),
+        "TRIPAL_SESSION_DB": os.path.join(workdir, "sessions.sqlite3"),
+        "TRIPAL_LOG_FILE": os.path.join(workdir, "tripal.log"),
+    }
+    app = subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "app:app",
+            "--port", str(app_port), "--log-level", "warning",
+        ],
+        cwd=SRC_DIR,
+        env=env,
+    )
+    processes = [fake, app]
+    try:
+        _wait_ready(f"{fake_base}/docs", fake)
+        _wait_ready(f"http://127.0.0.1:{app_port}/", app)
+    except Exception:
+        stop_servers(processes)
+        raise
+    return processes, f"ws://127.0.0.1:{app_port}/chat", app.pid
+
+
+def stop_servers(processes: list[subprocess.Popen]) -> None:
+    for process in processes:
+        process.terminate()
+    for process in processes:
+        process.wait()
+
+
+async def run_turn(ws: websockets.WebSocketClientProtocol, message: str) -> TurnResult:
+    result = TurnResult()
+    start = time.perf_counter()
+    first_at: float | None = None
+    texts: list[str] = []
+
+    await ws.send(message)
+    while True:
+        raw = await ws.recv()
+        try:
+            frame = json.loads(raw)
+        except json.JSONDecodeError:
+            # 旧形式のエラーメッセージ(JSONでない)
+            result.error = str(raw)
+            break
+        if frame.get("type") == "delta":
+            if first_at is None:
+                first_at = time.perf_counter()
+                result.ttft = first_at - start
+            texts.append(frame.get("text", ""))
+        elif frame.get("type") == "end":
+            break
+        elif frame.get("type") == "error":
+            result.error = frame.get("text", "error")
+            break
+
+    end = time.perf_counter()
+    result.turn = end - start
+    result.tokens = _count_tokens("".join(texts))
+    if first_at is not None and end > first_at:
+        result.tokens_per_sec = result.tokens / (end - first_at)
+    return result
+
+
+async def run_session(
+    url: str,
+    index: int,
+    args: argparse.Namespace,
+    turns_done: asyncio.Event,
+    release: asyncio.Event,
+) -> list[TurnResult]:
+    results: list[TurnResult] = []
+    try:
+        # 接続を少しずつ増やす
+        await asyncio.sleep(args.ramp * index / max(args.sessions, 1))
+        async with websockets.connect(url, max_size=None, open_timeout=60) as ws:
+            # 最初に"session" frameが送られてくる
+            await ws.recv()
+
+            for turn in range(args.turns):
+                message = MESSAGES[(index + turn) % len(MESSAGES)]
+                results.append(await run_turn(ws, message))
+
+            # 全セッションが接続している間にメモリを計測するため、閉じずに待つ
+            turns_done.set()
+            await release.wait()
+    except (OSError, asyncio.TimeoutError, websockets.WebSocketException) as e:
+        results.append(TurnResult(error=f"{e.__class__.__name__}: {e}"))
+    finally:
+        turns_done.set()
+    return results
+
+
+async def run_load(url: str, pid: int | None, args: argparse.Namespace) -> Report:
+    # engineの読み込みなど、初回のみの処理を計測から除く
+    async with websockets.connect(url, max_size=None, open_timeout=60) as ws:
+        await ws.recv()
+        await run_turn(ws, MESSAGES[0])
+
+    rss_before = _rss_kib(pid) if pid is not None else None
+
+    turns_done = [asyncio.Event() for _ in range(args.sessions)]
+    release = asyncio.Event()
+
+    start = time.perf_counter()
+    tasks = [
+        asyncio.create_task(run_session(url, i, args, turns_done[i], release))
+        for i in range(args.sessions)
+    ]
+    await asyncio.gather(*(event.wait() for event in turns_done))
+    wall = time.perf_counter() - start
+    rss_after = _rss_kib(pid) if pid is not None else None
+    release.set()
+    sessions = await asyncio.gather(*tasks)
+
+    results = [result for session in sessions for result in session]
+    ok = [result for result in results if result.error is None]
+    report = Report(
+        sessions=args.sessions,
+        turns=len(results),
+        errors=len(results) - len(ok),
+        ttft=_percentiles([r.ttft for r in ok if r.ttft is not None]),
+        turn=_percentiles([r.turn for r in ok]),
+        tokens_per_sec=_percentiles([r.tokens_per_sec for r in ok if r.tokens_per_sec > 0]),
+        wall=wall,
+    )
+    if rss_before is not None and rss_after is not None:
+        report.rss_per_session_kib = (rss_after - rss_before) / args.sessions
+    return report
+
+
+def print_report(report: Report) -> None:
+    print(f"sessions: {report.sessions}, turns: {report.turns}, errors: {report.errors}, "
+          f"wall: {report.wall:.2f}s")
+    for name, unit in (("ttft", "s"), ("turn", "s"), ("tokens_per_sec", "")):
+        stats = getattr(report, name)
+        if stats:
+            print(f"{name:>15}: " + ", ".join(f"{k} {v:.3f}{unit}" for k, v in stats.items()))
+    if report.rss_per_session_kib is not None:
+        print(f"{'rss/session':>15}: {report.rss_per_session_kib:.1f} KiB")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--sessions", type=int, default=50)
+    parser.add_argument("--turns", type=int, default=2)
+    parser.add_argument("--ramp", type=float, default=1.0, help="接続を開き終えるまでの秒数")
+    parser.add_argument("--url", help="起動済みのserverの/chatのURL")
+    parser.add_argument("--pid", type=int, help="--urlのserverのpid(メモリの計測用)")
+    parser.add_argument("--json", help="結果をJSONで保存するpath")
+    # fake_upstreams.pyの設定
+    parser.add_argument("--first-token-latency", type=float, default=0.3)
+    parser.add_argument("--token-interval", type=float, default=0.01)
+    parser.add_argument("--answer-tokens", type=int, default=200)
+    parser.add_argument("--function-call-rate", type=float, default=1.0)
+    parser.add_argument("--upstream-latency", type=float, default=0.05)
+    parser.add_argument("--no-parallel-tools", dest="parallel_tools", action="store_false")
+    args = parser.parse_args()
+
+    if args.url:
+        report = asyncio.run(run_load(args.url, args.pid, args))
+    else:
+        with tempfile.TemporaryDirectory() as workdir:
+            processes, url, pid = start_servers(args, workdir)
+            try:
+                report = asyncio.run(run_load(url, pid, args))
+            finally:
+                stop_servers(processes)
+
+    print_report(report)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(asdict(report), f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
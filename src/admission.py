@@ -0,0 +1,201 @@
+import asyncio
+import os
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable, Literal
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from metrics import (
+    ADMISSION_ACTIVE,
+    ADMISSION_REJECTED_TOTAL,
+    ADMISSION_WAIT_SECONDS,
+    ADMISSION_WAITING,
+)
+
+# ---------- 初期化処理 ---------- #
+# 同時に実行するagent(1ターンの応答)の上限。Azure OpenAIのTPM/RPMに合わせて調整する
+MAX_CONCURRENT_RUNS = int(os.environ.get("TRIPAL_MAX_CONCURRENT_RUNS", "32"))
+# 実行を待てるターン数の上限。これを超えた分はすぐに断る
+MAX_QUEUED_RUNS = int(os.environ.get("TRIPAL_MAX_QUEUED_RUNS", "64"))
+# 実行を待つ時間の上限(秒)。これを超えた分は断る
+RUN_QUEUE_TIMEOUT = float(os.environ.get("TRIPAL_RUN_QUEUE_TIMEOUT", "20.0"))
+# ------------------------------- #
+
+
+class AdmissionRejected(Exception):
+    """
+    混雑しているため、処理を受け付けなかったことを示す例外
+    """
+
+    def __init__(self, name: str, reason: Literal["queue_full", "timeout"]) -> None:
+        super().__init__(f"{name} rejected: {reason}")
+        self.name = name
+        self.reason = reason
+
+
+@dataclass(eq=False)
+class _Waiter:
+    # 実行できるようになったら結果がセットされる
+    admitted: asyncio.Future = field(
+        default_factory=lambda: asyncio.get_running_loop().create_future()
+    )
+    # 順番が変わったら結果がセットされる(毎回作り直す)
+    moved: asyncio.Future | None = None
+
+
+class AdmissionController:
+    """
+    同時実行数の上限と、上限つきの待ち行列を持つ受付
+
+    上限に空きがあればすぐに実行し、なければ到着順に待たせます。
+    待ち行列が一杯の場合や、wait_timeout秒待っても順番が来ない場合は、
+    AdmissionRejectedを送出してすぐに断ります(過負荷でも待ち時間が予測できるように)。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        max_concurrent: int,
+        max_queue: int,
+        wait_timeout: float,
+    ) -> None:
+        self.name = name
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.wait_timeout = wait_timeout
+
+        self._active = 0
+        self._waiters: deque[_Waiter] = deque()
+
+        self.admitted = 0
+        self.rejected_full = 0
+        self.rejected_timeout = 0
+
+    @property
+    def active(self) -> int:
+        return self._active
+
+    @property
+    def waiting(self) -> int:
+        return len(self._waiters)
+
+    def _update_gauges(self) -> None:
+        ADMISSION_ACTIVE.set(self._active, name=self.name)
+        ADMISSION_WAITING.set(len(self._waiters), name=self.name)
+
+    def _position(self, waiter: _Waiter) -> int:
+        return self._waiters.index(waiter) + 1
+
+    def _admit_next(self) -> None:
+        """
+        空きがあれば、先頭から順に実行させる。残った人には順番が変わったことを知らせる
+        """
+        while self._active < self.max_concurrent and self._waiters:
+            waiter = self._waiters.popleft()
+            if waiter.admitted.done():
+                continue
+            waiter.admitted.set_result(None)
+            self._active += 1
+        for waiter in self._waiters:
+            if waiter.moved is not None and not waiter.moved.done():
+                waiter.moved.set_result(None)
+        self._update_gauges()
+
+    def _release(self) -> None:
+        self._active -= 1
+        self._admit_next()
+
+    def _reject(self, reason: Literal["queue_full", "timeout"]) -> AdmissionRejected:
+        if reason == "queue_full":
+            self.rejected_full += 1
+        else:
+            self.rejected_timeout += 1
+        ADMISSION_REJECTED_TOTAL.inc(name=self.name, reason=reason)
+        return AdmissionRejected(self.name, reason)
+
+    async def _wait(
+        self, waiter: _Waiter, on_position: Callable[[int], Awaitable[None]] | None
+    ) -> None:
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + self.wait_timeout
+        reported = None
+        while not waiter.admitted.done():
+            position = self._position(waiter)
+            if on_position is not None and position != reported:
+                reported = position
+                await on_position(position)
+                # 送信している間に順番が来たかもしれない
+                continue
+
+            waiter.moved = loop.create_future()
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise self._reject("timeout")
+            await asyncio.wait(
+                [waiter.admitted, waiter.moved],
+                timeout=remaining,
+                return_when=asyncio.FIRST_COMPLETED,
+            )
+
+    @asynccontextmanager
+    async def acquire(
+        self, on_position: Callable[[int], Awaitable[None]] | None = None
+    ) -> AsyncIterator[None]:
+        """
+        実行できるようになるまで待ち、終わったら枠を返す
+
+        :param on_position: 待っている間、順番(1始まり)が変わるたびに呼ばれる関数
+        """
+        start = time.perf_counter()
+        if self._active < self.max_concurrent and not self._waiters:
+            self._active += 1
+            self._update_gauges()
+        elif len(self._waiters) >= self.max_queue:
+            raise self._reject("queue_full")
+        else:
+            waiter = _Waiter()
+            self._waiters.append(waiter)
+            self._update_gauges()
+            try:
+                await self._wait(waiter, on_position)
+            except BaseException:
+                # 断られた場合や、待っている間に切断された場合
+                if waiter.admitted.done() and not waiter.admitted.cancelled():
+                    # 枠を受け取った直後だったので、次の人に渡す
+                    self._release()
+                else:
+                    waiter.admitted.cancel()
+                    if waiter in self._waiters:
+                        self._waiters.remove(waiter)
+                    self._admit_next()
+                raise
+
+        self.admitted += 1
+        ADMISSION_WAIT_SECONDS.observe(time.perf_counter() - start, name=self.name)
+        try:
+            yield
+        finally:
+            self._release()
+
+    def stats(self) -> dict[str, int | float]:
+        return {
+            "active": self._active,
+            "waiting": len(self._waiters),
+            "max_concurrent": self.max_concurrent,
+            "max_queue": self.max_queue,
+            "wait_timeout": self.wait_timeout,
+            "admitted": self.admitted,
+            "rejected_full": self.rejected_full,
+            "rejected_timeout": self.rejected_timeout,
+        }
+
+
+# プロセス全体で共有する、agentの実行(1ターンの応答)の受付
+agent_admission = AdmissionController(
+    "agent_runs",
+    max_concurrent=MAX_CONCURRENT_RUNS,
+    max_queue=MAX_QUEUED_RUNS,
+    wait_timeout=RUN_QUEUE_TIMEOUT,
+)
@@ -1,49 +1,128 @@
 import asyncio
-import logging
+import json
 import os
-from logging import FileHandler, Formatter, StreamHandler, getLogger
+import re
+import time
+import uuid
+from logging import getLogger
+from typing import TYPE_CHECKING
 
-from dotenv import find_dotenv, load_dotenv
 from fastapi import (
     FastAPI,
     Request,
     WebSocket,
     WebSocketDisconnect,
 )
-from fastapi.responses import HTMLResponse
+from fastapi.responses import HTMLResponse, JSONResponse, PlainTextResponse
 from fastapi.staticfiles import StaticFiles
 from fastapi.templating import Jinja2Templates
 
-from tripalgpt import TriPalGPT
+import env_setup
+from admission import AdmissionRejected, agent_admission
+from caching import get_cache_stats
+from func_call_tools.poi_snapshot import poi_snapshot
+from http_client import (
+    aclose_async_client,
+    get_breaker_states,
+    get_upstream_admission_stats,
+)
+from log_setup import bind_session, common_logger, get_log_stats, new_turn
+from metrics import (
+    ACTIVE_SESSIONS,
+    TURNS_CANCELLED_TOTAL,
+    WS_FIRST_FRAME_SECONDS,
+    WS_TURN_SECONDS,
+    render_metrics,
+)
+from response_cache import response_cache
+from session_store import create_session_store
+from stream_sender import send_coalesced
+
+# langchainなどのimportには時間がかかるので、tripalgptは必要になってから読み込む
+# (scale-to-zeroからの起動で、"/"をすぐに返せるようにするため)
+if TYPE_CHECKING:
+    from tripalgpt import TriPalEngine, TriPalGPT
 
 # --------------- 初期化処理 --------------- #
-# cwdを./srcに変更
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
-# 環境変数をロード
-load_dotenv(find_dotenv())
 # ---FastAPI--- #
 app = FastAPI()
-app.mount("/static", StaticFiles(directory="static"), name="static")
+app.mount(
+    "/static",
+    StaticFiles(directory=os.path.join(env_setup.SRC_DIR, "static")),
+    name="static",
+)
 # template engineの設定
-templates = Jinja2Templates(directory="templates")
+templates = Jinja2Templates(directory=os.path.join(env_setup.SRC_DIR, "templates"))
 # ------------- #
 
 # ---Logの出力--- #
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
 logger = getLogger(__name__)
-logger.setLevel(logging.ERROR)
-# handlerの設定
-# StreamHandler
-stream_handler = StreamHandler()
-stream_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-stream_handler.setLevel(logging.ERROR)
-logger.addHandler(stream_handler)
-# FileHandler
-file_handler = FileHandler(filename="logs/app.log")
-file_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-file_handler.setLevel(logging.ERROR)
-logger.addHandler(file_handler)
 # ----------------------------------------- #
 
+# 会話の履歴の保存先(TRIPAL_SESSION_STORE)
+# プロセスの外に保存すれば、複数のworkerやnodeで/chatを動かせる
+session_store = create_session_store()
+# clientから受け取るセッションIDの形式
+SESSION_ID_PATTERN = re.compile(r"^[A-Za-z0-9_-]{16,64}$")
+
+# 混雑していて断った場合のメッセージ
+BUSY_MESSAGE = "ただいま混み合っています。 しばらくしてから再度お試しください。"
+# 応答中にエラーが発生した場合に、clientに表示するメッセージ
+ERROR_MESSAGE = "エラーが発生しました。 しばらくしてから再度お試しください。"
+
+# 起動後すぐに、backgroundでTriPalEngineを読み込んでおくかどうか
+PRELOAD_ENGINE = os.environ.get("TRIPAL_PRELOAD_ENGINE", "1") == "1"
+_engine_task: asyncio.Future | None = None
+_preload_task: asyncio.Task | None = None
+
+
+def _load_engine() -> "TriPalEngine":
+    from tripalgpt import get_tripal_engine
+
+    return get_tripal_engine()
+
+
+# 共有のTriPalEngineを取得する
+async def get_engine() -> "TriPalEngine":
+    """
+    共有のTriPalEngineを取得する。
+
+    初回はimportとLLM clientの作成をthreadで行い、その間もevent loopを止めません。
+    同時に呼ばれた場合も、読み込みは1回だけ行われます。
+    """
+    global _engine_task
+    if _engine_task is None:
+        _engine_task = asyncio.ensure_future(asyncio.to_thread(_load_engine))
+    try:
+        return await asyncio.shield(_engine_task)
+    except Exception:
+        # 読み込みに失敗した場合は、次の呼び出しで再び試す
+        if _engine_task.done():
+            _engine_task = None
+        raise
+
+
+# アプリの起動時に、TriPalEngineの読み込みを始める(完了は待たない)
+@app.on_event("startup")
+async def startup() -> None:
+    global _preload_task
+
+    async def _preload() -> None:
+        try:
+            await get_engine()
+        except Exception as e:
+            logger.exception(f" [Preload Error] {e.__class__.__name__}: {e}")
+
+    if PRELOAD_ENGINE:
+        _preload_task = asyncio.create_task(_preload())
+
+
+# アプリの終了時に、共有のHTTP clientを閉じる
+@app.on_event("shutdown")
+async def shutdown() -> None:
+    await aclose_async_client()
+
 
 # HTMLをレンダリングするだけの関数
 @app.get("/")
@@ -54,6 +133,26 @@ def index(request: Request) -> HTMLResponse:
     )
 
 
+# clientにJSON形式のframeを送信する
+async def _send_frame(ws: WebSocket, frame_type: str, **payload: str | int) -> None:
+    """
+    clientにframeを送信する。
+
+    frameの種類(type)は以下の通り
+    - "delta": 応答の一部(text)
+    - "end": 1ターンの応答の終わり
+    - "error": エラーメッセージ(text)
+    - "session": このセッションのID(session_id)
+    - "queue": 混雑していて、順番を待っていること(position: 何番目か)
+
+    :param ws: 送信先のWebSocket
+    :param frame_type: frameの種類
+    :param payload: frameに含める値
+    """
+    # 日本語をescapeすると3倍近いサイズになるので、ensure_ascii=Falseにする
+    await ws.send_text(json.dumps({"type": frame_type, **payload}, ensure_ascii=False))
+
+
 # Websocketを使用して、一つのrouteで送受信ができるようにする
 # そうしないと、入力と出力が一緒にできず、他の人が入力した内容で出力してしまう可能性がある
 @app.websocket("/chat")
@@ -61,35 +160,176 @@ async def chat(ws: WebSocket) -> None:
     # Websocketの接続を確立
     await ws.accept()
 
-    # LLMの初期化
-    tripal_gpt = TriPalGPT()
+    # clientから渡されたセッションIDを使う。なければ新しく発行してclientに伝える
+    # 再接続した場合や、別のworkerに繋がった場合でも、同じ履歴を使える
+    session_id = ws.query_params.get("session_id", "")
+    if not SESSION_ID_PATTERN.match(session_id):
+        session_id = uuid.uuid4().hex
+        await _send_frame(ws, "session", session_id=session_id)
+    # このセッションのLogには、セッションIDを付ける
+    bind_session(session_id)
+
+    ACTIVE_SESSIONS.inc()
+    tripal_gpt = None
+    # 受信は応答の送信中も続け、切断や新しい入力があれば実行中のターンを止める
+    inbox: asyncio.Queue[str | None] = asyncio.Queue()
+    turn_task: asyncio.Task | None = None
+
+    def cancel_turn(reason: str) -> None:
+        if turn_task is not None and not turn_task.done():
+            turn_task.cancel()
+            TURNS_CANCELLED_TOTAL.inc(reason=reason)
+            common_logger.info("turn_cancelled", extra={"reason": reason})
+
+    async def receive() -> None:
+        try:
+            while True:
+                user_chat = await ws.receive_text()
+                # 応答の途中で新しい入力があった場合は、古い方を止める
+                cancel_turn("superseded")
+                inbox.put_nowait(user_chat)
+        except WebSocketDisconnect:
+            cancel_turn("disconnect")
+        finally:
+            inbox.put_nowait(None)
 
+    # Engineを読み込んでいる間に届いた入力も、inboxで待たせておく
+    receiver = asyncio.create_task(receive())
     try:
-        # Websocketの接続が切れるまで、ユーザーの入力を受け取る
-        while True:
-            # ユーザーの入力を受け取る
-            user_chat = await ws.receive_text()
+        # セッションの初期化
+        # LLM clientやToolsはプロセス全体で共有し、セッションごとには会話の履歴のみを持つ
+        # 読み込みに失敗した場合も、clientにはerror frameで知らせる
+        engine = await get_engine()
+        from tripalgpt import TriPalGPT
 
-            # チャットボットにユーザーの入力を渡して、応答を取得する
-            # responseは非同期generator
-            async for output in tripal_gpt.get_async_generator_output(
-                user_input=user_chat
-            ):
-                # 応答を送信する
-                # UXのために、0.03秒待つ
-                # 0秒だと早すぎて目で追えない
-                await asyncio.sleep(0.03)
-                # Websocketに応答を送信
-                await ws.send_text(output)
-                await asyncio.sleep(0)
+        tripal_gpt = TriPalGPT(engine=engine, session_id=session_id, store=session_store)
+
+        # Websocketの接続が切れるまで、ユーザーの入力を受け取る
+        while (user_chat := await inbox.get()) is not None:
+            new_turn()
+            turn_task = asyncio.create_task(_run_turn(ws, tripal_gpt, user_chat))
+            try:
+                await turn_task
+            except asyncio.CancelledError:
+                # このhandler自体が止められた場合(serverの終了など)はそのまま終了する
+                if asyncio.current_task().cancelling():
+                    raise
+                # 新しい入力で止めた場合は、このターンの終わりを知らせる
+                if not receiver.done():
+                    await _send_frame(ws, "end")
     except WebSocketDisconnect:
-        del tripal_gpt
+        pass
     except Exception as e:
-        # エラーをログに出力
+        # エラーをログに出力
         logger.exception(f" {e.__class__.__name__}: {e}")
-        await ws.send_text(
-            "エラーが発生しました。 しばらくしてから再度お試しください。"
-        )
+        await _send_frame(ws, "error", text=ERROR_MESSAGE)
+        await _send_frame(ws, "end")
+    finally:
+        cancel_turn("disconnect")
+        receiver.cancel()
+        ACTIVE_SESSIONS.dec()
+        del tripal_gpt
+
+
+# 1ターン分の応答を送信する
+async def _run_turn(ws: WebSocket, tripal_gpt: "TriPalGPT", user_chat: str) -> None:
+    """
+    ユーザーの入力に対する応答を、clientにstreamingで送信する。
+
+    clientの切断や新しい入力があった場合は、このtaskごとcancelされます。
+    その場合、LLMのstreamingや実行中のToolの呼び出しも止まります。
+
+    :param ws: 送信先のWebSocket
+    :param tripal_gpt: このセッションのTriPalGPT
+    :param user_chat: ユーザーの入力
+    """
+    # 同時に実行できる数を超えている場合は、順番が来るまで待つ
+    # 待っている間は、何番目かをclientに知らせる
+    # 待ちきれない場合(待ち行列が一杯・時間切れ)はすぐに断る
+    turn_start = time.perf_counter()
+    try:
+        async with agent_admission.acquire(
+            on_position=lambda position: _send_frame(ws, "queue", position=position)
+        ):
+            waited = time.perf_counter() - turn_start
+
+            # チャットボットにユーザーの入力を渡して、応答を取得する
+            # tokenはいくつかまとめてから送信する
+            # タイピング風の演出はclient側で行うので、ここでは待たない
+            stats = await send_coalesced(
+                send=lambda text: _send_frame(ws, "delta", text=text),
+                tokens=tripal_gpt.get_async_generator_output(user_input=user_chat),
+            )
+    except AdmissionRejected as e:
+        common_logger.warning("admission_rejected", extra={"reason": e.reason})
+        await _send_frame(ws, "error", text=BUSY_MESSAGE)
+        await _send_frame(ws, "end")
+        return
+    await _send_frame(ws, "end")
+
+    if stats.first_frame is not None:
+        WS_FIRST_FRAME_SECONDS.observe(waited + stats.first_frame)
+    WS_TURN_SECONDS.observe(waited + stats.elapsed)
+    common_logger.info(
+        "stream",
+        extra={
+            "waited": round(waited, 3),
+            "tokens": stats.tokens,
+            "frames": stats.frames,
+            "first_frame": stats.first_frame,
+            "elapsed": round(stats.elapsed, 3),
+            "tokens_per_sec": round(stats.tokens_per_sec, 1),
+        },
+    )
+
+
+# Toolのcacheのhit/miss/evictionなどの統計
+@app.get("/stats/cache")
+def cache_stats() -> JSONResponse:
+    return JSONResponse(get_cache_stats())
+
+
+# 最初の発言に対する応答のcacheの統計
+@app.get("/stats/response-cache")
+def response_cache_stats() -> JSONResponse:
+    return JSONResponse(response_cache.stats())
+
+
+# 観光スポットのsnapshotの状態
+@app.get("/stats/poi-snapshot")
+def poi_snapshot_stats() -> JSONResponse:
+    return JSONResponse(poi_snapshot.stats())
+
+
+# 外部APIごとのcircuit breakerの状態
+@app.get("/stats/upstreams")
+def upstream_stats() -> JSONResponse:
+    return JSONResponse(get_breaker_states())
+
+
+# agentの実行と外部APIへのリクエストの、同時実行数と待ち行列の状態
+@app.get("/stats/admission")
+def admission_stats() -> JSONResponse:
+    return JSONResponse(
+        {
+            "agent_runs": agent_admission.stats(),
+            "upstream_calls": get_upstream_admission_stats(),
+        }
+    )
+
+
+# Logの書き込み待ちの数と、捨てた数
+@app.get("/stats/logging")
+def logging_stats() -> JSONResponse:
+    return JSONResponse(get_log_stats())
+
+
+# Prometheusで収集するmetric(ターンごとの所要時間やToolの所要時間など)
+@app.get("/metrics")
+def metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
 
 
 # demoページ
@@ -0,0 +1,384 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable
+
+import env_setup  # noqa: F401  環境変数の読み込み
+
+# ---------- 初期化処理 ---------- #
+# 永続化用のSQLite fileのpath。空文字にするとメモリ上のcacheのみを利用する
+CACHE_DB_PATH = os.environ.get(
+    "TRIPAL_CACHE_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "tool_cache.sqlite3"),
+)
+# メモリ上のcacheに保持する件数の上限(cacheごと)
+CACHE_MAXSIZE = int(os.environ.get("TRIPAL_CACHE_MAXSIZE", "1024"))
+# ------------------------------- #
+
+# cacheに値が存在しないことを示す値
+MISSING = object()
+
+
+def normalize_key(*parts: str) -> str:
+    """
+    cacheのkeyを作成する。
+
+    全角/半角や大文字/小文字、余分な空白の違いを吸収するため、
+    NFKC正規化・小文字化・空白の統一をしてから連結します。
+
+    :param parts: keyの要素(検索クエリ、カテゴリ、言語など)
+    """
+    normalized = (
+        " ".join(unicodedata.normalize("NFKC", str(part)).lower().split())
+        for part in parts
+    )
+    return "\x1f".join(normalized)
+
+
+class TTLCache:
+    """
+    有効期限付きのLRU cache(メモリ上)
+
+    件数がmaxsizeを超えると、最も長く使われていないものから削除します。
+    threadから呼ばれることもあるため、lockで保護しています。
+    """
+
+    def __init__(self, maxsize: int, ttl: float) -> None:
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._data: OrderedDict[str, tuple[float, Any]] = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.expirations = 0
+
+    def get(self, key: str) -> Any:
+        """
+        値を取得する。存在しないか期限切れの場合はMISSINGを返す
+
+        :param key: cache key
+        """
+        with self._lock:
+            item = self._data.get(key)
+            if item is None:
+                self.misses += 1
+                return MISSING
+
+            expires_at, value = item
+            if expires_at <= time.time():
+                del self._data[key]
+                self.expirations += 1
+                self.misses += 1
+                return MISSING
+
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value: Any, ttl: float | None = None) -> None:
+        """
+        値を保存する
+
+        :param key: cache key
+        :param value: 保存する値
+        :param ttl: 有効期限(秒)。Noneの場合はcacheのttlを利用する
+        """
+        expires_at = time.time() + (self.ttl if ttl is None else ttl)
+        with self._lock:
+            self._data[key] = (expires_at, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key: str) -> None:
+        """
+        値を削除する
+
+        :param key: cache key
+        """
+        with self._lock:
+            self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def values(self) -> list[Any]:
+        """
+        期限切れでない値の一覧を取得する(hit数などは変わらない)
+        """
+        now = time.time()
+        with self._lock:
+            return [value for expires_at, value in self._data.values() if expires_at > now]
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "expirations": self.expirations,
+            "size": len(self._data),
+        }
+
+
+class SQLiteCache:
+    """
+    有効期限付きのcache(SQLite)
+
+    プロセスの再起動後も残るように、メモリ上のcacheの後ろに置いて利用します。
+    1つのfileを複数のcache(namespace)で共有します。
+    """
+
+    def __init__(self, path: str, namespace: str) -> None:
+        self.path = path
+        self.namespace = namespace
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+
+    # 初回利用時にのみ接続する
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            # 複数のworkerから同時に読み書きできるようにする
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS cache ("
+                " namespace TEXT NOT NULL,"
+                " key TEXT NOT NULL,"
+                " value TEXT NOT NULL,"
+                " expires_at REAL NOT NULL,"
+                " PRIMARY KEY (namespace, key))"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def get(self, key: str) -> tuple[str, float] | None:
+        """
+        JSON文字列と有効期限を取得する。存在しないか期限切れの場合はNoneを返す
+
+        :param key: cache key
+        """
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT value, expires_at FROM cache"
+                    " WHERE namespace = ? AND key = ? AND expires_at > ?",
+                    (self.namespace, key, time.time()),
+                )
+                .fetchone()
+            )
+        if row is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return row[0], row[1]
+
+    def set(self, key: str, value: str, expires_at: float) -> None:
+        """
+        JSON文字列を保存する
+
+        :param key: cache key
+        :param value: 保存するJSON文字列
+        :param expires_at: 有効期限(UNIX time)
+        """
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO cache (namespace, key, value, expires_at)"
+                " VALUES (?, ?, ?, ?)",
+                (self.namespace, key, value, expires_at),
+            )
+            # 期限切れのものはついでに削除する
+            conn.execute(
+                "DELETE FROM cache WHERE namespace = ? AND expires_at <= ?",
+                (self.namespace, time.time()),
+            )
+            conn.commit()
+
+
+class TieredCache:
+    """
+    メモリ上のLRU cacheと、SQLiteのcacheを組み合わせたcache
+
+    値はJSON文字列として保存し、取得のたびに新しいobjectに復元します。
+    そのため、取得した値を呼び出し側で書き換えても、cacheには影響しません。
+    """
+
+    def __init__(
+        self,
+        name: str,
+        ttl: float,
+        maxsize: int = CACHE_MAXSIZE,
+        db_path: str = CACHE_DB_PATH,
+    ) -> None:
+        self.name = name
+        self.ttl = ttl
+        self.memory = TTLCache(maxsize=maxsize, ttl=ttl)
+        self.disk = SQLiteCache(db_path, namespace=name) if db_path else None
+
+        _registry[name] = self
+
+    def get(self, key: str) -> Any:
+        """
+        値を取得する。存在しない場合はMISSINGを返す
+
+        :param key: cache key
+        """
+        value = self.memory.get(key)
+        if value is MISSING and self.disk is not None:
+            row = self.disk.get(key)
+            if row is not None:
+                value, expires_at = row
+                # 次回からはメモリ上で見つかるようにする
+                self.memory.set(key, value, ttl=expires_at - time.time())
+
+        return MISSING if value is MISSING else json.loads(value)
+
+    def set(self, key: str, value: Any) -> None:
+        """
+        値を保存する。値はJSONに変換できるものに限る
+
+        :param key: cache key
+        :param value: 保存する値
+        """
+        serialized = json.dumps(value, ensure_ascii=False)
+        self.memory.set(key, serialized)
+        if self.disk is not None:
+            self.disk.set(key, serialized, time.time() + self.ttl)
+
+    async def aget(self, key: str) -> Any:
+        """
+        get()の非同期版。SQLiteへのアクセスはthreadで行う
+
+        :param key: cache key
+        """
+        value = self.memory.get(key)
+        if value is not MISSING:
+            return json.loads(value)
+        if self.disk is None:
+            return MISSING
+
+        row = await asyncio.to_thread(self.disk.get, key)
+        if row is None:
+            return MISSING
+        value, expires_at = row
+        self.memory.set(key, value, ttl=expires_at - time.time())
+        return json.loads(value)
+
+    async def aset(self, key: str, value: Any) -> None:
+        """
+        set()の非同期版。SQLiteへのアクセスはthreadで行う
+
+        :param key: cache key
+        :param value: 保存する値
+        """
+        serialized = json.dumps(value, ensure_ascii=False)
+        self.memory.set(key, serialized)
+        if self.disk is not None:
+            await asyncio.to_thread(
+                self.disk.set, key, serialized, time.time() + self.ttl
+            )
+
+    def stats(self) -> dict[str, int]:
+        stats = self.memory.stats()
+        stats["disk_hits"] = self.disk.hits if self.disk is not None else 0
+        stats["disk_misses"] = self.disk.misses if self.disk is not None else 0
+        return stats
+
+
+# 作成されたcacheの一覧(統計の取得用)
+_registry: dict[str, TieredCache] = {}
+_flight_registry: dict[str, "SingleFlight"] = {}
+
+
+def get_cache_stats() -> dict[str, dict[str, int]]:
+    """
+    全てのcacheのhit/miss/evictionなどの統計と、SingleFlightでまとめた呼び出しの数を取得する。
+    """
+    stats = {name: cache.stats() for name, cache in _registry.items()}
+    stats.update(
+        {f"{name}_flight": flight.stats() for name, flight in _flight_registry.items()}
+    )
+    return stats
+
+
+class SingleFlight:
+    """
+    同じkeyに対する同時の呼び出しを、1回の実行にまとめる
+
+    実行中のkeyに対して呼び出された場合は、新しく実行せずにその結果を待ちます。
+    結果は共有されるため、呼び出し側で書き換えないようにしてください。
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self._inflight: dict[str, asyncio.Task] = {}
+        # 実行中のtaskごとの、結果を待っている呼び出しの数
+        self._waiters: dict[asyncio.Task, int] = {}
+
+        self.leaders = 0
+        self.followers = 0
+        self.abandoned = 0
+
+        _flight_registry[name] = self
+
+    async def do(self, key: str, func: Callable[[], Awaitable[Any]]) -> Any:
+        """
+        funcを実行して結果を返す。同じkeyで実行中のものがあれば、その結果を待つ
+
+        funcは独立したtaskとして実行するため、待っている1人がcancelされても、
+        他の待っている呼び出しには影響しません。
+        待っている全員がcancelされた場合は、結果を使う人がいないのでfuncも止めます
+        (実行中のHTTPリクエストも中断されます)。
+
+        :param key: 呼び出しを識別するkey
+        :param func: 実行する非同期関数
+        """
+        task = self._inflight.get(key)
+        # 止めている途中のtaskは使わずに、新しく実行する
+        if task is None or task.cancelling():
+            self.leaders += 1
+            task = asyncio.ensure_future(func())
+            self._inflight[key] = task
+            task.add_done_callback(lambda t: self._done(key, t))
+        else:
+            self.followers += 1
+
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            return await asyncio.shield(task)
+        finally:
+            self._waiters[task] -= 1
+            if self._waiters[task] == 0:
+                del self._waiters[task]
+                if not task.done():
+                    self.abandoned += 1
+                    task.cancel()
+
+    def _done(self, key: str, task: asyncio.Task) -> None:
+        if self._inflight.get(key) is task:
+            del self._inflight[key]
+        # 待っている側がいない場合に、"exception was never retrieved"の警告が出ないようにする
+        if not task.cancelled():
+            task.exception()
+
+    def stats(self) -> dict[str, int]:
+        return {
+            "leaders": self.leaders,
+            "followers": self.followers,
+            "abandoned": self.abandoned,
+            "inflight": len(self._inflight),
+        }
@@ -0,0 +1,285 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Awaitable, Callable, Sequence
+
+import tiktoken
+from langchain_core.messages import (
+    AIMessage,
+    BaseMessage,
+    HumanMessage,
+    SystemMessage,
+    messages_from_dict,
+    messages_to_dict,
+)
+from langchain_core.runnables import Runnable
+
+import env_setup  # noqa: F401  環境変数の読み込み
+
+# ---------- 初期化処理 ---------- #
+logger = getLogger(__name__)
+
+# 履歴として、promptに含めるtoken数の上限
+MEMORY_TOKEN_BUDGET = int(os.environ.get("TRIPAL_MEMORY_TOKEN_BUDGET", "3000"))
+# gpt-35-turbo-16kのtokenizer
+# tiktokenは初回にencodingのfileをdownloadするため、TIKTOKEN_CACHE_DIRにimageのbuild時に保存しておく
+_ENCODING_NAME = "cl100k_base"
+_encoding: tiktoken.Encoding | None = None
+# encodingを読み込めなかった場合に、再び試すまでの時間(秒)
+_ENCODING_RETRY_INTERVAL = 300.0
+_encoding_retry_at = 0.0
+# 1つのmessageにつき、内容とは別にかかるtoken数(roleなど)
+_TOKENS_PER_MESSAGE = 4
+# ------------------------------- #
+
+
+def _get_encoding() -> tiktoken.Encoding | None:
+    """
+    tokenizerを取得する。読み込めない場合(offlineでcacheもない場合など)はNone
+
+    初めてtoken数を数えるときに読み込みます(Engineの作成や起動を待たせないように)。
+    """
+    global _encoding, _encoding_retry_at
+    if _encoding is None and time.monotonic() >= _encoding_retry_at:
+        try:
+            _encoding = tiktoken.get_encoding(_ENCODING_NAME)
+        except Exception as e:
+            _encoding_retry_at = time.monotonic() + _ENCODING_RETRY_INTERVAL
+            logger.warning(
+                f"[Tokenizer Load Error] {e.__class__.__name__}: {e} (count characters instead)"
+            )
+    return _encoding
+
+
+def count_text_tokens(text: str) -> int:
+    """
+    文字列のtoken数を数える
+
+    tokenizerを読み込めない場合は、文字数で見積もります。
+    (cl100k_baseでは日本語はおよそ1文字1token、英語はそれより少ないので、多めの見積もりになる)
+
+    :param text: 数える文字列
+    """
+    encoding = _get_encoding()
+    if encoding is None:
+        return len(text)
+    return len(encoding.encode(text))
+
+
+def count_message_tokens(messages: Sequence[BaseMessage]) -> int:
+    """
+    messageの列が、promptとして何tokenになるかを数える
+
+    function call・tool callの引数も数えに含めます。
+
+    :param messages: 数えるmessageの列
+    """
+    total = 0
+    for message in messages:
+        total += _TOKENS_PER_MESSAGE + count_text_tokens(str(message.content))
+        function_call = message.additional_kwargs.get("function_call")
+        if function_call:
+            total += count_text_tokens(
+                function_call.get("name", "") + function_call.get("arguments", "")
+            )
+        for tool_call in message.additional_kwargs.get("tool_calls") or []:
+            function = tool_call.get("function", {})
+            total += count_text_tokens(
+                function.get("name", "") + function.get("arguments", "")
+            )
+    return total
+
+
+@dataclass
+class _Turn:
+    """
+    1ターン分の会話(ユーザーの入力、Toolの呼び出しと結果、AIの応答)
+    """
+
+    messages: list[BaseMessage]
+    tokens: int
+
+
+class TokenBudgetMemory:
+    """
+    token数の上限付きの会話の履歴
+
+    直近のターンはそのまま保持し、上限を超えた古いターンは要約にまとめます。
+    要約はbackgroundのtaskで作成するため、応答のstreamingを待たせません。
+    要約が出来上がるまでは、古いターンもそのままpromptに含めます。
+    """
+
+    def __init__(
+        self,
+        summarizer: Runnable[dict[str, str], str] | None = None,
+        token_budget: int = MEMORY_TOKEN_BUDGET,
+        on_summarized: Callable[[], Awaitable[None]] | None = None,
+    ) -> None:
+        """
+        :param summarizer: {"summary", "conversation"}を受け取り、新しい要約を返すRunnable。Noneなら古いターンは捨てる
+        :param token_budget: 履歴として、promptに含めるtoken数の上限
+        :param on_summarized: 要約が更新された後に呼び出す関数(SessionStoreへの保存など)
+        """
+        self._summarizer = summarizer
+        self.token_budget = token_budget
+        self._on_summarized = on_summarized
+
+        self.summary = ""
+        self._turns: list[_Turn] = []
+        # 要約待ちのターン
+        self._pending: list[_Turn] = []
+        self._summary_task: asyncio.Task | None = None
+
+    def load_messages(self) -> list[BaseMessage]:
+        """
+        promptに含める履歴を取得する
+        """
+        messages: list[BaseMessage] = []
+        if self.summary:
+            messages.append(
+                SystemMessage(content=f"Summary of the earlier conversation:\n{self.summary}")
+            )
+        for turn in self._pending + self._turns:
+            messages.extend(turn.messages)
+        return messages
+
+    def save_turn(
+        self,
+        user_input: str,
+        output: str,
+        tool_messages: Sequence[BaseMessage] = (),
+    ) -> None:
+        """
+        1ターン分の会話を保存する。上限を超えた場合は、古いターンの要約を始める
+
+        :param user_input: ユーザーからの入力
+        :param output: AIの最終的な応答
+        :param tool_messages: Toolの呼び出しと結果のmessage
+        """
+        messages = [HumanMessage(content=user_input), *tool_messages, AIMessage(content=output)]
+        self._turns.append(_Turn(messages=messages, tokens=count_message_tokens(messages)))
+
+        # 直近の1ターンは必ず残す
+        while len(self._turns) > 1 and self.history_tokens() > self.token_budget:
+            self._pending.append(self._turns.pop(0))
+
+        if self._pending:
+            self._schedule_summary()
+
+    def history_tokens(self) -> int:
+        """
+        要約を除いた、保持しているターンのtoken数の合計
+        """
+        return sum(turn.tokens for turn in self._turns)
+
+    def prompt_tokens(self) -> int:
+        """
+        load_messages()の結果が、promptとして何tokenになるか
+        """
+        tokens = sum(turn.tokens for turn in self._pending) + self.history_tokens()
+        if self.summary:
+            tokens += count_message_tokens(self.load_messages()[:1])
+        return tokens
+
+    def _schedule_summary(self) -> None:
+        if self._summarizer is None:
+            # 要約できない場合は、古いターンは捨てる
+            self._pending.clear()
+            return
+        if self.summarizing:
+            # 実行中のtaskが、追加されたターンもまとめて要約する
+            return
+        try:
+            self._summary_task = asyncio.get_running_loop().create_task(
+                self._summarize_pending()
+            )
+        except RuntimeError:
+            # event loopの外では要約しない(次に保存したときに要約する)
+            pass
+
+    async def _summarize_pending(self) -> None:
+        while self._pending:
+            turns = list(self._pending)
+            conversation = "\n".join(
+                f"{message.type}: {message.content}"
+                for turn in turns
+                for message in turn.messages
+                # Toolの結果は長いので、要約には含めない(AIの応答に反映されている)
+                if message.type in ("human", "ai") and message.content
+            )
+            try:
+                self.summary = await self._summarizer.ainvoke(
+                    {"summary": self.summary or "(none)", "conversation": conversation}
+                )
+            except Exception as e:
+                # 失敗した場合は、古いターンをそのまま残して次の機会に再び試す
+                logger.exception(f"[Memory Summary Error] {e.__class__.__name__}: {e}")
+                return
+            del self._pending[: len(turns)]
+
+            if self._on_summarized is not None:
+                try:
+                    await self._on_summarized()
+                except Exception as e:
+                    logger.exception(f"[Memory Save Error] {e.__class__.__name__}: {e}")
+
+    @property
+    def summarizing(self) -> bool:
+        """
+        要約のtaskが実行中かどうか
+        """
+        return self._summary_task is not None and not self._summary_task.done()
+
+    async def wait_summary(self) -> None:
+        """
+        実行中の要約が終わるまで待つ
+        """
+        if self._summary_task is not None:
+            await asyncio.wait([self._summary_task])
+
+    def to_dict(self) -> dict[str, Any]:
+        """
+        SessionStoreに保存するため、JSONに変換できる辞書にする
+        """
+        return {
+            "summary": self.summary,
+            "turns": [_turn_to_dict(turn) for turn in self._turns],
+            "pending": [_turn_to_dict(turn) for turn in self._pending],
+        }
+
+    def load_dict(self, state: dict[str, Any]) -> None:
+        """
+        to_dict()で作成した辞書から、履歴を復元する
+
+        要約待ちのターンがあれば、このプロセスで要約を始めます。
+        要約の実行中は読み込みません。要約のtaskは、要約待ちのターンを先頭から数えて削除するため、
+        途中で履歴を置き換えると、要約していないターンを消したり、同じターンを2回要約したりします。
+        (要約中のセッションの履歴は、このプロセスのものが最新です)
+
+        :param state: to_dict()の戻り値
+        """
+        if self.summarizing:
+            return
+        self.summary = state.get("summary", "")
+        self._turns = [_turn_from_dict(turn) for turn in state.get("turns", [])]
+        self._pending = [_turn_from_dict(turn) for turn in state.get("pending", [])]
+        if self._pending:
+            self._schedule_summary()
+
+    def stats(self) -> dict[str, Any]:
+        return {
+            "turns": len(self._turns),
+            "pending_turns": len(self._pending),
+            "history_tokens": self.history_tokens(),
+            "summary_tokens": count_text_tokens(self.summary) if self.summary else 0,
+        }
+
+
+def _turn_to_dict(turn: _Turn) -> dict[str, Any]:
+    return {"messages": messages_to_dict(turn.messages), "tokens": turn.tokens}
+
+
+def _turn_from_dict(data: dict[str, Any]) -> _Turn:
+    return _Turn(messages=messages_from_dict(data["messages"]), tokens=data["tokens"])
@@ -1,10 +1,12 @@
 import os
 import json
+import httpx
 from openai import AzureOpenAI
-from dotenv import load_dotenv
+import env_setup  # noqa: F401  環境変数の読み込み
+from http_client import HTTP_CONNECT_TIMEOUT, get_client
 
-# 環境変数をロード
-load_dotenv()
+# 画像の生成には数十秒かかるため、共有のHTTP client(HTTP_READ_TIMEOUT)より長いread timeout(秒)にする
+DALLE_READ_TIMEOUT = float(os.environ.get("OPENAI_API_DALLE_TIMEOUT", "120.0"))
 
 # DALL-E 3で画像を生成するclass
 class DallE3:
@@ -20,6 +22,10 @@ class DallE3:
             azure_endpoint=azure_dalle_api_base,
             api_key=azure_dalle_api_key,
             azure_deployment=azure_dalle_api_deployment,
+            # 共有のHTTP client(keep-alive, timeout, circuit breaker)を利用する
+            http_client=get_client(),
+            # openaiはリクエストごとにこのtimeoutを渡すので、共有のclientのtimeoutは変わらない
+            timeout=httpx.Timeout(DALLE_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT),
         )
 
     def create_image(self, prompt: str) -> str:
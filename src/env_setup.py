@@ -0,0 +1,13 @@
+import os
+
+from dotenv import find_dotenv, load_dotenv
+
+# ---------- 初期化処理 ---------- #
+# 環境変数(.env)の読み込みは、ここで一度だけ行う
+# 環境変数を読むmoduleは、先頭でこのmoduleをimportする
+load_dotenv(find_dotenv())
+
+# srcのdirectory。cwdに依存しないように、fileのpathはここからの絶対pathで指定する
+SRC_DIR = os.path.dirname(os.path.abspath(__file__))
+LOG_DIR = os.path.join(SRC_DIR, "logs")
+# ------------------------------- #
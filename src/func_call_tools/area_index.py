@@ -0,0 +1,347 @@
+import re
+import unicodedata
+from dataclasses import dataclass
+
+# ---------- 初期化処理 ---------- #
+# 都道府県: (日本語の名前, ローマ字(ヘボン式), Rakutenの都道府県コード(middleClassCode))
+# "東京"のように、"都府県"を省いた呼び方で登録する
+PREFECTURES: tuple[tuple[str, str, str], ...] = (
+    ("北海道", "hokkaido", "hokkaido"),
+    ("青森", "aomori", "aomori"),
+    ("岩手", "iwate", "iwate"),
+    ("宮城", "miyagi", "miyagi"),
+    ("秋田", "akita", "akita"),
+    ("山形", "yamagata", "yamagata"),
+    ("福島", "fukushima", "hukushima"),
+    ("茨城", "ibaraki", "ibaragi"),
+    ("栃木", "tochigi", "tochigi"),
+    ("群馬", "gunma", "gunma"),
+    ("埼玉", "saitama", "saitama"),
+    ("千葉", "chiba", "tiba"),
+    ("東京", "tokyo", "tokyo"),
+    ("神奈川", "kanagawa", "kanagawa"),
+    ("新潟", "niigata", "niigata"),
+    ("富山", "toyama", "toyama"),
+    ("石川", "ishikawa", "ishikawa"),
+    ("福井", "fukui", "hukui"),
+    ("山梨", "yamanashi", "yamanasi"),
+    ("長野", "nagano", "nagano"),
+    ("岐阜", "gifu", "gihu"),
+    ("静岡", "shizuoka", "shizuoka"),
+    ("愛知", "aichi", "aichi"),
+    ("三重", "mie", "mie"),
+    ("滋賀", "shiga", "shiga"),
+    ("京都", "kyoto", "kyoto"),
+    ("大阪", "osaka", "osaka"),
+    ("兵庫", "hyogo", "hyogo"),
+    ("奈良", "nara", "nara"),
+    ("和歌山", "wakayama", "wakayama"),
+    ("鳥取", "tottori", "tottori"),
+    ("島根", "shimane", "simane"),
+    ("岡山", "okayama", "okayama"),
+    ("広島", "hiroshima", "hiroshima"),
+    ("山口", "yamaguchi", "yamaguchi"),
+    ("徳島", "tokushima", "tokushima"),
+    ("香川", "kagawa", "kagawa"),
+    ("愛媛", "ehime", "ehime"),
+    ("高知", "kochi", "kouchi"),
+    ("福岡", "fukuoka", "hukuoka"),
+    ("佐賀", "saga", "saga"),
+    ("長崎", "nagasaki", "nagasaki"),
+    ("熊本", "kumamoto", "kumamoto"),
+    ("大分", "oita", "ooita"),
+    ("宮崎", "miyazaki", "miyazaki"),
+    ("鹿児島", "kagoshima", "kagoshima"),
+    ("沖縄", "okinawa", "okinawa"),
+)
+
+# 都道府県名以外でよく聞かれる市・地域: (日本語の名前, ローマ字(ヘボン式), 都道府県コード)
+PLACES: tuple[tuple[str, str, str], ...] = (
+    ("札幌", "sapporo", "hokkaido"),
+    ("函館", "hakodate", "hokkaido"),
+    ("小樽", "otaru", "hokkaido"),
+    ("旭川", "asahikawa", "hokkaido"),
+    ("富良野", "furano", "hokkaido"),
+    ("登別", "noboribetsu", "hokkaido"),
+    ("仙台", "sendai", "miyagi"),
+    ("松島", "matsushima", "miyagi"),
+    ("日光", "nikko", "tochigi"),
+    ("草津", "kusatsu", "gunma"),
+    ("浅草", "asakusa", "tokyo"),
+    ("銀座", "ginza", "tokyo"),
+    ("新宿", "shinjuku", "tokyo"),
+    ("渋谷", "shibuya", "tokyo"),
+    ("池袋", "ikebukuro", "tokyo"),
+    ("品川", "shinagawa", "tokyo"),
+    ("舞浜", "maihama", "tiba"),
+    ("成田", "narita", "tiba"),
+    ("横浜", "yokohama", "kanagawa"),
+    ("箱根", "hakone", "kanagawa"),
+    ("鎌倉", "kamakura", "kanagawa"),
+    ("金沢", "kanazawa", "ishikawa"),
+    ("和倉", "wakura", "ishikawa"),
+    ("河口湖", "kawaguchiko", "yamanasi"),
+    ("軽井沢", "karuizawa", "nagano"),
+    ("白馬", "hakuba", "nagano"),
+    ("高山", "takayama", "gihu"),
+    ("下呂", "gero", "gihu"),
+    ("熱海", "atami", "shizuoka"),
+    ("伊豆", "izu", "shizuoka"),
+    ("名古屋", "nagoya", "aichi"),
+    ("伊勢", "ise", "mie"),
+    ("嵐山", "arashiyama", "kyoto"),
+    ("梅田", "umeda", "osaka"),
+    ("難波", "namba", "osaka"),
+    ("神戸", "kobe", "hyogo"),
+    ("有馬", "arima", "hyogo"),
+    ("城崎", "kinosaki", "hyogo"),
+    ("白浜", "shirahama", "wakayama"),
+    ("倉敷", "kurashiki", "okayama"),
+    ("宮島", "miyajima", "hiroshima"),
+    ("道後", "dogo", "ehime"),
+    ("松山", "matsuyama", "ehime"),
+    ("博多", "hakata", "hukuoka"),
+    ("別府", "beppu", "ooita"),
+    ("由布院", "yufuin", "ooita"),
+    ("湯布院", "yufuin", "ooita"),
+    ("指宿", "ibusuki", "kagoshima"),
+    ("屋久島", "yakushima", "kagoshima"),
+    ("那覇", "naha", "okinawa"),
+    ("石垣", "ishigaki", "okinawa"),
+    ("宮古島", "miyakojima", "okinawa"),
+)
+
+# Rakutenのkeywordとして残す語(宿の種類など)。ローマ字で書かれた場合は日本語に直す
+KEYWORD_WORDS: dict[str, str] = {
+    "ホテル": "hotel",
+    "ビジネスホテル": "",
+    "旅館": "ryokan",
+    "温泉": "onsen",
+    "温泉宿": "",
+    "民宿": "minshuku",
+    "ペンション": "pension",
+    "ゲストハウス": "guesthouse",
+    "リゾート": "resort",
+    "宿": "yado",
+    "おすすめ": "",
+    "格安": "",
+    "高級": "",
+}
+# keywordから取り除く語(助詞や、検索の役に立たない言い回し)
+FILLER_WORDS: frozenset[str] = frozenset(
+    {
+        "の",
+        "な",
+        "で",
+        "に",
+        "にある",
+        "周辺",
+        "近く",
+        "付近",
+        "エリア",
+        "有名な",
+        "人気の",
+        "人気",
+        "宿泊施設",
+        "都",
+        "府",
+        "県",
+        "市",
+        "区",
+    }
+)
+# ローマ字の都道府県名の後ろに付く、取り除く語("tokyo-to", "kanagawa ken"など)
+_ROMAJI_SUFFIXES = ("prefecture", "ken", "fu", "to")
+# ------------------------------- #
+
+
+@dataclass(frozen=True)
+class Area:
+    """
+    地名と、Rakutenの都道府県コード(middleClassCode)
+    """
+
+    name: str
+    pref_code: str
+    is_prefecture: bool
+
+
+def _normalize(text: str) -> str:
+    return unicodedata.normalize("NFKC", text)
+
+
+def _is_romaji(text: str) -> bool:
+    # "Kōchi"のような長音記号付きのローマ字も含める
+    decomposed = unicodedata.normalize("NFKD", text)
+    return "".join(c for c in decomposed if not unicodedata.combining(c)).isascii()
+
+
+def canonical_romaji(text: str) -> str:
+    """
+    ローマ字の表記ゆれ(ヘボン式/訓令式、長音、大文字小文字、"-ken"など)を吸収したkeyを作成する
+
+    例) "Fukuoka", "hukuoka" → "hukuoka" / "Tōkyō-to", "toukyou" → "tokyo"
+
+    :param text: ローマ字の地名
+    """
+    # "ō"などの長音記号を取り除く
+    text = unicodedata.normalize("NFKD", text.lower())
+    text = "".join(c for c in text if not unicodedata.combining(c))
+    words = re.findall(r"[a-z]+", text)
+    if len(words) > 1 and words[-1] in _ROMAJI_SUFFIXES:
+        words = words[:-1]
+    text = "".join(words)
+
+    for hepburn, kunrei in (
+        ("shi", "si"),
+        ("chi", "ti"),
+        ("tsu", "tu"),
+        ("fu", "hu"),
+        ("ji", "zi"),
+        ("sh", "sy"),
+        ("ch", "ty"),
+        ("j", "zy"),
+        ("mb", "nb"),
+    ):
+        text = text.replace(hepburn, kunrei)
+    for long_vowel, vowel in (("ou", "o"), ("oo", "o"), ("uu", "u"), ("aa", "a"), ("ii", "i")):
+        text = text.replace(long_vowel, vowel)
+    return text
+
+
+def _build_index() -> tuple[dict[str, Area], dict[str, Area]]:
+    """
+    日本語の名前と、ローマ字(ヘボン式とRakutenのコード)のkeyから、Areaを引けるようにする
+
+    先に登録したもの(都道府県)を優先します。
+    """
+    by_name: dict[str, Area] = {}
+    by_romaji: dict[str, Area] = {}
+    for table, is_prefecture in ((PREFECTURES, True), (PLACES, False)):
+        for name, romaji, pref_code in table:
+            area = Area(name=name, pref_code=pref_code, is_prefecture=is_prefecture)
+            by_name.setdefault(name, area)
+            for key in (romaji, pref_code if is_prefecture else romaji):
+                by_romaji.setdefault(canonical_romaji(key), area)
+    return by_name, by_romaji
+
+
+# 起動時に一度だけ作成する
+_AREAS_BY_NAME, _AREAS_BY_ROMAJI = _build_index()
+# 長い名前から探して、"京都"が"東京都"の一部として見つからないようにする
+_NAMES_LONGEST_FIRST = sorted(_AREAS_BY_NAME, key=len, reverse=True)
+# keywordを区切るための語彙(長いものから順に試す)
+_VOCABULARY = sorted(
+    {*_AREAS_BY_NAME, *KEYWORD_WORDS, *FILLER_WORDS}, key=len, reverse=True
+)
+_KEYWORD_WORDS_BY_ROMAJI = {romaji: word for word, romaji in KEYWORD_WORDS.items() if romaji}
+
+
+def lookup_area(text: str) -> Area | None:
+    """
+    日本語かローマ字の地名からAreaを取得する。見つからない場合はNone
+
+    :param text: "東京都", "福岡", "fukuoka", "hukuoka"など
+    """
+    text = _normalize(text).strip()
+    if not text:
+        return None
+    if _is_romaji(text):
+        return _AREAS_BY_ROMAJI.get(canonical_romaji(text))
+    area = _AREAS_BY_NAME.get(text)
+    if area is None and text[-1] in "都府県":
+        area = _AREAS_BY_NAME.get(text[:-1])
+    return area
+
+
+def normalize_pref_code(pref_code: str) -> str:
+    """
+    LLMが渡した都道府県コードを、Rakutenの都道府県コードに直す。わからない場合は""
+
+    :param pref_code: "fukuoka", "Tokyo", "東京"など
+    """
+    area = lookup_area(pref_code)
+    return area.pref_code if area is not None else ""
+
+
+def find_areas(text: str, limit: int | None = 2) -> list[tuple[str, str]]:
+    """
+    文章の中から都道府県名・地名を探し、(地名, 都道府県コード)を出てきた順に返す
+
+    "東京都"の中の"京都"のように重なる場合は、長い方(同じ長さなら表の先の方)だけを数えます。
+
+    :param text: ユーザーの入力など
+    :param limit: 返す件数の上限。Noneの場合は全て
+    """
+    text = _normalize(text)
+    found: list[tuple[int, str, str]] = []
+    taken: set[int] = set()
+    for name in _NAMES_LONGEST_FIRST:
+        start = text.find(name)
+        while start != -1:
+            span = set(range(start, start + len(name)))
+            if not span & taken:
+                taken |= span
+                found.append((start, name, _AREAS_BY_NAME[name].pref_code))
+                break
+            start = text.find(name, start + 1)
+
+    found.sort()
+    return [(name, code) for _, name, code in found[:limit]]
+
+
+def _segment(token: str) -> list[str] | None:
+    """
+    語彙の語だけで区切れる場合は区切った語を、区切れない場合はNoneを返す
+    """
+    words = []
+    position = 0
+    while position < len(token):
+        for word in _VOCABULARY:
+            if token.startswith(word, position):
+                words.append(word)
+                position += len(word)
+                break
+        else:
+            return None
+    return words
+
+
+def _normalize_token(token: str) -> list[str]:
+    """
+    keywordの1語を、Rakutenで検索しやすい語に直す
+
+    "東京にあるホテル"のような文章は"東京 ホテル"に、ローマ字の地名は日本語に直します。
+    宿の名前など、語彙で区切れないものはそのまま残します。
+    """
+    if _is_romaji(token):
+        area = _AREAS_BY_ROMAJI.get(canonical_romaji(token))
+        if area is not None:
+            return [area.name]
+        return [_KEYWORD_WORDS_BY_ROMAJI.get(token.lower(), token)]
+
+    words = _segment(token)
+    if words is None or all(word in FILLER_WORDS for word in words):
+        return [token]
+    return [word for word in words if word not in FILLER_WORDS]
+
+
+def normalize_keyword(keyword: str) -> tuple[str, str]:
+    """
+    LLMが渡したkeywordを、空白区切りの検索語に直す
+
+    例) "東京にあるホテル" → ("東京 ホテル", "tokyo") / "hakodate ryokan" → ("函館 旅館", "hokkaido")
+
+    :param keyword: Reservation_Informationのkeyword
+    :return: 直したkeyword, keywordの地名から推測した都道府県コード(1つに決まらない場合は"")
+    """
+    words: list[str] = []
+    for token in _normalize(keyword).split():
+        for word in _normalize_token(token):
+            if word not in words:
+                words.append(word)
+    normalized = " ".join(words)
+
+    # 区切れなかった語に複数の地名が含まれることもあるので、全ての地名を調べる
+    pref_codes = {code for _, code in find_areas(normalized, limit=None)}
+    return normalized, pref_codes.pop() if len(pref_codes) == 1 else ""
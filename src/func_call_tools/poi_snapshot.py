@@ -0,0 +1,254 @@
+import hashlib
+import json
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from dataclasses import dataclass
+from logging import getLogger
+from typing import Any, Iterable, Iterator
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from metrics import POI_SNAPSHOT_LOOKUPS_TOTAL
+
+# ---------- 初期化処理 ---------- #
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
+logger = getLogger(__name__)
+
+# snapshotのfileのpath。空文字にすると利用しない
+POI_SNAPSHOT_PATH = os.environ.get(
+    "TRIPAL_POI_SNAPSHOT",
+    os.path.join(
+        os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "cache", "poi_snapshot.bin"
+    ),
+)
+# snapshotの情報を使う期間(秒)。これより古い情報はAPIから取得し直す。default: 30日
+POI_SNAPSHOT_MAX_AGE = float(os.environ.get("TRIPAL_POI_SNAPSHOT_MAX_AGE", str(30 * 24 * 3600)))
+# fileが更新されたかを確認する間隔(秒)
+POI_SNAPSHOT_RECHECK = float(os.environ.get("TRIPAL_POI_SNAPSHOT_RECHECK", "60"))
+
+# fileの形式
+# header: magic, version, 予約, 作成日時(UNIX time), 件数, 予約
+# index:  件数分の(keyのhash, dataのoffset, dataの長さ)。hashの昇順に並べる
+# data:   zlibで圧縮したJSON
+_MAGIC = b"TPOI"
+_VERSION = 1
+_HEADER = struct.Struct("<4sHHdII")
+_INDEX_ENTRY = struct.Struct("<QQI")
+# ------------------------------- #
+
+
+@dataclass(frozen=True)
+class SnapshotEntry:
+    """
+    snapshotに保存した、1つの検索条件の結果
+    """
+
+    loc_search: str
+    category: str
+    fetched_at: float
+    # (ロケーションの名前, 情報)のlist
+    locations: list[tuple[str, dict[str, Any]]]
+
+    @property
+    def age(self) -> float:
+        return time.time() - self.fetched_at
+
+
+def _hash_key(key: str) -> int:
+    return int.from_bytes(hashlib.blake2b(key.encode(), digest_size=8).digest(), "little")
+
+
+def write_snapshot(path: str, entries: Iterable[tuple[str, SnapshotEntry]]) -> int:
+    """
+    snapshotのfileを作成する。作成中のfileを読まれないように、一時fileに書いてから置き換える
+
+    :param path: 作成するfileのpath
+    :param entries: (cacheのkey(normalize_key), SnapshotEntry)
+    :return: 保存した件数
+    """
+    blobs: dict[int, tuple[str, bytes]] = {}
+    for key, entry in entries:
+        data = {
+            "key": key,
+            "loc_search": entry.loc_search,
+            "category": entry.category,
+            "fetched_at": entry.fetched_at,
+            "locations": entry.locations,
+        }
+        blob = zlib.compress(json.dumps(data, ensure_ascii=False).encode(), 9)
+        blobs[_hash_key(key)] = (key, blob)
+
+    hashes = sorted(blobs)
+    offset = _HEADER.size + _INDEX_ENTRY.size * len(hashes)
+    index = bytearray()
+    for key_hash in hashes:
+        blob = blobs[key_hash][1]
+        index += _INDEX_ENTRY.pack(key_hash, offset, len(blob))
+        offset += len(blob)
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = f"{path}.tmp.{os.getpid()}"
+    with open(tmp_path, "wb") as f:
+        f.write(_HEADER.pack(_MAGIC, _VERSION, 0, time.time(), len(hashes), 0))
+        f.write(index)
+        for key_hash in hashes:
+            f.write(blobs[key_hash][1])
+    os.replace(tmp_path, path)
+    return len(hashes)
+
+
+class POISnapshot:
+    """
+    よく聞かれる場所の検索結果を、読み取り専用のfileからmmapで読み込むstore
+
+    fileはrefresh_poi_snapshot.pyで事前に作成します。
+    全てのworkerが同じfileをmmapするので、OSのpage cacheを共有でき、workerごとのメモリは増えません。
+    refresh jobがfileを置き換えた場合は、POI_SNAPSHOT_RECHECK秒以内に新しいfileを読み込みます。
+    """
+
+    def __init__(
+        self,
+        path: str,
+        max_age: float = POI_SNAPSHOT_MAX_AGE,
+        recheck: float = POI_SNAPSHOT_RECHECK,
+    ) -> None:
+        self.path = path
+        self.max_age = max_age
+        self.recheck = recheck
+        self._lock = threading.Lock()
+        # 開いているfileのmmapと件数(入れ替えても読み込み中の呼び出しに影響しないように、まとめて持つ)
+        self._mapped: tuple[mmap.mmap, int] | None = None
+        self._built_at = 0.0
+        self._file_id: tuple[int, int] | None = None
+        self._checked_at = float("-inf")
+
+    def _open(self) -> tuple[mmap.mmap, int] | None:
+        """
+        fileが置き換えられていれば開き直し、現在のmmapと件数を返す
+        """
+        now = time.monotonic()
+        if now - self._checked_at < self.recheck:
+            return self._mapped
+
+        with self._lock:
+            if now - self._checked_at < self.recheck:
+                return self._mapped
+            self._checked_at = now
+            try:
+                stat = os.stat(self.path)
+            except OSError:
+                self._mapped, self._file_id = None, None
+                return None
+            file_id = (stat.st_ino, stat.st_mtime_ns)
+            if file_id == self._file_id:
+                return self._mapped
+            self._file_id = file_id
+
+            try:
+                with open(self.path, "rb") as f:
+                    mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+                magic, version, _, built_at, count, _ = _HEADER.unpack_from(mapped, 0)
+            except (OSError, ValueError, struct.error) as e:
+                logger.warning(f"[POI Snapshot] {self.path} could not be opened: {e}")
+                self._mapped = None
+                return None
+            if magic != _MAGIC or version != _VERSION:
+                logger.warning(
+                    f"[POI Snapshot] {self.path} is not a POI snapshot (version {_VERSION})"
+                )
+                mapped.close()
+                self._mapped = None
+                return None
+
+            # 古いmmapは、読み込み中の呼び出しが終われば解放される
+            self._mapped, self._built_at = (mapped, count), built_at
+            return self._mapped
+
+    @staticmethod
+    def _find(mapped: mmap.mmap, count: int, key_hash: int) -> tuple[int, int] | None:
+        # indexはhashの昇順なので二分探索する
+        low, high = 0, count
+        while low < high:
+            middle = (low + high) // 2
+            found_hash, offset, length = _INDEX_ENTRY.unpack_from(
+                mapped, _HEADER.size + middle * _INDEX_ENTRY.size
+            )
+            if found_hash == key_hash:
+                return offset, length
+            if found_hash < key_hash:
+                low = middle + 1
+            else:
+                high = middle
+        return None
+
+    @staticmethod
+    def _decode(blob: bytes) -> tuple[str, SnapshotEntry]:
+        data = json.loads(zlib.decompress(blob))
+        return data["key"], SnapshotEntry(
+            loc_search=data["loc_search"],
+            category=data["category"],
+            fetched_at=data["fetched_at"],
+            locations=[(name, info) for name, info in data["locations"]],
+        )
+
+    def get(self, key: str) -> SnapshotEntry | None:
+        """
+        検索条件の結果を取得する。存在しないか、max_ageより古い場合はNone
+
+        :param key: cacheのkey(normalize_key(loc_search, category, language))
+        """
+        if not self.path:
+            return None
+        opened = self._open()
+        if opened is None:
+            POI_SNAPSHOT_LOOKUPS_TOTAL.inc(result="miss")
+            return None
+        mapped, count = opened
+        location = self._find(mapped, count, _hash_key(key))
+        if location is None:
+            POI_SNAPSHOT_LOOKUPS_TOTAL.inc(result="miss")
+            return None
+
+        offset, length = location
+        found_key, entry = self._decode(mapped[offset : offset + length])
+        # hashの衝突
+        if found_key != key:
+            POI_SNAPSHOT_LOOKUPS_TOTAL.inc(result="miss")
+            return None
+
+        if entry.age > self.max_age:
+            POI_SNAPSHOT_LOOKUPS_TOTAL.inc(result="stale")
+            return None
+        POI_SNAPSHOT_LOOKUPS_TOTAL.inc(result="hit")
+        return entry
+
+    def entries(self) -> Iterator[tuple[str, SnapshotEntry]]:
+        """
+        保存されている全ての結果を返す(refresh jobで、取得に失敗した分を引き継ぐために使う)
+        """
+        opened = self._open() if self.path else None
+        if opened is None:
+            return
+        mapped, count = opened
+        for i in range(count):
+            _, offset, length = _INDEX_ENTRY.unpack_from(
+                mapped, _HEADER.size + i * _INDEX_ENTRY.size
+            )
+            yield self._decode(mapped[offset : offset + length])
+
+    def stats(self) -> dict[str, Any]:
+        opened = self._open() if self.path else None
+        return {
+            "path": self.path,
+            "loaded": opened is not None,
+            "entries": opened[1] if opened is not None else 0,
+            "built_at": self._built_at,
+            "max_age": self.max_age,
+        }
+
+
+# プロセス全体で共有するsnapshot(初回の検索時にfileを開く)
+poi_snapshot = POISnapshot(POI_SNAPSHOT_PATH)
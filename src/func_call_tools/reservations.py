@@ -1,42 +1,37 @@
 import json
-import logging
 import os
-from logging import FileHandler, Formatter, StreamHandler, getLogger
+import random
+from logging import getLogger
 from typing import Any, Literal
 
-import numpy as np
-import requests
-from dotenv import find_dotenv, load_dotenv
+import httpx
 
 # LangChainが利用しているpydanticのバージョンが古いため、v1を利用する
-from pydantic.v1 import BaseModel, Field
+from pydantic.v1 import BaseModel, Field, validator
 
+import env_setup  # noqa: F401  環境変数の読み込み
+from caching import MISSING, SingleFlight, TieredCache, normalize_key
+from func_call_tools.area_index import normalize_keyword, normalize_pref_code
+from http_client import get_async_client
 from log_setup import common_logger
+from metrics import TOOL_ARGS_NORMALIZED_TOTAL
 
 # ---------- 初期化処理 ---------- #
-# 現在のdirectoryを取得し、directoryをsrcに変更
-cwd = os.getcwd()
-cwd = cwd if cwd.endswith("src") else os.path.join(cwd, "src")
-# 環境変数をロード
-load_dotenv(find_dotenv())
 # Logの出力
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
 logger = getLogger(__name__)
-logger.setLevel(logging.ERROR)
-# handlerの設定
-# StreamHandler
-stream_handler = StreamHandler()
-stream_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-stream_handler.setLevel(logging.ERROR)
-logger.addHandler(stream_handler)
-# FileHandler
-file_handler = FileHandler(filename=f"{cwd}/logs/reservations.log")
-file_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s\n" + "%(message)s"))
-file_handler.setLevel(logging.ERROR)
-logger.addHandler(file_handler)
 
 HEADERS = {"accept": "application/json"}
 RAKUTEN_APPLICATION_ID = os.environ.get("RAKUTEN_APPLICATION_ID")
 RAKUTEN_AFFILIATE_ID = os.environ.get("RAKUTEN_AFFILIATE_ID")
+# APIのURL。負荷試験などでは、ローカルの代替serverに向ける
+RAKUTEN_API_BASE = os.environ.get("RAKUTEN_API_BASE", "https://app.rakuten.co.jp/services/api")
+# 検索結果のcacheの有効期限(秒)。料金が変わることがあるので1時間
+SEARCH_CACHE_TTL = float(os.environ.get("RAKUTEN_SEARCH_CACHE_TTL", "3600"))
+# 検索結果全体をcacheし、ランダムな選択はcacheから取り出した後に行う
+search_cache = TieredCache("rakuten_keyword_search", ttl=SEARCH_CACHE_TTL)
+# 同じ検索条件の同時のリクエストを1回にまとめる
+search_flight = SingleFlight("rakuten_keyword_search")
 # 都道府県コード
 PREFECTURE_CODE = Literal[
     "",
@@ -115,21 +110,98 @@ class TravelReservationSchema(BaseModel):
         examples=["tokyo", "shiga", "hokkaido"],
     )
 
+    # "fukuoka"や"東京"のような表記ゆれは、検証の前にRakutenのコードに直す
+    # 直せないものは""(都道府県の指定なし)にして、エラーにしない
+    @validator("pref_code", pre=True)
+    def _normalize_pref_code(cls, value: Any) -> str:
+        normalized = normalize_pref_code(str(value or ""))
+        if normalized != value:
+            TOOL_ARGS_NORMALIZED_TOTAL.inc(tool="Reservation_Information", field="pref_code")
+        return normalized
+
 
 # ------Tool(Function Calling)で利用する関数の定義------ #
+# AgentExecutorは非同期で実行するので、Toolには非同期版のみを用意する
+
+
+async def aget_reserve_location(keyword: str, pref_code: str = "") -> dict[str, Any]:
+    """
+    宿泊施設の情報を取得する。共有の非同期HTTP clientを利用する
+
+    :param keyword: search keyword. space separated. multiple can be specified
+    :param pref_code: prefecture code. romaji
+    """
+    keyword, pref_code = _normalize_args(keyword, pref_code)
 
+    res_dict: dict = await _afind_matching_props(keyword, pref_code)
 
-def get_reserve_location(keyword: str, pref_code: str = "") -> dict[str, Any]:
+    return _choose_hotels(res_dict)
+
+
+async def aprefetch_reserve_location(keyword: str, pref_code: str = "") -> bool:
     """
-    宿泊施設の情報を取得
+    aget_reserve_location()と同じ検索を行い、cacheに入れておく
+
+    Toolが呼び出される前に、ユーザーの入力から推測した検索を行うために使います。
 
     :param keyword: search keyword. space separated. multiple can be specified
     :param pref_code: prefecture code. romaji
+    :return: 検索に成功したかどうか
+    """
+    # Toolの呼び出しと同じcacheのkeyになるように、同じく正規化する
+    res_dict: dict = await _afind_matching_props(*_normalized_args(keyword, pref_code))
+    return not res_dict.get("Error")
+
+
+def _normalized_args(keyword: str, pref_code: str) -> tuple[str, str]:
     """
-    common_logger.info(f"keyword: {keyword}, pref_code: {pref_code}")
+    LLMが渡した引数を、Rakutenで検索できる形に直す
+
+    - keyword: "東京にあるホテル" → "東京 ホテル"のように、文章を検索語に分ける
+    - pref_code: "fukuoka" → "hukuoka"のように、表記ゆれをRakutenのコードに直す。
+      指定がなければ、keywordの地名から推測する
+
+    :param keyword: search keyword. space separated. multiple can be specified
+    :param pref_code: prefecture code. romaji
+    """
+    normalized_keyword, inferred_pref_code = normalize_keyword(keyword)
+    return normalized_keyword, normalize_pref_code(pref_code) or inferred_pref_code
+
+
+def _normalize_args(keyword: str, pref_code: str) -> tuple[str, str]:
+    """
+    _normalized_args()で引数を直し、直した数の記録とLogの出力を行う
+
+    エラーになる引数で呼ばれて、agentが引数を変えて呼び直す(LLMの往復が増える)のを防ぎます。
+
+    :param keyword: search keyword. space separated. multiple can be specified
+    :param pref_code: prefecture code. romaji
+    """
+    normalized_keyword, normalized_pref_code = _normalized_args(keyword, pref_code)
+
+    if normalized_keyword != keyword:
+        TOOL_ARGS_NORMALIZED_TOTAL.inc(tool="Reservation_Information", field="keyword")
+    if normalized_pref_code != pref_code:
+        TOOL_ARGS_NORMALIZED_TOTAL.inc(tool="Reservation_Information", field="pref_code")
+
+    common_logger.info(
+        "reserve_location",
+        extra={
+            "keyword": normalized_keyword,
+            "pref_code": normalized_pref_code,
+            "raw_keyword": keyword,
+            "raw_pref_code": pref_code,
+        },
+    )
+    return normalized_keyword, normalized_pref_code
+
 
-    res_dict: dict = _find_matching_props(keyword, pref_code)
+def _choose_hotels(res_dict: dict[str, Any]) -> dict[str, Any]:
+    """
+    検索結果の中から、ランダムに最大10件の宿泊施設を選ぶ
 
+    :param res_dict: result of _afind_matching_props()
+    """
     if res_dict.get("Error"):
         return res_dict
 
@@ -138,7 +210,7 @@ def get_reserve_location(keyword: str, pref_code: str = "") -> dict[str, Any]:
     # 情報の数を10個以下に制限
     count = length if length < 10 else 10
 
-    rnd_choices = np.random.choice(length, count, replace=False)
+    rnd_choices = random.sample(range(length), count)
 
     hotel_info = {}
     for rnd_index in rnd_choices:
@@ -155,11 +227,9 @@ def get_reserve_location(keyword: str, pref_code: str = "") -> dict[str, Any]:
     return hotel_info
 
 
-def _find_matching_props(
-    keyword: str, pref_code: PREFECTURE_CODE = ""
-) -> dict[str, Any] | dict[str, str]:
+def _keyword_search_url(keyword: str, pref_code: PREFECTURE_CODE = "") -> str:
     """
-    ロケーション検索の結果を取得する
+    Keyword Hotel SearchのURLを作成する
 
     :param keyword: search keyword. space separated. multiple can be specified
     :param pref_code: prefecture code. romaji
@@ -171,10 +241,80 @@ def _find_matching_props(
     required_param = f"?applicationId={RAKUTEN_APPLICATION_ID}&affiliateId={RAKUTEN_AFFILIATE_ID}&format=json&formatVersion=2"
     optional_param = f"&responseType=small&elements={elements}&keyword={keyword}&middleClassCode={pref_code}"
 
-    url = "https://app.rakuten.co.jp/services/api/Travel/KeywordHotelSearch/20170426"
+    url = f"{RAKUTEN_API_BASE}/Travel/KeywordHotelSearch/20170426"
+
+    return url + required_param + optional_param
+
+
+async def _afind_matching_props(
+    keyword: str, pref_code: PREFECTURE_CODE = ""
+) -> dict[str, Any] | dict[str, str]:
+    """
+    ロケーション検索の結果を取得する
 
-    res = requests.get(url + required_param + optional_param, headers=HEADERS)
+    結果はcacheし、同じ条件の同時のリクエストは1回にまとめます。
+    戻り値は他の呼び出しと共有されることがあるので、書き換えないでください。
+
+    :param keyword: search keyword. space separated. multiple can be specified
+    :param pref_code: prefecture code. romaji
+    """
+    cache_key = normalize_key(keyword, pref_code)
+    cached = await search_cache.aget(cache_key)
+    if cached is not MISSING:
+        return cached
 
+    async def _fetch() -> dict[str, Any] | dict[str, str]:
+        try:
+            res = await get_async_client().get(
+                _keyword_search_url(keyword, pref_code), headers=HEADERS
+            )
+        except httpx.HTTPError as e:
+            return _transport_error(keyword, pref_code, e)
+
+        dict_data = _parse_keyword_search(res, keyword, pref_code)
+        # 検索に成功した場合のみcacheする
+        if not dict_data.get("Error"):
+            await search_cache.aset(cache_key, dict_data)
+
+        return dict_data
+
+    # 同じ条件で実行中のリクエストがあれば、その結果を共有する
+    return await search_flight.do(cache_key, _fetch)
+
+
+def _transport_error(
+    keyword: str, pref_code: str, error: httpx.HTTPError
+) -> dict[str, str]:
+    """
+    通信エラー(timeoutやcircuit breakerなど)をログに出力し、Toolの結果として返すerrorを作成する
+
+    :param keyword: search keyword (for logging)
+    :param pref_code: prefecture code (for logging)
+    :param error: 発生した通信エラー
+    """
+    logger.error(
+        f"[Rakuten Transport Error(Keyword Hotel Search)]\n"
+        f"keyword: {keyword}, pref_code: {pref_code}\n"
+        f"error: {error.__class__.__name__}: {error}"
+    )
+    return {
+        "Error": "Service Unavailable",
+        "Message to AI": "The hotel search service is temporarily unavailable. Do not retry this tool now; answer with the information you already have.",
+    }
+
+
+def _parse_keyword_search(
+    res: httpx.Response,
+    keyword: str,
+    pref_code: PREFECTURE_CODE = "",
+) -> dict[str, Any] | dict[str, str]:
+    """
+    Keyword Hotel Searchのレスポンスを辞書に変換する。errorの場合はErrorを含む辞書を返す
+
+    :param res: response of the Keyword Hotel Search
+    :param keyword: search keyword (for logging)
+    :param pref_code: prefecture code (for logging)
+    """
     if 500 <= res.status_code <= 599:
         logger.exception(
             f"[Rakuten Server Error(Keyword Hotel Search)] \n"
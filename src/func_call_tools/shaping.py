@@ -0,0 +1,180 @@
+import asyncio
+import functools
+import json
+import os
+from dataclasses import dataclass
+from typing import Any, Callable, TypeVar
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from chat_memory import count_text_tokens
+from log_setup import common_logger
+from metrics import TOOL_OUTPUT_TOKENS, TOOL_OUTPUT_TOKENS_SAVED
+
+# ---------- 初期化処理 ---------- #
+# Toolの出力(JSON)として、LLMに渡すtoken数の上限
+TOOL_OUTPUT_TOKEN_BUDGET = int(os.environ.get("TRIPAL_TOOL_OUTPUT_TOKEN_BUDGET", "1500"))
+# 1つの文字列の文字数の上限。超えた分は切り詰める(URLは切り詰めない)
+TOOL_TEXT_MAX_CHARS = int(os.environ.get("TRIPAL_TOOL_TEXT_MAX_CHARS", "120"))
+# 値が取得できなかったことを示す文字列。LLMには渡さない
+PLACEHOLDER_VALUES = frozenset(
+    {
+        "名前なし",
+        "詳細なし",
+        "TripadvisorのURL無し",
+        "国なし",
+        "住所なし",
+        "メールアドレスなし",
+        "電話番号なし",
+        "公式Webサイトなし",
+        "営業時間情報なし",
+    }
+)
+# 切り詰めないkey。LLMへの指示(エラー時の対応など)は、途中で切れると意味が変わる
+UNTRUNCATED_KEYS = frozenset({"Error", "Message to AI"})
+_ELLIPSIS = "…"
+
+F = TypeVar("F", bound=Callable[..., Any])
+# ------------------------------- #
+
+
+@dataclass
+class ShapeReport:
+    """
+    Toolの出力を整形した結果の統計
+    """
+
+    tokens_before: int = 0
+    tokens_after: int = 0
+    dropped_fields: int = 0
+    truncated_fields: int = 0
+    dropped_items: int = 0
+
+    @property
+    def tokens_saved(self) -> int:
+        return self.tokens_before - self.tokens_after
+
+
+def _serialize(output: Any) -> str:
+    # format_to_openai_tool_messages()と同じ形式でtoken数を数える
+    if isinstance(output, str):
+        return output
+    return json.dumps(output, ensure_ascii=False)
+
+
+def _is_empty(value: Any) -> bool:
+    if value is None or value == "" or value == [] or value == {}:
+        return True
+    return isinstance(value, str) and value.strip() in PLACEHOLDER_VALUES
+
+
+def _compact(value: Any, text_max_chars: int, report: ShapeReport) -> Any:
+    """
+    空の値やplaceholderを取り除き、長い文字列を切り詰める
+    """
+    if isinstance(value, dict):
+        compacted = {}
+        for key, item in value.items():
+            if key not in UNTRUNCATED_KEYS:
+                item = _compact(item, text_max_chars, report)
+            if _is_empty(item):
+                report.dropped_fields += 1
+                continue
+            compacted[key] = item
+        return compacted
+    if isinstance(value, list):
+        return [
+            item
+            for item in (_compact(item, text_max_chars, report) for item in value)
+            if not _is_empty(item)
+        ]
+    if (
+        isinstance(value, str)
+        and len(value) > text_max_chars
+        and not value.startswith(("http://", "https://"))
+    ):
+        report.truncated_fields += 1
+        return value[:text_max_chars].rstrip() + _ELLIPSIS
+    return value
+
+
+def shape_tool_output(
+    output: Any,
+    token_budget: int = TOOL_OUTPUT_TOKEN_BUDGET,
+    text_max_chars: int = TOOL_TEXT_MAX_CHARS,
+) -> tuple[Any, ShapeReport]:
+    """
+    Toolの出力を、LLMに渡す前に小さくする
+
+    1. 空の値やplaceholder("住所なし"など)を取り除く
+    2. 長い文字列(descriptionなど)を切り詰める。UNTRUNCATED_KEYSの値("Message to AI"など)はそのまま残す
+    3. まだtoken_budgetを超える場合は、後ろの項目(ロケーションや宿泊施設)から減らす
+
+    文字列の出力(エラーメッセージなど)はそのまま返します。
+
+    :param output: Toolの出力
+    :param token_budget: 整形後のtoken数の上限
+    :param text_max_chars: 1つの文字列の文字数の上限
+    """
+    report = ShapeReport(tokens_before=count_text_tokens(_serialize(output)))
+    if not isinstance(output, dict):
+        report.tokens_after = report.tokens_before
+        return output, report
+
+    shaped = _compact(output, text_max_chars, report)
+    tokens = count_text_tokens(_serialize(shaped))
+    # 最低1件は残す
+    while tokens > token_budget and len(shaped) > 1:
+        shaped.pop(next(reversed(shaped)))
+        report.dropped_items += 1
+        tokens = count_text_tokens(_serialize(shaped))
+
+    report.tokens_after = tokens
+    return shaped, report
+
+
+def _record(tool_name: str, report: ShapeReport) -> None:
+    TOOL_OUTPUT_TOKENS.observe(report.tokens_after, tool=tool_name)
+    TOOL_OUTPUT_TOKENS_SAVED.observe(report.tokens_saved, tool=tool_name)
+    common_logger.info(
+        "tool_output_shaped",
+        extra={
+            "tool": tool_name,
+            "tokens_before": report.tokens_before,
+            "tokens_after": report.tokens_after,
+            "tokens_saved": report.tokens_saved,
+            "dropped_fields": report.dropped_fields,
+            "truncated_fields": report.truncated_fields,
+            "dropped_items": report.dropped_items,
+        },
+    )
+
+
+def shape_output(tool_name: str) -> Callable[[F], F]:
+    """
+    Toolの関数の出力をshape_tool_output()で整形し、減らしたtoken数を記録するdecorator
+
+    同期版・非同期版のどちらの関数にも使えます。
+
+    :param tool_name: Toolの名前(Log・metricのlabel)
+    """
+
+    def decorator(func: F) -> F:
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                shaped, report = shape_tool_output(await func(*args, **kwargs))
+                _record(tool_name, report)
+                return shaped
+
+            return async_wrapper  # type: ignore[return-value]
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            shaped, report = shape_tool_output(func(*args, **kwargs))
+            _record(tool_name, report)
+            return shaped
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
@@ -1,43 +1,48 @@
+import asyncio
 import json
-import logging
 import os
 import random
-from logging import FileHandler, Formatter, StreamHandler, getLogger
+from datetime import datetime
+from logging import getLogger
 from typing import Literal, Tuple
 
-import requests
-from dotenv import find_dotenv, load_dotenv
+import httpx
 
 # LangChainが利用しているpydanticのバージョンが古いため、v1を利用する
-from langchain_core.pydantic_v1 import BaseModel, Field
+from pydantic.v1 import BaseModel, Field
 
+import env_setup  # noqa: F401  環境変数の読み込み
+from caching import MISSING, SingleFlight, TieredCache, normalize_key
+from func_call_tools.poi_snapshot import poi_snapshot
+from http_client import get_async_client
 from log_setup import common_logger
 
 # ---------- 初期化処理 ---------- #
-# 現在のdirectoryを取得し、directoryをsrcに変更
-cwd = os.getcwd()
-cwd = cwd if cwd.endswith("src") else os.path.join(cwd, "src")
-# 環境変数をロード
-load_dotenv(find_dotenv())
 # Logの出力
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
 logger = getLogger(__name__)
-logger.setLevel(logging.ERROR)
-# handlerの設定
-# StreamHandler
-stream_handler = StreamHandler()
-stream_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-stream_handler.setLevel(logging.ERROR)
-logger.addHandler(stream_handler)
-# FileHandler
-file_handler = FileHandler(filename=f"{cwd}/logs/suggestions.log")
-file_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s\n" + "%(message)s"))
-file_handler.setLevel(logging.ERROR)
-logger.addHandler(file_handler)
 
 TRIPADVISOR_API_KEY = os.environ.get("TRIPADVISOR_API_KEY")
+# APIのURL。負荷試験などでは、ローカルの代替serverに向ける
+TRIPADVISOR_API_BASE = os.environ.get(
+    "TRIPADVISOR_API_BASE", "https://api.content.tripadvisor.com/api/v1"
+)
 HEADERS = {
     "accept": "application/json",
 }
+# ロケーション詳細を同時に取得する数の上限
+DETAILS_CONCURRENCY = int(os.environ.get("TRIPADVISOR_DETAILS_CONCURRENCY", "5"))
+# ロケーション詳細の取得を待つ時間の上限(秒)。超えた分はmin_loc_infoで代用する
+DETAILS_DEADLINE = float(os.environ.get("TRIPADVISOR_DETAILS_DEADLINE", "5.0"))
+# cacheの有効期限(秒)。検索結果は6時間、詳細情報は24時間
+SEARCH_CACHE_TTL = float(os.environ.get("TRIPADVISOR_SEARCH_CACHE_TTL", "21600"))
+DETAILS_CACHE_TTL = float(os.environ.get("TRIPADVISOR_DETAILS_CACHE_TTL", "86400"))
+# 同じ場所への問い合わせが多いので、APIのレスポンスをcacheする
+search_cache = TieredCache("tripadvisor_search", ttl=SEARCH_CACHE_TTL)
+details_cache = TieredCache("tripadvisor_details", ttl=DETAILS_CACHE_TTL)
+# 同じ条件の同時のリクエスト(先読みとToolの呼び出しなど)を1回にまとめる
+search_flight = SingleFlight("tripadvisor_search")
+details_flight = SingleFlight("tripadvisor_details")
 # ------------------------------- #
 
 
@@ -75,58 +80,227 @@ class TravelProposalSchema(BaseModel):
 
 
 # 観光スポットの提案
-def get_trip_suggestions_info(
+# AgentExecutorは非同期で実行するので、Toolには非同期版のみを用意する
+async def aget_trip_suggestions_info(
     loc_search: str = "",
     category: Literal["", "hotels", "attractions", "restaurants", "geos"] = "",
 ) -> str | dict[str, dict[str, str]]:
     """
-    検索情報(とカテゴリ)を与えて、おすすめの観光スポットを返す
+    検索情報(とカテゴリ)を与えて、おすすめの観光スポットを返す。共有の非同期HTTP clientを利用する
 
     :param loc_search: Text to use for searching based on the name of the location.
     :param category: Filters result set based on property type. Valid options are "", "hotels", "attractions", "restaurants", and "geos".
     """
-    common_logger.info(f"loc_search: {loc_search}, category: {category}")
+    common_logger.info(
+        "trip_suggestions", extra={"loc_search": loc_search, "category": category}
+    )
 
     language = "ja"
     currency = "JPY"
 
-    # loc_search が入力されていない場合は、"検索したい場所を入力してください"を返す
+    # loc_search が入力されていない場合は、"検索したい場所を入力してください"を返す
     # ただ、function callingの特性上ほぼありえない
     if loc_search == "":
         return "検索したい場所を入力してください"
 
-    loc_ids, other_info = _get_location_id(loc_search, category, language)
+    # よく聞かれる場所は、事前に作成したsnapshotから返す
+    snapshot_info = _snapshot_locations_info(loc_search, category, language)
+    if snapshot_info is not None:
+        return snapshot_info
+
+    loc_ids, other_info = await _aget_location_id(loc_search, category, language)
 
-    common_logger.info(f"loc_ids: {loc_ids}, other_info: {other_info}")
+    # other_infoは大きいので、Logには件数のみを残す
+    common_logger.info(
+        "trip_suggestions_locations",
+        extra={"loc_ids": loc_ids, "loc_count": len(loc_ids)},
+    )
 
     if loc_ids == []:
         return (
             f"情報が取得出来ませんでした。もう一度やり直してください。\n\n{other_info}"
         )
 
+    random.shuffle(loc_ids)  # ロケーションIDをランダムに
+
     # 場所の情報を取得
-    output = {}
+    return await _aget_locations_info(loc_ids, other_info, language, currency)
+
+
+# 観光スポットの情報を先読みする
+async def aprefetch_trip_suggestions(loc_search: str, category: str = "") -> int:
+    """
+    aget_trip_suggestions_info()と同じ検索(Location Search)だけを行い、cacheに入れておく
+
+    Toolが呼び出される前に、ユーザーの入力から推測した検索を行うために使います。
+    推測が外れた場合の無駄を抑えるため、APIの呼び出しは検索の1回だけにし、
+    詳細(Location Details)の取得は行いません。
+
+    :param loc_search: Text to use for searching based on the name of the location.
+    :param category: Filters result set based on property type.
+    :return: 見つかったロケーションの数
+    """
+    # snapshotにある場合は、APIを呼び出さない
+    entry = poi_snapshot.get(normalize_key(loc_search, category, "ja"))
+    if entry is not None:
+        return len(entry.locations)
+    loc_ids, _ = await _aget_location_id(loc_search, category, "ja")
+    return len(loc_ids)
+
+
+# 観光スポットの情報をAPI(とcache)から取得する
+async def afetch_locations_info(
+    loc_search: str, category: str = "", language: str = "ja", currency: str = "JPY"
+) -> dict[str, dict[str, str]]:
+    """
+    検索と詳細の取得を行い、ロケーションの名前ごとの情報を返す。見つからない場合は{}
+
+    snapshotは使わずに、APIかcacheから取得します(refresh_poi_snapshot.pyでも使います)。
+
+    :param loc_search: Text to use for searching based on the name of the location.
+    :param category: Filters result set based on property type.
+    :param language: language of the response
+    :param currency: currency of the response
+    """
+    loc_ids, other_info = await _aget_location_id(loc_search, category, language)
+    if not loc_ids:
+        return {}
+    return await _aget_locations_info(loc_ids, other_info, language, currency)
 
-    # APIコールのお金節約のため、ロケーションIDをランダムにinfo_count個選ぶ
-    # We are始まるから制限一時撤廃！
-    # info_count = 5
-    # ls = range(0, 10)
-    # rand_ls = list(random.sample(ls, info_count))
-    # for rand_index in rand_ls:
-    random.shuffle(loc_ids)  # ロケーションIDをランダムに
+
+# snapshotから観光スポットの情報を取得する
+def _snapshot_locations_info(
+    loc_search: str, category: str, language: str
+) -> dict[str, dict[str, str]] | None:
+    """
+    snapshotにある場合は、ロケーションの情報(取得日時つき)を返す。ない場合はNone
+
+    :param loc_search: search query
+    :param category: search category
+    :param language: language of the response
+    """
+    entry = poi_snapshot.get(normalize_key(loc_search, category, language))
+    if entry is None:
+        return None
+
+    locations = list(entry.locations)
+    random.shuffle(locations)  # ロケーションをランダムに
+
+    fetched_at = datetime.fromtimestamp(entry.fetched_at).astimezone()
+    common_logger.info(
+        "trip_suggestions_snapshot",
+        extra={
+            "loc_count": len(locations),
+            "fetched_at": fetched_at.isoformat(timespec="seconds"),
+            "age_days": round(entry.age / 86400, 1),
+        },
+    )
+    # 古い情報の可能性があることを、AIに伝える
+    return {
+        "data_freshness": {
+            "source": "offline snapshot",
+            "fetched_at": fetched_at.date().isoformat(),
+            "Message to AI": "Opening hours and details may have changed since fetched_at.",
+        },
+        **dict(locations),
+    }
+
+
+# 複数のロケーションの情報をまとめて取得する
+async def _aget_locations_info(
+    loc_ids: list[str],
+    other_info: dict[str, dict[str, str]],
+    language: str,
+    currency: str,
+) -> dict[str, dict[str, str]]:
+    """
+    複数のロケーションの情報を、同時実行数をDETAILS_CONCURRENCYに制限して同時に取得する
+
+    DETAILS_DEADLINE秒以内に取得できなかったロケーションは、min_loc_infoで代用します。
+
+    :param loc_ids: list of location ids
+    :param other_info: dict of location information by get_location_id()
+    :param language: language of the response
+    :param currency: currency of the response
+    """
+    semaphore = asyncio.Semaphore(DETAILS_CONCURRENCY)
+
+    async def _fetch(loc_id: str) -> dict[str, str]:
+        async with semaphore:
+            return await _aget_location_info(
+                loc_id, other_info[loc_id], language, currency
+            )
+
+    tasks = {loc_id: asyncio.create_task(_fetch(loc_id)) for loc_id in loc_ids}
+    try:
+        done, _ = await asyncio.wait(tasks.values(), timeout=DETAILS_DEADLINE)
+    finally:
+        # 間に合わなかったものはcancelする
+        for task in tasks.values():
+            if not task.done():
+                task.cancel()
+
+    results = {
+        loc_id: task.result()
+        for loc_id, task in tasks.items()
+        if task in done and task.exception() is None
+    }
+    return _merge_locations_info(loc_ids, other_info, results)
+
+
+# 取得できたロケーションの情報と、min_loc_infoをまとめる
+def _merge_locations_info(
+    loc_ids: list[str],
+    other_info: dict[str, dict[str, str]],
+    results: dict[str, dict[str, str]],
+) -> dict[str, dict[str, str]]:
+    """
+    取得できたロケーションの情報をまとめる。取得できなかったものはmin_loc_infoで代用する
+
+    :param loc_ids: list of location ids
+    :param other_info: dict of location information by get_location_id()
+    :param results: dict of location information by get_location_info()
+    """
+    stragglers = [loc_id for loc_id in loc_ids if loc_id not in results]
+    if stragglers:
+        logger.warning(
+            f"[Tripadvisor Details Timeout] \n"
+            f"{len(stragglers)}/{len(loc_ids)} location details were not fetched "
+            f"within {DETAILS_DEADLINE}s: {stragglers}"
+        )
+
+    output = {}
     for loc_id in loc_ids:
-        # loc_id = loc_ids[rand_index]
         min_loc_info = other_info[loc_id]
-        loc_info = _get_location_info(loc_id, min_loc_info, language, currency)
-
         # get_location_info()の中でerrorレスポンスが返ってくると"name"すら返ってこないので、min_loc_infoから取ってきてます。その方が確実
-        output[min_loc_info["name"]] = loc_info
+        output[min_loc_info["name"]] = results.get(loc_id, min_loc_info)
 
     return output
 
 
+# ロケーション検索のURLを作成する
+def _location_search_url(loc_search: str, category: str, language: str) -> str:
+    """
+    ロケーション検索のURLを作成する
+
+    :param loc_search: search query
+    :param category: search category
+    :param language: language of the response
+    """
+    # パラメータの設定
+    id_param = (
+        f"?key={TRIPADVISOR_API_KEY}&language={language}&searchQuery={loc_search}"
+    )
+
+    if category != "":
+        id_param += "&category=" + category
+
+    url = f"{TRIPADVISOR_API_BASE}/location/search"
+    return url + id_param
+
+
 # ロケーションの検索をし、ロケーションIDを取得する
-def _get_location_id(
+async def _aget_location_id(
     loc_search: str, category: str, language: str
 ) -> Tuple[list[str], dict[str, dict[str, str]]]:
     """
@@ -139,23 +313,70 @@ def _get_location_id(
     :return loc_ids: list of location ids
     :return loc_info: dict of location information
     """
-    # パラメータの設定
-    id_param = (
-        f"?key={TRIPADVISOR_API_KEY}&language={language}&searchQuery={loc_search}"
+    cache_key = normalize_key(loc_search, category, language)
+    cached = await search_cache.aget(cache_key)
+    if cached is not MISSING:
+        return cached["loc_ids"], cached["other_info"]
+
+    async def _fetch() -> Tuple[list[str], dict[str, dict[str, str]]]:
+        url = _location_search_url(loc_search, category, language)
+        try:
+            response = await get_async_client().get(url, headers=HEADERS)
+        except httpx.HTTPError as e:
+            return [], _transport_error("Location Search", url, e)
+
+        loc_ids, other_info = _parse_location_search(response, loc_search, url)
+        # 検索に成功した場合のみcacheする
+        if loc_ids != []:
+            await search_cache.aset(
+                cache_key, {"loc_ids": loc_ids, "other_info": other_info}
+            )
+
+        return loc_ids, other_info
+
+    # 同じ条件で実行中のリクエストがあれば、その結果を共有する
+    # (呼び出し側でloc_idsをshuffleするので、共有した結果はcopyして返す)
+    loc_ids, other_info = await search_flight.do(cache_key, _fetch)
+    return list(loc_ids), other_info
+
+
+# 通信エラー(timeoutやcircuit breakerなど)をログに出力する
+def _transport_error(label: str, url: str, error: httpx.HTTPError) -> dict[str, str]:
+    """
+    通信エラーをログに出力し、Toolの結果として返すerrorを作成する
+
+    :param label: どのAPIの呼び出しか(for logging)
+    :param url: request url (for logging)
+    :param error: 発生した通信エラー
+    """
+    logger.error(
+        f"[Tripadvisor Transport Error({label})] \n"
+        f"url: {url}\n"
+        f"error: {error.__class__.__name__}: {error}"
     )
+    return {
+        "error": "Service Unavailable",
+        "Message to AI": "Tripadvisor is temporarily unavailable. Do not retry this tool now; answer with the information you already have.",
+    }
 
-    if category != "":
-        id_param += "&category=" + category
 
-    url = "https://api.content.tripadvisor.com/api/v1/location/search"
-    response = requests.get(url + id_param, headers=HEADERS)
+# ロケーション検索のレスポンスから、ロケーションIDを取り出す
+def _parse_location_search(
+    response: httpx.Response, loc_search: str, url: str
+) -> Tuple[list[str], dict[str, dict[str, str]]]:
+    """
+    ロケーション検索のレスポンスから、ロケーションIDと最低限の情報を取り出す
 
+    :param response: response of the location search
+    :param loc_search: search query (for logging)
+    :param url: request url (for logging)
+    """
     # error handling
     if 500 <= response.status_code <= 599:
         logger.exception(
             f"[Tripadvisor Server Error(Location Search)] \n"
             f"search query: {loc_search}\n"
-            f"url: {url + id_param}\n"
+            f"url: {url}\n"
             f"status_code: {response.status_code}\n"
             f"error text: {response.text}"
         )
@@ -167,7 +388,7 @@ def _get_location_id(
         logger.exception(
             f"[Tripadvisor Error] \n"
             f"search query: {loc_search}\n"
-            f"url: {url + id_param}\n"
+            f"url: {url}\n"
             f"error text: {res_dict}"
         )
         return [], {"error": "Search Error"}
@@ -195,8 +416,23 @@ def _get_location_id(
     return loc_ids, other_info
 
 
+# ロケーション詳細のURLを作成する
+def _location_details_url(loc_id: str, language: str, currency: str) -> str:
+    """
+    ロケーション詳細のURLを作成する
+
+    :param loc_id: location id
+    :param language: language of the response
+    :param currency: currency of the response
+    """
+    # パラメータの設定
+    loc_param = f"/{loc_id}/details?key={TRIPADVISOR_API_KEY}&language={language}&currency={currency}"
+    url = f"{TRIPADVISOR_API_BASE}/location"
+    return url + loc_param
+
+
 # ロケーションIDに基づいた、ロケーションの情報を取得する
-def _get_location_info(
+async def _aget_location_info(
     loc_id: str, min_loc_info: dict, language: str, currency: str
 ) -> dict[str, str]:
     """
@@ -206,16 +442,61 @@ def _get_location_info(
     :param min_loc_info: other information of the location by get_location_id()
     :param language: language of the response
     """
-    # パラメータの設定
-    loc_param = f"/{loc_id}/details?key={TRIPADVISOR_API_KEY}&language={language}&currency={currency}"
-    url = "https://api.content.tripadvisor.com/api/v1/location"
-    response = requests.get(url + loc_param, headers=HEADERS)
+    cache_key = normalize_key(loc_id, language, currency)
+    cached = await details_cache.aget(cache_key)
+    if cached is not MISSING:
+        return cached
+
+    async def _fetch() -> dict[str, str]:
+        url = _location_details_url(loc_id, language, currency)
+        try:
+            response = await get_async_client().get(url, headers=HEADERS)
+        except httpx.HTTPError as e:
+            _transport_error(f"Location {loc_id} Details", url, e)
+            return min_loc_info
+
+        loc_info = _parse_location_details(response, loc_id, min_loc_info, url)
+        # 詳細情報が取得できた場合のみcacheする
+        if _is_details_success(loc_info, min_loc_info):
+            await details_cache.aset(cache_key, loc_info)
+
+        return loc_info
+
+    # 同じロケーションを取得中であれば、その結果を共有する
+    return await details_flight.do(cache_key, _fetch)
+
 
+# 詳細情報が取得できたかどうか
+def _is_details_success(loc_info: dict[str, str], min_loc_info: dict) -> bool:
+    """
+    _parse_location_details()の結果が、errorやmin_loc_infoによる代用でないかを判定する
+
+    :param loc_info: result of _parse_location_details()
+    :param min_loc_info: other information of the location by get_location_id()
+    """
+    return loc_info is not min_loc_info and "error" not in loc_info
+
+
+# ロケーション詳細のレスポンスから、必要な情報を取り出す
+def _parse_location_details(
+    response: httpx.Response,
+    loc_id: str,
+    min_loc_info: dict,
+    url: str,
+) -> dict[str, str]:
+    """
+    ロケーション詳細のレスポンスから、必要な情報を取り出す
+
+    :param response: response of the location details
+    :param loc_id: location id (for logging)
+    :param min_loc_info: other information of the location by get_location_id()
+    :param url: request url (for logging)
+    """
     # error handling
     if 500 <= response.status_code <= 599:
         logger.exception(
             f"[Tripadvisor Server Error(Location {loc_id} Details)] \n"
-            f"url: {url + loc_param}\n"
+            f"url: {url}\n"
             f"status_code: {response.status_code}\n"
             f"error text: {response.text}"
         )
@@ -0,0 +1,388 @@
+import asyncio
+import os
+import random
+import threading
+import time
+from typing import Literal
+
+import httpx
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from admission import AdmissionController, AdmissionRejected
+from metrics import UPSTREAM_REQUEST_SECONDS, UPSTREAM_RETRIES_TOTAL
+
+# ---------- 初期化処理 ---------- #
+# 外部API(Tripadvisor, Rakuten, DALL-E)の呼び出しで共有するHTTP clientの設定
+# 接続/読み込みのtimeout(秒)
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "3.0"))
+HTTP_READ_TIMEOUT = float(os.environ.get("HTTP_READ_TIMEOUT", "10.0"))
+# connection poolの上限
+HTTP_MAX_CONNECTIONS = int(os.environ.get("HTTP_MAX_CONNECTIONS", "200"))
+HTTP_MAX_KEEPALIVE = int(os.environ.get("HTTP_MAX_KEEPALIVE", "50"))
+# 1つのhostに同時に送るリクエストの上限
+HTTP_MAX_CONNECTIONS_PER_HOST = int(
+    os.environ.get("HTTP_MAX_CONNECTIONS_PER_HOST", "50")
+)
+# 外部APIへの同時リクエスト数の上限(全host合計)と、待てる数・待つ時間(秒)の上限
+HTTP_MAX_CONCURRENT_UPSTREAM = int(os.environ.get("HTTP_MAX_CONCURRENT_UPSTREAM", "64"))
+HTTP_MAX_QUEUED_UPSTREAM = int(os.environ.get("HTTP_MAX_QUEUED_UPSTREAM", "256"))
+HTTP_UPSTREAM_QUEUE_TIMEOUT = float(os.environ.get("HTTP_UPSTREAM_QUEUE_TIMEOUT", "3.0"))
+# 5xx/429のときのretry回数と、待ち時間(秒)の基準値・上限
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "2"))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "0.2"))
+HTTP_RETRY_MAX_BACKOFF = float(os.environ.get("HTTP_RETRY_MAX_BACKOFF", "2.0"))
+# 連続で何回失敗したらcircuit breakerを開くか、何秒後に再び試すか
+HTTP_BREAKER_FAILURES = int(os.environ.get("HTTP_BREAKER_FAILURES", "5"))
+HTTP_BREAKER_RESET = float(os.environ.get("HTTP_BREAKER_RESET", "30.0"))
+
+# retryしても良いmethod(冪等なもの)と、retryするstatus code
+IDEMPOTENT_METHODS = frozenset({"GET", "HEAD", "OPTIONS"})
+RETRY_STATUS_CODES = frozenset({429, 500, 502, 503, 504})
+
+_client: httpx.Client | None = None
+_async_client: httpx.AsyncClient | None = None
+
+# 非同期のリクエストの受付。混雑している場合は、待たずにすぐ失敗させる
+upstream_admission = AdmissionController(
+    "upstream_calls",
+    max_concurrent=HTTP_MAX_CONCURRENT_UPSTREAM,
+    max_queue=HTTP_MAX_QUEUED_UPSTREAM,
+    wait_timeout=HTTP_UPSTREAM_QUEUE_TIMEOUT,
+)
+# ------------------------------- #
+
+
+class UpstreamUnavailableError(httpx.TransportError):
+    """
+    circuit breakerが開いているため、リクエストを送らずに失敗したことを示す例外
+    """
+
+
+class CircuitBreaker:
+    """
+    hostごとのcircuit breaker
+
+    連続でfailure_threshold回失敗すると開き(open)、reset_timeout秒の間はリクエストを送らずに失敗させます。
+    reset_timeout秒経つと1つだけリクエストを通し(half open)、成功すれば閉じ(closed)、失敗すれば再び開きます。
+    試しに通したリクエストが結果を残さずに終わった場合(cancelや通信以外のエラー)は、
+    release_probe()で開いた状態に戻し、次のリクエストを試しに通します。
+    """
+
+    def __init__(
+        self,
+        host: str,
+        failure_threshold: int = HTTP_BREAKER_FAILURES,
+        reset_timeout: float = HTTP_BREAKER_RESET,
+    ) -> None:
+        self.host = host
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+
+        self.state: Literal["closed", "open", "half_open"] = "closed"
+        self.failures = 0
+        self.opened_count = 0
+        self._opened_at = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self) -> tuple[bool, bool]:
+        """
+        リクエストを送っても良いかと、それが試しに通すリクエスト(probe)かどうかを返す
+
+        probeの場合は、終わった後に必ずrelease_probe()を呼んでください。
+        """
+        with self._lock:
+            if self.state == "closed":
+                return True, False
+            if self.state == "open" and time.monotonic() >= self._opened_at + self.reset_timeout:
+                # 1つだけ試しに通す
+                self.state = "half_open"
+                return True, True
+            return False, False
+
+    def release_probe(self) -> None:
+        """
+        probeが成功も失敗も記録せずに終わった場合に、開いた状態に戻す
+
+        開いた時刻はそのままなので、次のリクエストがすぐにprobeになります。
+        """
+        with self._lock:
+            if self.state == "half_open":
+                self.state = "open"
+
+    def record_success(self) -> None:
+        with self._lock:
+            self.state = "closed"
+            self.failures = 0
+
+    def record_failure(self) -> None:
+        with self._lock:
+            self.failures += 1
+            if self.state == "half_open" or self.failures >= self.failure_threshold:
+                if self.state != "open":
+                    self.opened_count += 1
+                self.state = "open"
+                self._opened_at = time.monotonic()
+
+
+# hostごとのcircuit breakerとリクエスト数の制限
+_breakers: dict[str, CircuitBreaker] = {}
+_host_limits: dict[str, threading.BoundedSemaphore] = {}
+_async_host_limits: dict[str, asyncio.Semaphore] = {}
+_registry_lock = threading.Lock()
+
+
+def _get_breaker(host: str) -> CircuitBreaker:
+    with _registry_lock:
+        if host not in _breakers:
+            _breakers[host] = CircuitBreaker(host)
+        return _breakers[host]
+
+
+def _get_host_limit(host: str) -> threading.BoundedSemaphore:
+    with _registry_lock:
+        if host not in _host_limits:
+            _host_limits[host] = threading.BoundedSemaphore(
+                HTTP_MAX_CONNECTIONS_PER_HOST
+            )
+        return _host_limits[host]
+
+
+def _get_async_host_limit(host: str) -> asyncio.Semaphore:
+    if host not in _async_host_limits:
+        _async_host_limits[host] = asyncio.Semaphore(HTTP_MAX_CONNECTIONS_PER_HOST)
+    return _async_host_limits[host]
+
+
+def _retry_delay(attempt: int, response: httpx.Response | None) -> float:
+    """
+    retryまでの待ち時間を計算する。Retry-After headerがあればそれに従う
+
+    :param attempt: 何回目のretryか(0始まり)
+    :param response: 失敗したresponse(通信エラーの場合はNone)
+    """
+    if response is not None:
+        retry_after = response.headers.get("Retry-After")
+        if retry_after is not None and retry_after.isdigit():
+            return min(float(retry_after), HTTP_RETRY_MAX_BACKOFF)
+    # full jitter: 同時に失敗したリクエストが一斉にretryしないようにする
+    return random.uniform(0, min(HTTP_RETRY_MAX_BACKOFF, HTTP_RETRY_BACKOFF * 2**attempt))
+
+
+def _observe(host: str, start: float, response: httpx.Response | None) -> None:
+    """
+    1回のリクエストの所要時間を記録する。statusは通信エラーの場合"error"
+
+    bodyを読み込む前(headerを受け取った時点)までの時間です。
+    """
+    status = "error" if response is None else str(response.status_code)
+    UPSTREAM_REQUEST_SECONDS.observe(time.perf_counter() - start, host=host, status=status)
+
+
+def _is_retryable(request: httpx.Request, attempt: int) -> bool:
+    return request.method in IDEMPOTENT_METHODS and attempt < HTTP_MAX_RETRIES
+
+
+class ResilientTransport(httpx.BaseTransport):
+    """
+    retry・hostごとの同時リクエスト数の制限・circuit breakerを備えたtransport
+    """
+
+    def __init__(self, transport: httpx.BaseTransport) -> None:
+        self._transport = transport
+
+    def handle_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        breaker = _get_breaker(host)
+        allowed, probe = breaker.acquire()
+        if not allowed:
+            raise UpstreamUnavailableError(
+                f"circuit breaker for {host} is open", request=request
+            )
+
+        try:
+            return self._send(request, host, breaker)
+        finally:
+            if probe:
+                breaker.release_probe()
+
+    def _send(
+        self, request: httpx.Request, host: str, breaker: CircuitBreaker
+    ) -> httpx.Response:
+        attempt = 0
+        with _get_host_limit(host):
+            while True:
+                start = time.perf_counter()
+                try:
+                    response = self._transport.handle_request(request)
+                except httpx.TransportError:
+                    _observe(host, start, None)
+                    if not _is_retryable(request, attempt):
+                        breaker.record_failure()
+                        raise
+                    UPSTREAM_RETRIES_TOTAL.inc(host=host)
+                    time.sleep(_retry_delay(attempt, None))
+                    attempt += 1
+                    continue
+                _observe(host, start, response)
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                if not _is_retryable(request, attempt):
+                    breaker.record_failure()
+                    return response
+
+                delay = _retry_delay(attempt, response)
+                response.close()
+                UPSTREAM_RETRIES_TOTAL.inc(host=host)
+                time.sleep(delay)
+                attempt += 1
+
+    def close(self) -> None:
+        self._transport.close()
+
+
+class AsyncResilientTransport(httpx.AsyncBaseTransport):
+    """
+    ResilientTransportの非同期版
+    """
+
+    def __init__(self, transport: httpx.AsyncBaseTransport) -> None:
+        self._transport = transport
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        breaker = _get_breaker(host)
+        allowed, probe = breaker.acquire()
+        if not allowed:
+            raise UpstreamUnavailableError(
+                f"circuit breaker for {host} is open", request=request
+            )
+
+        try:
+            async with upstream_admission.acquire():
+                return await self._send(request, host, breaker)
+        except AdmissionRejected as e:
+            raise UpstreamUnavailableError(
+                f"too many concurrent upstream requests ({e.reason})", request=request
+            ) from e
+        finally:
+            # cancelされた場合なども、half openのままにしない
+            if probe:
+                breaker.release_probe()
+
+    async def _send(
+        self, request: httpx.Request, host: str, breaker: CircuitBreaker
+    ) -> httpx.Response:
+        attempt = 0
+        async with _get_async_host_limit(host):
+            while True:
+                start = time.perf_counter()
+                try:
+                    response = await self._transport.handle_async_request(request)
+                except httpx.TransportError:
+                    _observe(host, start, None)
+                    if not _is_retryable(request, attempt):
+                        breaker.record_failure()
+                        raise
+                    UPSTREAM_RETRIES_TOTAL.inc(host=host)
+                    await asyncio.sleep(_retry_delay(attempt, None))
+                    attempt += 1
+                    continue
+                _observe(host, start, response)
+
+                if response.status_code not in RETRY_STATUS_CODES:
+                    breaker.record_success()
+                    return response
+                if not _is_retryable(request, attempt):
+                    breaker.record_failure()
+                    return response
+
+                delay = _retry_delay(attempt, response)
+                await response.aclose()
+                UPSTREAM_RETRIES_TOTAL.inc(host=host)
+                await asyncio.sleep(delay)
+                attempt += 1
+
+    async def aclose(self) -> None:
+        await self._transport.aclose()
+
+
+def _timeout() -> httpx.Timeout:
+    return httpx.Timeout(
+        HTTP_READ_TIMEOUT, connect=HTTP_CONNECT_TIMEOUT, pool=HTTP_CONNECT_TIMEOUT
+    )
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=HTTP_MAX_CONNECTIONS,
+        max_keepalive_connections=HTTP_MAX_KEEPALIVE,
+    )
+
+
+def get_client() -> httpx.Client:
+    """
+    共有のHTTP clientを取得する。DALL-E(openaiのsync client)で利用する
+
+    初回呼び出し時にのみ作成し、以降は同じインスタンスを返します。
+    """
+    global _client
+    with _registry_lock:
+        if _client is None or _client.is_closed:
+            _client = httpx.Client(
+                timeout=_timeout(),
+                transport=ResilientTransport(httpx.HTTPTransport(limits=_limits())),
+            )
+        return _client
+
+
+def get_async_client() -> httpx.AsyncClient:
+    """
+    共有の非同期HTTP clientを取得する。
+
+    初回呼び出し時にのみ作成し、以降は同じインスタンスを返します。
+    """
+    global _async_client
+    if _async_client is None or _async_client.is_closed:
+        _async_client = httpx.AsyncClient(
+            timeout=_timeout(),
+            transport=AsyncResilientTransport(
+                httpx.AsyncHTTPTransport(limits=_limits())
+            ),
+        )
+    return _async_client
+
+
+async def aclose_async_client() -> None:
+    """
+    共有のHTTP clientを閉じる。アプリの終了時に呼び出す。
+    """
+    global _async_client, _client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    if _client is not None:
+        _client.close()
+        _client = None
+
+
+def get_upstream_admission_stats() -> dict[str, int | float]:
+    """
+    外部APIへの非同期リクエストの受付の状態を取得する。
+    """
+    return upstream_admission.stats()
+
+
+def get_breaker_states() -> dict[str, dict[str, str | int]]:
+    """
+    hostごとのcircuit breakerの状態を取得する。
+    """
+    return {
+        host: {
+            "state": breaker.state,
+            "failures": breaker.failures,
+            "opened_count": breaker.opened_count,
+        }
+        for host, breaker in _breakers.items()
+    }
@@ -1,23 +1,200 @@
+import atexit
+import copy
+import json
 import logging
 import os
-from logging import FileHandler, Formatter, getLogger
+import queue
+import sys
+import uuid
+from contextvars import ContextVar
+from logging import Formatter, LogRecord, StreamHandler, getLogger
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
 
-from dotenv import find_dotenv, load_dotenv
+import env_setup
 
+# ---------- 初期化処理 ---------- #
+# Logの出力形式。"json" | "text"
+LOG_FORMAT = os.environ.get("TRIPAL_LOG_FORMAT", "json")
+# common_loggerのlevel。module毎のloggerはWARNING以上のみ出力する
+LOG_LEVEL = os.environ.get("TRIPAL_LOG_LEVEL", "INFO").upper()
+# Logのfileの名前と、rotationするサイズ(byte)・残す世代数
+LOG_FILE = os.environ.get("TRIPAL_LOG_FILE", os.path.join(env_setup.LOG_DIR, "tripal.log"))
+LOG_MAX_BYTES = int(os.environ.get("TRIPAL_LOG_MAX_BYTES", str(10 * 1024 * 1024)))
+LOG_BACKUP_COUNT = int(os.environ.get("TRIPAL_LOG_BACKUP_COUNT", "5"))
+# 書き込み待ちのLogの上限。溢れた分は捨てて、event loopを止めないようにする
+LOG_QUEUE_SIZE = int(os.environ.get("TRIPAL_LOG_QUEUE_SIZE", "10000"))
 
-load_dotenv(find_dotenv())
+# 今処理しているセッションとターン(1回の発言と応答)のID
+session_id_var: ContextVar[str | None] = ContextVar("session_id", default=None)
+turn_id_var: ContextVar[str | None] = ContextVar("turn_id", default=None)
 
-# directoryを変更
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
+# LogRecordが標準で持つ属性。これ以外はextraで渡された値として出力する
+_RECORD_ATTRS = frozenset(
+    vars(LogRecord("", 0, "", 0, "", None, None)).keys()
+    | {"message", "asctime", "session_id", "turn_id"}
+)
+# ------------------------------- #
 
 
-common_logger = getLogger(__name__)
-common_logger.setLevel(logging.INFO)
+def bind_session(session_id: str) -> None:
+    """
+    以降のLogに、セッションIDを付ける
 
-stream_handler = FileHandler(filename="logs/common.log")
-stream_handler.setLevel(logging.INFO)
-stream_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-common_logger.addHandler(stream_handler)
+    :param session_id: セッションID
+    """
+    session_id_var.set(session_id)
+
+
+def new_turn() -> str:
+    """
+    新しいターンのIDを発行し、以降のLogに付ける
+
+    :return: ターンのID
+    """
+    turn_id = uuid.uuid4().hex[:12]
+    turn_id_var.set(turn_id)
+    return turn_id
+
+
+def _extra_fields(record: LogRecord) -> dict:
+    """
+    extraで渡された値を取得する
+    """
+    return {
+        key: value for key, value in vars(record).items() if key not in _RECORD_ATTRS
+    }
+
+
+class JsonFormatter(Formatter):
+    """
+    1行に1つのJSONとして出力するFormatter
+
+    session_id・turn_idと、extraで渡された値もfieldとして出力します。
+    """
+
+    def format(self, record: LogRecord) -> str:
+        entry = {
+            "ts": self.formatTime(record, "%Y-%m-%dT%H:%M:%S") + f".{int(record.msecs):03d}",
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+            "session_id": getattr(record, "session_id", None),
+            "turn_id": getattr(record, "turn_id", None),
+        }
+        entry.update(_extra_fields(record))
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            entry["exc_info"] = record.exc_text
+        return json.dumps(entry, ensure_ascii=False, default=str)
+
+
+class TextFormatter(Formatter):
+    """
+    開発用の1行のtext形式のFormatter。extraで渡された値はkey=valueとして末尾に付ける
+    """
+
+    def __init__(self) -> None:
+        super().__init__(
+            "[%(levelname)s] %(asctime)s %(name)s "
+            "session=%(session_id)s turn=%(turn_id)s %(message)s"
+        )
+
+    def format(self, record: LogRecord) -> str:
+        text = super().format(record)
+        extra = " ".join(
+            f"{key}={value}" for key, value in _extra_fields(record).items()
+        )
+        return f"{text} {extra}" if extra else text
+
+
+class _NonBlockingQueueHandler(QueueHandler):
+    """
+    呼び出し元のthread(event loop)ではqueueに入れるだけのhandler
+
+    session_id・turn_idはここで付けます(contextvarsは呼び出し元でしか読めないため)。
+    queueが一杯の場合は待たずに捨て、捨てた数を数えます。
+    """
+
+    def __init__(self, log_queue: queue.Queue) -> None:
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: LogRecord) -> LogRecord:
+        # 引数やtracebackはここで文字列にしておき、書き込み側のthreadには値だけを渡す
+        record = copy.copy(record)
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            record.exc_text = Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        record.session_id = session_id_var.get()
+        record.turn_id = turn_id_var.get()
+        return record
+
+    def enqueue(self, record: LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+def _create_formatter() -> Formatter:
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return TextFormatter()
+
+
+def _setup_logging() -> tuple[_NonBlockingQueueHandler, QueueListener]:
+    """
+    全てのLogを1つのqueueに集め、backgroundのthreadでfileと標準エラー出力に書き込む
+    """
+    formatter = _create_formatter()
+
+    os.makedirs(os.path.dirname(LOG_FILE) or ".", exist_ok=True)
+    file_handler = RotatingFileHandler(
+        LOG_FILE, maxBytes=LOG_MAX_BYTES, backupCount=LOG_BACKUP_COUNT, delay=True
+    )
+    file_handler.setFormatter(formatter)
+
+    # 標準エラー出力にはエラーのみ
+    stream_handler = StreamHandler(sys.stderr)
+    stream_handler.setLevel(logging.ERROR)
+    stream_handler.setFormatter(formatter)
+
+    log_queue: queue.Queue = queue.Queue(maxsize=LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    listener = QueueListener(
+        log_queue, file_handler, stream_handler, respect_handler_level=True
+    )
+
+    root = getLogger()
+    root.addHandler(queue_handler)
+    if root.level == logging.NOTSET or root.level > logging.WARNING:
+        root.setLevel(logging.WARNING)
+
+    listener.start()
+    # プロセスの終了時に、queueに残っているLogを書き込む
+    atexit.register(listener.stop)
+    return queue_handler, listener
+
+
+def get_log_stats() -> dict[str, int]:
+    """
+    書き込み待ちのLogの数と、queueが一杯で捨てたLogの数を取得する
+    """
+    return {
+        "queued": _queue_handler.queue.qsize(),
+        "dropped": _queue_handler.dropped,
+    }
+
+
+_queue_handler, _listener = _setup_logging()
+
+# 処理の流れを追うためのlogger(INFO)
+common_logger = getLogger("tripal")
+common_logger.setLevel(LOG_LEVEL)
 
 
 # Azure Application InsightsにLogを送信するときは下記を追加
@@ -29,8 +206,7 @@ common_logger.addHandler(stream_handler)
 
 # config_integration.trace_integrations(["logging"])
 
-# logging.basicConfig(handlers=[AzureLogHandler()])
-
+# listenerのhandlerに加えると、送信もbackgroundのthreadで行われる
 # azure_handler = AzureLogHandler()
 # azure_handler.setLevel(logging.INFO)
-# common_logger.addHandler(azure_handler)
+# _listener.handlers = (*_listener.handlers, azure_handler)
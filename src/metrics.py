@@ -0,0 +1,397 @@
+import asyncio
+import functools
+import threading
+import time
+from typing import Any, Callable, Iterable, TypeVar
+
+# ---------- 初期化処理 ---------- #
+# 時間(秒)のhistogramのbucket
+LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+# 秒間token数のhistogramのbucket
+TOKENS_PER_SEC_BUCKETS = (5.0, 10.0, 20.0, 50.0, 100.0, 200.0, 500.0, 1000.0)
+# agentのiteration数のhistogramのbucket
+ITERATION_BUCKETS = (1.0, 2.0, 3.0, 4.0, 5.0, 7.0, 10.0, 15.0)
+# 1ターンあたりの回数(Toolの失敗など)のhistogramのbucket
+COUNT_BUCKETS = (0.0, 1.0, 2.0, 3.0, 5.0, 10.0)
+# token数のhistogramのbucket
+TOKEN_BUCKETS = (0.0, 50.0, 100.0, 250.0, 500.0, 1000.0, 2000.0, 4000.0, 8000.0)
+
+F = TypeVar("F", bound=Callable[..., Any])
+# ------------------------------- #
+
+
+def _format_labels(labelnames: tuple[str, ...], values: tuple[str, ...], **extra: str) -> str:
+    pairs = [*zip(labelnames, values), *extra.items()]
+    if not pairs:
+        return ""
+    escaped = (
+        (name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in pairs
+    )
+    return "{" + ",".join(f'{name}="{value}"' for name, value in escaped) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    """
+    Prometheusのtext形式で出力できるmetricの基底クラス
+
+    labelの値ごとに値を持ちます。複数のthreadから更新されても良いようにlockで保護しています。
+    """
+
+    kind = ""
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        if set(labels) != set(self.labelnames):
+            raise ValueError(
+                f"{self.name} expects labels {self.labelnames}, got {tuple(labels)}"
+            )
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _samples(self) -> list[str]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.kind}",
+        ]
+        with self._lock:
+            lines.extend(self._samples())
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    """
+    増えるだけの値(リクエスト数など)
+    """
+
+    kind = "counter"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def _samples(self) -> list[str]:
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Gauge(_Metric):
+    """
+    増減する値(接続中のセッション数など)
+    """
+
+    kind = "gauge"
+
+    def __init__(self, name: str, documentation: str, labelnames: Iterable[str] = ()) -> None:
+        super().__init__(name, documentation, labelnames)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+    def _samples(self) -> list[str]:
+        if not self._values and not self.labelnames:
+            return [f"{self.name} 0"]
+        return [
+            f"{self.name}{_format_labels(self.labelnames, key)} {_format_value(value)}"
+            for key, value in self._values.items()
+        ]
+
+
+class Histogram(_Metric):
+    """
+    値の分布(所要時間など)。bucketごとの累積の件数と、合計・件数を持ちます。
+    """
+
+    kind = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Iterable[str] = (),
+        buckets: Iterable[float] = LATENCY_BUCKETS,
+    ) -> None:
+        super().__init__(name, documentation, labelnames)
+        self.buckets = (*sorted(buckets), float("inf"))
+        # labelの値ごとの、[bucketごとの件数..., 合計]
+        self._values: dict[tuple[str, ...], list[float]] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            counts = self._values.get(key)
+            if counts is None:
+                counts = self._values[key] = [0.0] * (len(self.buckets) + 1)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            counts[-1] += value
+
+    def _samples(self) -> list[str]:
+        lines = []
+        for key, counts in self._values.items():
+            cumulative = 0.0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(self.labelnames, key, le=_format_value(bound))
+                lines.append(f"{self.name}_bucket{labels} {_format_value(cumulative)}")
+            labels = _format_labels(self.labelnames, key)
+            lines.append(f"{self.name}_sum{labels} {_format_value(counts[-1])}")
+            lines.append(f"{self.name}_count{labels} {_format_value(cumulative)}")
+        return lines
+
+
+def track_tool(
+    tool_name: str, is_failure: Callable[[Any], bool] | None = None
+) -> Callable[[F], F]:
+    """
+    Toolの関数の所要時間と結果(ok/error)をTOOL_DURATION_SECONDSに記録するdecorator
+
+    同期版・非同期版のどちらの関数にも使えます。
+    Toolは失敗を例外ではなく戻り値({"Error": ...}など)で伝えるため、is_failureで戻り値も判定します。
+
+    :param tool_name: Toolの名前(label)
+    :param is_failure: 戻り値が失敗を示すものかどうかを判定する関数
+    """
+
+    def _status(result: Any) -> str:
+        return "error" if is_failure is not None and is_failure(result) else "ok"
+
+    def decorator(func: F) -> F:
+        if asyncio.iscoroutinefunction(func):
+
+            @functools.wraps(func)
+            async def async_wrapper(*args: Any, **kwargs: Any) -> Any:
+                start = time.perf_counter()
+                status = "error"
+                try:
+                    result = await func(*args, **kwargs)
+                    status = _status(result)
+                    return result
+                except asyncio.CancelledError:
+                    status = "cancelled"
+                    raise
+                finally:
+                    TOOL_DURATION_SECONDS.observe(
+                        time.perf_counter() - start, tool=tool_name, status=status
+                    )
+
+            return async_wrapper  # type: ignore[return-value]
+
+        @functools.wraps(func)
+        def wrapper(*args: Any, **kwargs: Any) -> Any:
+            start = time.perf_counter()
+            status = "error"
+            try:
+                result = func(*args, **kwargs)
+                status = _status(result)
+                return result
+            finally:
+                TOOL_DURATION_SECONDS.observe(
+                    time.perf_counter() - start, tool=tool_name, status=status
+                )
+
+        return wrapper  # type: ignore[return-value]
+
+    return decorator
+
+
+def render_metrics() -> str:
+    """
+    全てのmetricをPrometheusのtext形式(version 0.0.4)で出力する
+    """
+    return "\n".join(metric.render() for metric in _registry) + "\n"
+
+
+# 作成したmetricの一覧
+_registry: list[_Metric] = []
+
+# ---/chat--- #
+ACTIVE_SESSIONS = Gauge(
+    "tripal_active_sessions", "Number of connected /chat WebSocket sessions."
+)
+WS_FIRST_FRAME_SECONDS = Histogram(
+    "tripal_ws_first_frame_seconds",
+    "Time from receiving a message to sending the first frame to the client.",
+)
+TURNS_CANCELLED_TOTAL = Counter(
+    "tripal_turns_cancelled_total",
+    "Number of in-flight turns cancelled by reason (disconnect/superseded).",
+    ("reason",),
+)
+WS_TURN_SECONDS = Histogram(
+    "tripal_ws_turn_seconds",
+    "Time from receiving a message to sending the last frame to the client.",
+)
+
+# ---TriPalGPT--- #
+TURNS_TOTAL = Counter(
+    "tripal_turns_total", "Number of turns by source and status.", ("source", "status")
+)
+TURN_FIRST_TOKEN_SECONDS = Histogram(
+    "tripal_turn_first_token_seconds",
+    "Time from the start of a turn to the first generated token.",
+    ("source",),
+)
+TURN_DURATION_SECONDS = Histogram(
+    "tripal_turn_duration_seconds",
+    "Time from the start of a turn to the last generated token.",
+    ("source",),
+)
+TURN_TOKENS_PER_SECOND = Histogram(
+    "tripal_turn_tokens_per_second",
+    "Generated tokens per second after the first token.",
+    ("source",),
+    buckets=TOKENS_PER_SEC_BUCKETS,
+)
+AGENT_ITERATIONS = Histogram(
+    "tripal_agent_iterations",
+    "Number of agent iterations (LLM calls) per turn.",
+    buckets=ITERATION_BUCKETS,
+)
+TOOL_DURATION_SECONDS = Histogram(
+    "tripal_tool_duration_seconds",
+    "Tool call latency by tool and status.",
+    ("tool", "status"),
+)
+TOOL_OUTPUT_TOKENS = Histogram(
+    "tripal_tool_output_tokens",
+    "Tokens of each tool output passed to the LLM, after shaping.",
+    ("tool",),
+    buckets=TOKEN_BUCKETS,
+)
+TOOL_OUTPUT_TOKENS_SAVED = Histogram(
+    "tripal_tool_output_tokens_saved",
+    "Tokens removed from each tool output by shaping.",
+    ("tool",),
+    buckets=TOKEN_BUCKETS,
+)
+TOOL_ARGS_NORMALIZED_TOTAL = Counter(
+    "tripal_tool_args_normalized_total",
+    "Number of tool arguments rewritten by the local area index before the API call.",
+    ("tool", "field"),
+)
+TURN_TOOL_FAILURES = Histogram(
+    "tripal_turn_tool_failures",
+    "Number of tool calls per turn that returned an error to the agent.",
+    buckets=COUNT_BUCKETS,
+)
+TURN_TOOL_RETRIES = Histogram(
+    "tripal_turn_tool_retries",
+    "Number of tool calls per turn that retried the same tool after it failed.",
+    buckets=COUNT_BUCKETS,
+)
+AGENT_BUDGET_EXHAUSTED_TOTAL = Counter(
+    "tripal_agent_budget_exhausted_total",
+    "Number of agent turns that ran out of a budget (iterations/tool_calls/time) "
+    "and answered from the tool results gathered so far.",
+    ("budget",),
+)
+
+POI_SNAPSHOT_LOOKUPS_TOTAL = Counter(
+    "tripal_poi_snapshot_lookups_total",
+    "Number of offline POI snapshot lookups by result (hit/miss/stale).",
+    ("result",),
+)
+
+# ---先読み--- #
+PREFETCH_TOTAL = Counter(
+    "tripal_prefetch_total",
+    "Number of speculative tool-cache prefetches by target and status.",
+    ("target", "status"),
+)
+
+# ---modelの振り分け--- #
+ROUTE_DECISIONS_TOTAL = Counter(
+    "tripal_route_decisions_total",
+    "Number of turns routed to each model by route (chat/agent) and classifier.",
+    ("route", "classifier"),
+)
+ROUTE_DECISION_SECONDS = Histogram(
+    "tripal_route_decision_seconds",
+    "Time spent deciding the route of a turn by classifier.",
+    ("classifier",),
+)
+ROUTE_TURN_SECONDS = Histogram(
+    "tripal_route_turn_seconds",
+    "Time from the start of a turn to the last generated token by route.",
+    ("route",),
+)
+ROUTE_FIRST_TOKEN_SECONDS = Histogram(
+    "tripal_route_first_token_seconds",
+    "Time from the start of a turn to the first generated token by route.",
+    ("route",),
+)
+ROUTE_PROMPT_TOKENS = Histogram(
+    "tripal_route_prompt_tokens",
+    "Estimated prompt tokens of the first LLM call of a turn by route.",
+    ("route",),
+    buckets=TOKEN_BUCKETS,
+)
+ROUTE_COMPLETION_TOKENS = Histogram(
+    "tripal_route_completion_tokens",
+    "Generated answer tokens per turn by route.",
+    ("route",),
+    buckets=TOKEN_BUCKETS,
+)
+
+# ---受付(同時実行数の制限)--- #
+ADMISSION_ACTIVE = Gauge(
+    "tripal_admission_active", "Number of admitted, running operations.", ("name",)
+)
+ADMISSION_WAITING = Gauge(
+    "tripal_admission_waiting", "Number of operations waiting in the queue.", ("name",)
+)
+ADMISSION_WAIT_SECONDS = Histogram(
+    "tripal_admission_wait_seconds",
+    "Time spent waiting in the queue before being admitted.",
+    ("name",),
+)
+ADMISSION_REJECTED_TOTAL = Counter(
+    "tripal_admission_rejected_total",
+    "Number of rejected operations by reason (queue_full/timeout).",
+    ("name", "reason"),
+)
+
+# ---外部API--- #
+UPSTREAM_REQUEST_SECONDS = Histogram(
+    "tripal_upstream_request_seconds",
+    "Latency of each HTTP attempt to third-party APIs by host and status.",
+    ("host", "status"),
+)
+UPSTREAM_RETRIES_TOTAL = Counter(
+    "tripal_upstream_retries_total", "Number of retried HTTP attempts by host.", ("host",)
+)
@@ -0,0 +1,109 @@
+import asyncio
+import os
+from logging import getLogger
+from typing import Any, Awaitable, Callable
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from func_call_tools.area_index import find_areas
+from func_call_tools.reservations import aprefetch_reserve_location
+from func_call_tools.suggestions import aprefetch_trip_suggestions
+from log_setup import common_logger
+from metrics import PREFETCH_TOTAL
+
+# ---------- 初期化処理 ---------- #
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
+logger = getLogger(__name__)
+
+# 先読みを行うかどうか("0"で無効)
+PREFETCH_ENABLED = os.environ.get("TRIPAL_PREFETCH", "1") == "1"
+# 宿泊施設を探していると判断する語。含まれていればRakutenを、なければTripadvisorを先読みする
+LODGING_WORDS = ("ホテル", "宿", "旅館", "民宿", "温泉", "泊", "予約")
+# プロセス全体で同時に実行する先読みの数の上限。超えた分は行わない
+PREFETCH_MAX_INFLIGHT = int(os.environ.get("TRIPAL_PREFETCH_MAX_INFLIGHT", "16"))
+# 1つの先読みにかける時間の上限(秒)
+PREFETCH_TIMEOUT = float(os.environ.get("TRIPAL_PREFETCH_TIMEOUT", "10.0"))
+# ------------------------------- #
+
+# 実行中の先読みの数(プロセス全体)
+_inflight = 0
+
+
+class SpeculativePrefetch:
+    """
+    LLMがToolを選んでいる間に、ユーザーの入力から推測した検索を行い、Toolのcacheに入れておく
+
+    例えば"沖縄に行きたい"であればTripadvisorの"沖縄"の検索を、
+    "沖縄のホテル"であればRakutenの"沖縄"(pref_code="okinawa")の検索を先に始めます。
+    その後のToolの呼び出しが同じ条件であれば、cacheか実行中のリクエスト(SingleFlight)から結果を受け取れます。
+
+    推測はLLMが選ぶ引数と一致しないことも多いため、外部APIの呼び出しは1ターンにつき1回だけにします。
+    1ターンごとに作成し、ターンが終わったらcancel()で止めます。
+    """
+
+    def __init__(self) -> None:
+        self._tasks: list[asyncio.Task] = []
+
+    def start(self, user_input: str) -> None:
+        """
+        ユーザーの入力から地名を探し、見つかった場合は先読みを始める
+
+        :param user_input: ユーザーからの入力
+        """
+        if not PREFETCH_ENABLED:
+            return
+
+        areas = find_areas(user_input, limit=1)
+        if not areas:
+            return
+
+        name, pref_code = areas[0]
+        if any(word in user_input for word in LODGING_WORDS):
+            target = "rakuten"
+            self._spawn(target, aprefetch_reserve_location, name, pref_code)
+        else:
+            target = "tripadvisor"
+            self._spawn(target, aprefetch_trip_suggestions, name)
+        common_logger.info(
+            "prefetch", extra={"target": target, "area": name, "pref_code": pref_code}
+        )
+
+    def _spawn(
+        self, target: str, func: Callable[..., Awaitable[Any]], *args: str
+    ) -> None:
+        if _inflight >= PREFETCH_MAX_INFLIGHT:
+            PREFETCH_TOTAL.inc(target=target, status="skipped")
+            return
+        self._tasks.append(asyncio.create_task(_run(target, func, *args)))
+
+    def cancel(self) -> None:
+        """
+        終わっていない先読みを止める
+
+        Toolの呼び出しが同じリクエストを待っている場合、そのリクエストは止まらずに最後まで実行されます。
+        誰も待っていないリクエストは、SingleFlightが中断します。
+        """
+        for task in self._tasks:
+            if not task.done():
+                task.cancel()
+        self._tasks.clear()
+
+
+async def _run(target: str, func: Callable[..., Awaitable[Any]], *args: str) -> None:
+    global _inflight
+    _inflight += 1
+    status = "error"
+    try:
+        async with asyncio.timeout(PREFETCH_TIMEOUT):
+            found = await func(*args)
+        status = "ok" if found else "empty"
+    except asyncio.CancelledError:
+        status = "cancelled"
+        raise
+    except TimeoutError:
+        status = "timeout"
+    except Exception as e:
+        # 先読みの失敗はユーザーの応答には影響させない
+        logger.warning(f"[Prefetch Error({target})] {args}\n{e.__class__.__name__}: {e}")
+    finally:
+        _inflight -= 1
+        PREFETCH_TOTAL.inc(target=target, status=status)
@@ -0,0 +1,164 @@
+"""
+よく聞かれる場所の検索結果を、Tripadvisorから取得してPOI snapshotのfileを作成するjob
+
+Location_Informationは、snapshotにある検索条件であればAPIを呼び出さずに答えます。
+cronなどで定期的に(snapshotの有効期限より短い間隔で)実行してください。
+fileは一時fileに書いてから置き換えるので、serverを止める必要はありません。
+
+検索条件は、以下から集めます。
+- --from-log: TriPalのJSON log("trip_suggestions")で、よく使われた検索条件の上位--top件
+- --queries: 1行に1つの検索条件("検索クエリ<TAB>カテゴリ"。カテゴリは省略可)を書いたfile
+- どちらも指定しない場合は、DEFAULT_QUERIES
+
+取得に失敗した検索条件は、有効期限内であれば前回のsnapshotの結果を引き継ぎます。
+
+usage:
+    $ cd src
+    $ python refresh_poi_snapshot.py --from-log logs/tripal.log --top 100
+    $ python refresh_poi_snapshot.py --queries queries.tsv --output cache/poi_snapshot.bin
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from collections import Counter
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from caching import normalize_key
+from func_call_tools.poi_snapshot import (
+    POI_SNAPSHOT_MAX_AGE,
+    POI_SNAPSHOT_PATH,
+    POISnapshot,
+    SnapshotEntry,
+    write_snapshot,
+)
+from func_call_tools.suggestions import afetch_locations_info
+from http_client import aclose_async_client
+
+# 検索条件の指定がない場合に取得する、よく聞かれる場所
+DEFAULT_QUERIES: list[tuple[str, str]] = [
+    ("日本の有名な観光スポット", ""),
+    ("東京タワー", ""),
+    ("東京スカイツリー", ""),
+    ("浅草寺", ""),
+    ("旭山動物園", ""),
+    ("北海道の名所", ""),
+    ("京都の有名レストラン", "restaurants"),
+    ("金閣寺", ""),
+    ("伏見稲荷大社", ""),
+    ("大阪城", ""),
+    ("東大寺", ""),
+    ("厳島神社", ""),
+    ("沖縄美ら海水族館", ""),
+    ("富士山", ""),
+]
+LANGUAGE = "ja"
+
+
+def queries_from_log(paths: list[str], top: int) -> list[tuple[str, str]]:
+    """
+    JSON logから、よく使われた検索条件を多い順に取得する
+
+    :param paths: JSON形式のlog file(TRIPAL_LOG_FORMAT=json)
+    :param top: 取得する件数
+    """
+    counts: Counter[tuple[str, str]] = Counter()
+    for path in paths:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                try:
+                    record = json.loads(line)
+                except json.JSONDecodeError:
+                    continue
+                if record.get("message") == "trip_suggestions" and record.get("loc_search"):
+                    counts[(record["loc_search"], record.get("category") or "")] += 1
+    return [query for query, _ in counts.most_common(top)]
+
+
+def queries_from_file(path: str) -> list[tuple[str, str]]:
+    """
+    1行に1つの検索条件("検索クエリ<TAB>カテゴリ")を書いたfileから、検索条件を取得する
+
+    :param path: 検索条件のfile
+    """
+    queries = []
+    with open(path, encoding="utf-8") as f:
+        for line in f:
+            loc_search, _, category = line.rstrip("\n").partition("\t")
+            if loc_search.strip():
+                queries.append((loc_search.strip(), category.strip()))
+    return queries
+
+
+async def fetch_entries(
+    queries: list[tuple[str, str]], concurrency: int
+) -> dict[str, SnapshotEntry]:
+    """
+    検索条件ごとに、検索と詳細の取得を行う
+
+    :param queries: (検索クエリ, カテゴリ)のlist
+    :param concurrency: 同時に取得する検索条件の数
+    """
+    semaphore = asyncio.Semaphore(concurrency)
+    entries: dict[str, SnapshotEntry] = {}
+
+    async def _fetch(loc_search: str, category: str) -> None:
+        async with semaphore:
+            locations = await afetch_locations_info(loc_search, category, LANGUAGE)
+        if not locations:
+            print(f"skip (no result): {loc_search} {category}")
+            return
+        entries[normalize_key(loc_search, category, LANGUAGE)] = SnapshotEntry(
+            loc_search=loc_search,
+            category=category,
+            fetched_at=time.time(),
+            locations=list(locations.items()),
+        )
+
+    await asyncio.gather(*(_fetch(loc_search, category) for loc_search, category in queries))
+    return entries
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--output", default=POI_SNAPSHOT_PATH)
+    parser.add_argument("--from-log", nargs="*", default=[], help="JSON形式のlog file")
+    parser.add_argument("--top", type=int, default=100, help="logから取得する検索条件の数")
+    parser.add_argument("--queries", help="検索条件のfile(検索クエリ<TAB>カテゴリ)")
+    parser.add_argument("--concurrency", type=int, default=4)
+    args = parser.parse_args()
+
+    if not args.output:
+        parser.error("--output (or TRIPAL_POI_SNAPSHOT) is required")
+
+    queries: list[tuple[str, str]] = []
+    if args.from_log:
+        queries += queries_from_log(args.from_log, args.top)
+    if args.queries:
+        queries += queries_from_file(args.queries)
+    if not queries:
+        queries = DEFAULT_QUERIES
+    queries = list(dict.fromkeys(queries))
+
+    try:
+        entries = await fetch_entries(queries, args.concurrency)
+    finally:
+        await aclose_async_client()
+
+    # 取得できなかったものは、有効期限内であれば前回の結果を引き継ぐ
+    carried = 0
+    for key, entry in POISnapshot(args.output, recheck=0).entries():
+        if key not in entries and entry.age <= POI_SNAPSHOT_MAX_AGE:
+            entries[key] = entry
+            carried += 1
+
+    count = write_snapshot(args.output, entries.items())
+    print(
+        f"wrote {count} entries to {args.output} "
+        f"(fetched: {count - carried}, carried over: {carried}, queries: {len(queries)})"
+    )
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import time
+from dataclasses import dataclass, field
+from typing import TYPE_CHECKING, AsyncGenerator
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from caching import MISSING, TTLCache, normalize_key
+
+# 起動を速くするため、型のためだけのlangchainはimportしない
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+
+# ---------- 初期化処理 ---------- #
+# 最初の発言(挨拶や「〇〇に行きたい」など)に対する応答をcacheするかどうか
+RESPONSE_CACHE_ENABLED = os.environ.get("TRIPAL_RESPONSE_CACHE", "0") == "1"
+# cacheの有効期限(秒)と、保持する件数の上限
+RESPONSE_CACHE_TTL = float(os.environ.get("TRIPAL_RESPONSE_CACHE_TTL", "3600"))
+RESPONSE_CACHE_MAXSIZE = int(os.environ.get("TRIPAL_RESPONSE_CACHE_MAXSIZE", "256"))
+# 1つの応答として保存するtoken数の上限。これより長い応答はcacheしない
+RESPONSE_CACHE_MAX_TOKENS = int(
+    os.environ.get("TRIPAL_RESPONSE_CACHE_MAX_TOKENS", "2000")
+)
+# 末尾の句読点や記号の違いは同じ入力とみなす
+_TRAILING_PUNCTUATION = " 　!！?？.。、,，~〜ー…♪"
+# ------------------------------- #
+
+
+@dataclass
+class CachedResponse:
+    """
+    cacheした応答と、そのhit数
+
+    統計として外部に出すため、ユーザーの入力は保存せず、keyのhashのみを持ちます。
+    """
+
+    key_hash: str
+    tokens: list[str]
+    output: str
+    created_at: float = field(default_factory=time.time)
+    hits: int = 0
+    last_hit_at: float | None = None
+
+
+class ResponseCache:
+    """
+    会話の履歴が空のときの応答を、tokenの列のまま保存しておくcache
+
+    hitした場合はLLMを呼び出さずに、保存したtokenを同じasync generatorの形で返します。
+    """
+
+    def __init__(
+        self,
+        enabled: bool = RESPONSE_CACHE_ENABLED,
+        ttl: float = RESPONSE_CACHE_TTL,
+        maxsize: int = RESPONSE_CACHE_MAXSIZE,
+        max_tokens: int = RESPONSE_CACHE_MAX_TOKENS,
+    ) -> None:
+        self.enabled = enabled
+        self.max_tokens = max_tokens
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+        self.stores = 0
+        self.skipped = 0
+
+    @staticmethod
+    def history_fingerprint(history: "list[BaseMessage]") -> str:
+        """
+        会話の履歴を識別するための値を作成する
+
+        :param history: 会話の履歴
+        """
+        serialized = json.dumps(
+            [(m.type, m.content) for m in history], ensure_ascii=False
+        )
+        return hashlib.sha256(serialized.encode()).hexdigest()[:16]
+
+    def make_key(self, user_input: str, history: "list[BaseMessage]") -> str | None:
+        """
+        cacheのkeyを作成する。cacheの対象外の場合はNoneを返す
+
+        履歴によって応答が変わるため、履歴が空のとき(最初の発言)のみを対象にしています。
+
+        :param user_input: ユーザーからの入力
+        :param history: 会話の履歴
+        """
+        if not self.enabled or history:
+            return None
+        normalized = normalize_key(user_input).rstrip(_TRAILING_PUNCTUATION)
+        if normalized == "":
+            return None
+        return normalize_key(normalized, self.history_fingerprint(history))
+
+    def get(self, key: str) -> CachedResponse | None:
+        """
+        cacheした応答を取得する。存在しない場合はNoneを返す
+
+        :param key: make_key()で作成したkey
+        """
+        entry = self._cache.get(key)
+        if entry is MISSING:
+            return None
+        entry.hits += 1
+        entry.last_hit_at = time.time()
+        return entry
+
+    def put(self, key: str, tokens: list[str]) -> None:
+        """
+        応答を保存する。長すぎる応答は保存しない
+
+        :param key: make_key()で作成したkey
+        :param tokens: 応答のtokenの列
+        """
+        if not tokens or len(tokens) > self.max_tokens:
+            self.skipped += 1
+            return
+        self._cache.set(
+            key,
+            CachedResponse(
+                key_hash=hashlib.sha256(key.encode()).hexdigest()[:16],
+                tokens=tokens,
+                output="".join(tokens),
+            ),
+        )
+        self.stores += 1
+
+    @staticmethod
+    async def replay(entry: CachedResponse) -> AsyncGenerator[str, None]:
+        """
+        cacheした応答を、LLMの出力と同じようにtokenごとに返す
+
+        :param entry: get()で取得した応答
+        """
+        for token in entry.tokens:
+            yield token
+
+    def stats(self, top: int = 20) -> dict:
+        """
+        cache全体の統計と、hit数の多い応答ごとの統計を取得する
+
+        他のユーザーの入力が見えないように、応答はkeyのhashで示します。
+
+        :param top: 応答ごとの統計を何件返すか
+        """
+        entries = sorted(
+            self._cache.values(),
+            key=lambda entry: entry.hits,
+            reverse=True,
+        )
+        return {
+            "enabled": self.enabled,
+            **self._cache.stats(),
+            "stores": self.stores,
+            "skipped": self.skipped,
+            "entries": [
+                {
+                    "key": entry.key_hash,
+                    "hits": entry.hits,
+                    "tokens": len(entry.tokens),
+                    "created_at": entry.created_at,
+                    "last_hit_at": entry.last_hit_at,
+                }
+                for entry in entries[:top]
+            ],
+        }
+
+
+# プロセス全体で共有するcache
+response_cache = ResponseCache()
@@ -0,0 +1,157 @@
+import asyncio
+import os
+import re
+import time
+import unicodedata
+from logging import getLogger
+from typing import TYPE_CHECKING, Literal, Sequence
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from func_call_tools.area_index import find_areas
+from metrics import ROUTE_DECISION_SECONDS, ROUTE_DECISIONS_TOTAL
+
+if TYPE_CHECKING:
+    from langchain_core.messages import BaseMessage
+    from langchain_core.runnables import Runnable
+
+# ---------- 初期化処理 ---------- #
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
+logger = getLogger(__name__)
+
+# 振り分けの方式
+# "heuristic": 文字列の規則だけで判定する(default)
+# "llm": 規則で判定できない場合は、速いmodelに分類させる
+# "off": 全てagentで応答する(従来の動作)
+RouterMode = Literal["heuristic", "llm", "off"]
+ROUTER_MODE: RouterMode = os.environ.get("TRIPAL_ROUTER", "heuristic")  # type: ignore[assignment]
+# LLMの分類を待つ時間の上限(秒)。超えた場合はagentで応答する
+ROUTER_LLM_TIMEOUT = float(os.environ.get("TRIPAL_ROUTER_LLM_TIMEOUT", "2.0"))
+# これより長い発言は、プランの相談とみなす(文字数)
+CHAT_MAX_CHARS = int(os.environ.get("TRIPAL_ROUTER_CHAT_MAX_CHARS", "30"))
+
+# "chat": Toolなしの速いmodelで応答する / "agent": Tool付きの16kのagentで応答する
+Route = Literal["chat", "agent"]
+
+# プランの相談やToolが必要そうな語。含まれていればagentで応答する
+AGENT_WORDS = (
+    "旅行", "旅", "観光", "スポット", "名所", "プラン", "計画", "日程", "予定", "予算",
+    "ホテル", "宿", "旅館", "温泉", "泊", "予約", "レストラン", "ランチ", "ディナー",
+    "グルメ", "食べ", "お店", "行きたい", "行き方", "アクセス", "おすすめ", "オススメ",
+    "ツアー", "世界遺産", "美術館", "博物館", "公園", "神社", "寺", "日帰り", "週末",
+    "円", "万", "観光地", "調べて", "探して",
+)
+# 挨拶・お礼など、雑談とみなす発言
+CHAT_PATTERNS = re.compile(
+    r"^(こんにちは|こんばんは|おはよう(ございます)?|はじめまして|"
+    r"ありがとう(ございます|ございました)?|どうも|助かりました|"
+    r"hello|hi|hey|thanks|thank you|さようなら|またね|バイバイ)(?![a-z])"
+)
+# 相づち・返事。直前の応答が質問や提案("ホテルも調べましょうか？"など)なら、その答えなのでagentで応答する
+ACKNOWLEDGEMENT_PATTERNS = re.compile(
+    r"^(はい|いいえ|うん|ええ|ok|okay|yes|no|了解(です)?|わかりました|"
+    r"よろしく(お願いします)?|お願いします|ぜひ)(?![a-z])"
+)
+# 前の応答についての確認の質問
+CLARIFY_PATTERNS = re.compile(
+    r"(どういう意味|もう一度|もう少し分かりやすく|わかりやすく|言い換えて|つまり|"
+    r"今の(説明|話)|さっきの(説明|話))"
+)
+# ------------------------------- #
+
+
+def _normalize(text: str) -> str:
+    text = unicodedata.normalize("NFKC", text).strip().lower()
+    # 文末の記号や絵文字を取り除く
+    return re.sub(r"[\s!?。、.,〜~笑\U0001F300-\U0001FAFF]+$", "", text)
+
+
+def _last_ai_message_asks(chat_history: Sequence["BaseMessage"]) -> bool:
+    """
+    直前のAIの応答が、質問や提案(ユーザーの返事を待つもの)で終わっているかどうか
+    """
+    for message in reversed(chat_history):
+        # Toolを呼び出しただけのmessage(内容が空)は飛ばす
+        if message.type == "ai" and message.content:
+            return "?" in unicodedata.normalize("NFKC", str(message.content))
+    return False
+
+
+def classify_heuristic(
+    user_input: str, chat_history: Sequence["BaseMessage"] = ()
+) -> Route | None:
+    """
+    文字列の規則で振り分ける。判定できない場合はNone
+
+    - 地名やプラン・宿・食事に関する語があればagent
+    - 長い発言はagent
+    - 相づち・返事は、直前の応答が質問や提案ならagent、そうでなければchat
+    - 挨拶・お礼や、前の応答についての確認の質問はchat
+
+    :param user_input: ユーザーからの入力
+    :param chat_history: このセッションの会話の履歴
+    """
+    text = _normalize(user_input)
+    if not text:
+        return "chat"
+    if find_areas(text, limit=1) or any(word in text for word in AGENT_WORDS):
+        return "agent"
+    if len(text) > CHAT_MAX_CHARS:
+        return "agent"
+    if ACKNOWLEDGEMENT_PATTERNS.match(text):
+        return "agent" if _last_ai_message_asks(chat_history) else "chat"
+    if CHAT_PATTERNS.match(text) or CLARIFY_PATTERNS.search(text):
+        return "chat"
+    return None
+
+
+class ModelRouter:
+    """
+    1ターンの応答を、Toolなしの速いmodel(chat)と、Tool付きの16kのagent(agent)のどちらで行うかを決める
+
+    規則(classify_heuristic)で判定できない場合は、modeが"llm"であれば速いmodelに分類させ、
+    それ以外の場合や分類に失敗した場合は、agentで応答します(Toolが必要な発言を取りこぼさないように)。
+    """
+
+    def __init__(
+        self, mode: RouterMode = ROUTER_MODE, classifier: "Runnable | None" = None
+    ) -> None:
+        """
+        :param mode: 振り分けの方式
+        :param classifier: {"input", "chat_history"}を受け取り、"agent"か"chat"を返すChain
+        """
+        self.mode = mode
+        self.classifier = classifier
+
+    async def route(self, user_input: str, chat_history: list["BaseMessage"]) -> Route:
+        """
+        振り分け先を決める
+
+        :param user_input: ユーザーからの入力
+        :param chat_history: このセッションの会話の履歴
+        """
+        start = time.perf_counter()
+        if self.mode == "off":
+            route, classifier = "agent", "off"
+        else:
+            heuristic = classify_heuristic(user_input, chat_history)
+            if heuristic is not None:
+                route, classifier = heuristic, "heuristic"
+            elif self.mode == "llm" and self.classifier is not None:
+                route, classifier = await self._classify_llm(user_input, chat_history), "llm"
+            else:
+                route, classifier = "agent", "default"
+
+        ROUTE_DECISIONS_TOTAL.inc(route=route, classifier=classifier)
+        ROUTE_DECISION_SECONDS.observe(time.perf_counter() - start, classifier=classifier)
+        return route  # type: ignore[return-value]
+
+    async def _classify_llm(self, user_input: str, chat_history: list["BaseMessage"]) -> Route:
+        try:
+            async with asyncio.timeout(ROUTER_LLM_TIMEOUT):
+                answer: str = await self.classifier.ainvoke(  # type: ignore[union-attr]
+                    {"input": user_input, "chat_history": chat_history}
+                )
+        except Exception as e:
+            logger.warning(f"[Router Error] LLMで分類出来ませんでした。\n{e.__class__.__name__}: {e}")
+            return "agent"
+        return "chat" if answer.strip().lower().startswith("chat") else "agent"
@@ -0,0 +1,225 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+from abc import ABC, abstractmethod
+from typing import Any, Protocol
+
+import env_setup  # noqa: F401  環境変数の読み込み
+from caching import MISSING, TTLCache
+
+# ---------- 初期化処理 ---------- #
+# 会話の履歴の保存先。"memory" | "sqlite" | "redis"
+SESSION_STORE = os.environ.get("TRIPAL_SESSION_STORE", "memory")
+# 最後の発言から、何秒間履歴を残すか
+SESSION_TTL = float(os.environ.get("TRIPAL_SESSION_TTL", "86400"))
+# "memory"の場合に保持するセッション数の上限
+SESSION_MAXSIZE = int(os.environ.get("TRIPAL_SESSION_MAXSIZE", "10000"))
+# "sqlite"の場合のfileのpath。複数のworkerで同じfileを共有する
+SESSION_DB_PATH = os.environ.get(
+    "TRIPAL_SESSION_DB",
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), "cache", "sessions.sqlite3"),
+)
+# "redis"の場合の接続先
+REDIS_URL = os.environ.get("TRIPAL_REDIS_URL", "redis://localhost:6379/0")
+# ------------------------------- #
+
+
+class SessionStore(ABC):
+    """
+    セッションIDごとに、会話の状態(履歴)を保存する場所のinterface
+
+    状態はJSONに変換できる辞書です。
+    プロセスの外に保存するものを使えば、/chatを複数のworkerやnodeで動かせます。
+    """
+
+    @abstractmethod
+    async def load(self, session_id: str) -> dict[str, Any] | None:
+        """
+        状態を取得する。存在しない場合はNoneを返す
+
+        :param session_id: セッションID
+        """
+
+    @abstractmethod
+    async def save(self, session_id: str, state: dict[str, Any]) -> None:
+        """
+        状態を保存する
+
+        :param session_id: セッションID
+        :param state: 保存する状態
+        """
+
+    @abstractmethod
+    async def delete(self, session_id: str) -> None:
+        """
+        状態を削除する
+
+        :param session_id: セッションID
+        """
+
+
+class InMemorySessionStore(SessionStore):
+    """
+    プロセスのメモリ上に保存するSessionStore
+
+    1つのworkerで動かす場合や、開発用です。
+    """
+
+    def __init__(self, ttl: float = SESSION_TTL, maxsize: int = SESSION_MAXSIZE) -> None:
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def load(self, session_id: str) -> dict[str, Any] | None:
+        value = self._cache.get(session_id)
+        return None if value is MISSING else json.loads(value)
+
+    async def save(self, session_id: str, state: dict[str, Any]) -> None:
+        self._cache.set(session_id, json.dumps(state, ensure_ascii=False))
+
+    async def delete(self, session_id: str) -> None:
+        self._cache.delete(session_id)
+
+
+class SQLiteSessionStore(SessionStore):
+    """
+    SQLiteのfileに保存するSessionStore
+
+    同じhostの複数のworkerで、1つのfileを共有できます。
+    SQLiteへのアクセスはthreadで行い、event loopを止めないようにしています。
+    """
+
+    def __init__(self, path: str = SESSION_DB_PATH, ttl: float = SESSION_TTL) -> None:
+        self.path = path
+        self.ttl = ttl
+        self._conn: sqlite3.Connection | None = None
+        self._lock = threading.Lock()
+
+    # 初回利用時にのみ接続する
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+            conn = sqlite3.connect(self.path, check_same_thread=False, timeout=5.0)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions ("
+                " session_id TEXT PRIMARY KEY,"
+                " state TEXT NOT NULL,"
+                " expires_at REAL NOT NULL)"
+            )
+            conn.commit()
+            self._conn = conn
+        return self._conn
+
+    def _load(self, session_id: str) -> str | None:
+        with self._lock:
+            row = (
+                self._connect()
+                .execute(
+                    "SELECT state FROM sessions WHERE session_id = ? AND expires_at > ?",
+                    (session_id, time.time()),
+                )
+                .fetchone()
+            )
+        return None if row is None else row[0]
+
+    def _save(self, session_id: str, state: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute(
+                "INSERT OR REPLACE INTO sessions (session_id, state, expires_at)"
+                " VALUES (?, ?, ?)",
+                (session_id, state, time.time() + self.ttl),
+            )
+            # 期限切れのものはついでに削除する
+            conn.execute("DELETE FROM sessions WHERE expires_at <= ?", (time.time(),))
+            conn.commit()
+
+    def _delete(self, session_id: str) -> None:
+        with self._lock:
+            conn = self._connect()
+            conn.execute("DELETE FROM sessions WHERE session_id = ?", (session_id,))
+            conn.commit()
+
+    async def load(self, session_id: str) -> dict[str, Any] | None:
+        value = await asyncio.to_thread(self._load, session_id)
+        return None if value is None else json.loads(value)
+
+    async def save(self, session_id: str, state: dict[str, Any]) -> None:
+        await asyncio.to_thread(
+            self._save, session_id, json.dumps(state, ensure_ascii=False)
+        )
+
+    async def delete(self, session_id: str) -> None:
+        await asyncio.to_thread(self._delete, session_id)
+
+
+class RedisLikeClient(Protocol):
+    """
+    RedisSessionStoreが必要とするclientのinterface
+
+    redis.asyncio.Redisや、同じmethodを持つローカルの代替実装が満たします。
+    """
+
+    async def get(self, name: str) -> bytes | str | None: ...
+
+    async def set(self, name: str, value: str, ex: int | None = None) -> Any: ...
+
+    async def delete(self, *names: str) -> Any: ...
+
+
+class RedisSessionStore(SessionStore):
+    """
+    Redis(互換のserver)に保存するSessionStore
+
+    複数のnodeから同じ履歴を参照できるため、sticky sessionなしで水平にscaleできます。
+    """
+
+    def __init__(
+        self,
+        client: RedisLikeClient,
+        ttl: float = SESSION_TTL,
+        prefix: str = "tripal:session:",
+    ) -> None:
+        self._client = client
+        self.ttl = ttl
+        self.prefix = prefix
+
+    async def load(self, session_id: str) -> dict[str, Any] | None:
+        value = await self._client.get(self.prefix + session_id)
+        return None if value is None else json.loads(value)
+
+    async def save(self, session_id: str, state: dict[str, Any]) -> None:
+        await self._client.set(
+            self.prefix + session_id,
+            json.dumps(state, ensure_ascii=False),
+            ex=int(self.ttl),
+        )
+
+    async def delete(self, session_id: str) -> None:
+        await self._client.delete(self.prefix + session_id)
+
+
+def create_session_store(kind: str = SESSION_STORE) -> SessionStore:
+    """
+    TRIPAL_SESSION_STOREの設定に従って、SessionStoreを作成する
+
+    :param kind: "memory" | "sqlite" | "redis"
+    """
+    if kind == "memory":
+        return InMemorySessionStore()
+    if kind == "sqlite":
+        return SQLiteSessionStore()
+    if kind == "redis":
+        # redisを使う場合のみ必要なので、ここでimportする
+        try:
+            from redis.asyncio import Redis
+        except ImportError as e:
+            raise RuntimeError(
+                'TRIPAL_SESSION_STORE="redis" requires the "redis" package. '
+                "Please run `pip install redis`."
+            ) from e
+        return RedisSessionStore(Redis.from_url(REDIS_URL))
+
+    raise ValueError(f"Unknown TRIPAL_SESSION_STORE: {kind}")
@@ -4,7 +4,12 @@ import { marked } from "https://cdn.jsdelivr.net/npm/marked/lib/marked.esm.js";
 
 // LocalとAzureでURLを切り替える
 const WebSocketURL = window.location.hostname === "127.0.0.1" || window.location.hostname === "0.0.0.0" ? "ws://127.0.0.1:8000" : "wss://tripal-ca.greenbay-9762fead.japaneast.azurecontainerapps.io";
-const ws = new WebSocket(WebSocketURL + "/chat");
+// セッションIDをtabごとに保存し、再読み込みや再接続でも同じ会話の履歴を使う
+const SESSION_ID_KEY = "tripal_session_id";
+const sessionId = sessionStorage.getItem(SESSION_ID_KEY);
+const ws = new WebSocket(
+  WebSocketURL + "/chat" + (sessionId ? "?session_id=" + encodeURIComponent(sessionId) : "")
+);
 
 console.log("WebSocketURL: ", WebSocketURL);
 // ------------------------------
@@ -21,6 +26,21 @@ ws.onclose = function () {
   );
 };
 
+// 応答以外のframe(セッションIDの通知など)を処理する
+// 処理した場合はtrueを返す
+function handleControlFrame(frame) {
+  if (frame.type === "session") {
+    sessionStorage.setItem(SESSION_ID_KEY, frame.session_id);
+    return true;
+  }
+  return false;
+}
+
+// 最初のメッセージを送信するまでは、応答以外のframeのみを受け取る
+ws.onmessage = function (event) {
+  handleControlFrame(JSON.parse(event.data));
+};
+
 ws.onerror = function (err) {
   console.error("Socket encountered error: ", err.message, "Closing socket");
   addMessage(
@@ -73,26 +93,77 @@ typingArea.addEventListener("submit", (event) => {
   // chatAreaの子要素としてchatIOElementを追加
   chatArea.appendChild(chatIOElement);
 
-  // Markdownパース用の変数を初期化
-  let mdParse = "";
+  // 受信した応答を少しずつ表示するtypewriterを作成
+  const typewriter = createTypewriter(chatDetailsElement);
 
   // WebSocketからメッセージを受信したときの処理
+  // サーバーからは {"type": "delta" | "end" | "error", "text": "..."} の形式で届く
+  // 混雑している場合は、先に {"type": "queue", "position": 何番目} が届く
   ws.onmessage = function (event) {
-    // 受信したメッセージをchatDetailsElementに追加
-    chatDetailsElement.innerHTML += event.data;
+    const frame = JSON.parse(event.data);
+    if (handleControlFrame(frame)) {
+      return;
+    }
 
-    // Markdownパース用の変数に受信したメッセージを追加
-    mdParse += event.data;
+    if (frame.type === "queue") {
+      // 混雑していて順番待ちのときは、何番目かを表示する(応答が届いたら上書きされる)
+      chatDetailsElement.textContent =
+        "ただいま混み合っています。順番待ち: " + frame.position + "番目";
+      return;
+    }
 
-    // 受信したメッセージに改行が含まれている場合、Markdownパースを行う
-    if (event.data.includes("\n")) {
-      chatDetailsElement.innerHTML = marked.parse(mdParse);
+    if (frame.type === "delta" || frame.type === "error") {
+      // 受信したテキストを表示待ちに追加
+      typewriter.push(frame.text);
     }
+  };
+});
+
+// 1フレームで表示する文字数の下限
+const TYPING_MIN_CHARS_PER_FRAME = 1;
+// 表示待ちの文字を、おおよそ何フレームで表示し終えるか
+// サーバーはtokenをまとめて送ってくるので、溜まった量に応じて表示を速める
+const TYPING_CATCHUP_FRAMES = 20;
+
+// 受信したテキストを少しずつ表示する(タイピング風の演出)
+// 以前はサーバー側で1tokenごとに0.03秒待っていたが、その演出をclient側で行う
+function createTypewriter(element) {
+  // まだ表示していない文字
+  let pending = [];
+  // Markdownパース用の変数(表示済みの文字)
+  let mdParse = "";
+  // アニメーション中かどうか
+  let running = false;
+
+  function step() {
+    const count = Math.max(
+      TYPING_MIN_CHARS_PER_FRAME,
+      Math.ceil(pending.length / TYPING_CATCHUP_FRAMES)
+    );
+    mdParse += pending.splice(0, count).join("");
+    element.innerHTML = marked.parse(mdParse);
 
     // 新しいメッセージが追加されたので、handleNewMessage関数を呼び出す
     handleNewMessage();
+
+    if (pending.length > 0) {
+      requestAnimationFrame(step);
+    } else {
+      running = false;
+    }
+  }
+
+  return {
+    push(text) {
+      // サロゲートペア(絵文字など)を壊さないように、1文字ずつに分割
+      pending.push(...Array.from(text));
+      if (!running) {
+        running = true;
+        requestAnimationFrame(step);
+      }
+    },
   };
-});
+}
 
 // メッセージをチャットエリアに追加する関数
 function addMessage(sender, message) {
@@ -0,0 +1,128 @@
+import asyncio
+import os
+import time
+from dataclasses import dataclass, field
+from typing import AsyncIterator, Awaitable, Callable
+
+import env_setup  # noqa: F401  環境変数の読み込み
+
+# ---------- 初期化処理 ---------- #
+# tokenをまとめて1つのframeにする時間幅(秒)。0にするとtokenごとに送信する
+STREAM_FLUSH_INTERVAL = float(os.environ.get("TRIPAL_STREAM_FLUSH_INTERVAL", "0.05"))
+# 1つのframeに詰めるtokenの最大byte数(UTF-8)
+STREAM_MAX_FRAME_BYTES = int(os.environ.get("TRIPAL_STREAM_MAX_FRAME_BYTES", "1024"))
+# frameを送信した後に待つ時間(秒)。0なら人工的な遅延はなし
+# タイピング風の演出はclient側(index.js)で行うため、基本的には0で良い
+STREAM_PACING = float(os.environ.get("TRIPAL_STREAM_PACING", "0"))
+# ------------------------------- #
+
+# Queueの終端を示す値
+_END = object()
+
+
+@dataclass
+class StreamStats:
+    """
+    1ターン分の送信結果の統計
+    """
+
+    tokens: int = 0
+    frames: int = 0
+    bytes: int = 0
+    # 最初のframeを送信するまでの時間(秒)
+    first_frame: float | None = None
+    # 全てのframeを送信し終えるまでの時間(秒)
+    elapsed: float = 0.0
+    _start: float = field(default_factory=time.perf_counter, repr=False)
+
+    @property
+    def tokens_per_sec(self) -> float:
+        return self.tokens / self.elapsed if self.elapsed > 0 else 0.0
+
+
+async def send_coalesced(
+    send: Callable[[str], Awaitable[None]],
+    tokens: AsyncIterator[str],
+    flush_interval: float = STREAM_FLUSH_INTERVAL,
+    max_frame_bytes: int = STREAM_MAX_FRAME_BYTES,
+    pacing: float = STREAM_PACING,
+) -> StreamStats:
+    """
+    tokenのasync iteratorを読み、時間幅とbyte数でまとめてから送信する。
+
+    tokenの受信はbackgroundのtaskで行うため、送信中に届いたtokenは次のframeにまとめられます。
+    最初のtokenが届いてからflush_interval秒経つか、max_frame_bytesを超えた時点でframeを送信します。
+
+    :param send: 1つのframe(文字列)を送信する関数
+    :param tokens: 送信するtokenのasync iterator
+    :param flush_interval: tokenをまとめる時間幅(秒)
+    :param max_frame_bytes: 1つのframeの最大byte数
+    :param pacing: frameを送信した後に待つ時間(秒)
+    """
+    stats = StreamStats()
+    loop = asyncio.get_running_loop()
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def _receive() -> None:
+        try:
+            async for token in tokens:
+                queue.put_nowait(token)
+        finally:
+            queue.put_nowait(_END)
+
+    receiver = asyncio.create_task(_receive())
+    try:
+        ended = False
+        while not ended:
+            # frameの最初のtokenは、届くまで待つ
+            token = await queue.get()
+            if token is _END:
+                break
+
+            buffer = [token]
+            size = len(token.encode())
+            deadline = loop.time() + flush_interval
+
+            while size < max_frame_bytes:
+                # すでに届いているtokenは待たずにまとめる
+                try:
+                    token = queue.get_nowait()
+                except asyncio.QueueEmpty:
+                    if loop.time() >= deadline:
+                        break
+                    try:
+                        async with asyncio.timeout_at(deadline):
+                            token = await queue.get()
+                    except TimeoutError:
+                        break
+
+                if token is _END:
+                    ended = True
+                    break
+                buffer.append(token)
+                size += len(token.encode())
+
+            await send("".join(buffer))
+
+            stats.tokens += len(buffer)
+            stats.frames += 1
+            stats.bytes += size
+            if stats.first_frame is None:
+                stats.first_frame = time.perf_counter() - stats._start
+
+            if pacing > 0:
+                await asyncio.sleep(pacing)
+
+        # 受信側で発生したerrorはここで送出される
+        await receiver
+    finally:
+        if not receiver.done():
+            receiver.cancel()
+            await asyncio.wait([receiver])
+        # generatorの後処理(Chainの停止など)を確実に行う
+        aclose = getattr(tokens, "aclose", None)
+        if aclose is not None:
+            await aclose()
+
+    stats.elapsed = time.perf_counter() - stats._start
+    return stats
@@ -1,59 +1,351 @@
-import logging
+import asyncio
+import contextvars
+import functools
+import json
 import os
-from logging import FileHandler, Formatter, StreamHandler, getLogger
-from typing import AsyncGenerator, AsyncIterator
+import time
+from logging import getLogger
+from typing import Any, AsyncGenerator, AsyncIterator, Callable, Literal
 
-from dotenv import find_dotenv, load_dotenv
 from langchain.agents import AgentExecutor
-from langchain.agents.format_scratchpad import format_to_openai_function_messages
-from langchain.agents.output_parsers import OpenAIFunctionsAgentOutputParser
-from langchain.memory import ConversationBufferMemory
+from langchain.agents.format_scratchpad.openai_tools import format_to_openai_tool_messages
+from langchain.agents.output_parsers.openai_tools import OpenAIToolsAgentOutputParser
 from langchain.prompts import ChatPromptTemplate, MessagesPlaceholder
+from langchain_core.callbacks import AsyncCallbackHandler
+from langchain_core.agents import AgentAction, AgentFinish
+from langchain_core.messages import BaseMessage
+from langchain_core.output_parsers import StrOutputParser
+from langchain_core.runnables import Runnable, RunnableBranch, RunnableLambda
 from langchain_core.tools import StructuredTool, ToolException
 from langchain_core.tracers import RunLogPatch
-from langchain_core.utils.function_calling import convert_to_openai_function
+from langchain_core.utils.function_calling import convert_to_openai_tool
 from langchain_openai import AzureChatOpenAI
 
-from func_call_tools.reservations import TravelReservationSchema, get_reserve_location
-from func_call_tools.suggestions import TravelProposalSchema, get_trip_suggestions_info
+import env_setup  # noqa: F401  環境変数の読み込み
+from chat_memory import TokenBudgetMemory, count_text_tokens
+from func_call_tools.reservations import TravelReservationSchema, aget_reserve_location
+from func_call_tools.shaping import shape_output
+from func_call_tools.suggestions import TravelProposalSchema, aget_trip_suggestions_info
 from llm_prompts import (
+    get_budget_exhausted_prompt,
+    get_chat_prompt,
+    get_router_prompt,
+    get_summary_prompt,
     get_system_prompt,
     get_trip_reservation_desc,
     get_trip_suggestion_desc,
     prompt_injection_defense,
 )
+from log_setup import common_logger
+from metrics import (
+    AGENT_BUDGET_EXHAUSTED_TOTAL,
+    AGENT_ITERATIONS,
+    ROUTE_COMPLETION_TOKENS,
+    ROUTE_FIRST_TOKEN_SECONDS,
+    ROUTE_PROMPT_TOKENS,
+    ROUTE_TURN_SECONDS,
+    TURN_DURATION_SECONDS,
+    TURN_FIRST_TOKEN_SECONDS,
+    TURN_TOKENS_PER_SECOND,
+    TURN_TOOL_FAILURES,
+    TURN_TOOL_RETRIES,
+    TURNS_TOTAL,
+    track_tool,
+)
+from prefetch import SpeculativePrefetch
+from response_cache import ResponseCache, response_cache
+from router import ModelRouter, Route
+from session_store import SessionStore
 
 # ---------- 初期化処理 ---------- #
-# directoryをsrcに変更
-os.chdir(os.path.dirname(os.path.abspath(__file__)))
-# 環境変数をロード
-load_dotenv(find_dotenv())
 # ---Logの出力---
+# handlerはlog_setupで設定する(queueを介してbackgroundのthreadで書き込む)
 logger = getLogger(__name__)
-logger.setLevel(logging.ERROR)
-# handlerの設定
-# StreamHandler
-stream_handler = StreamHandler()
-stream_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s %(message)s"))
-stream_handler.setLevel(logging.ERROR)
-logger.addHandler(stream_handler)
-# FileHandler
-file_handler = FileHandler(filename="logs/tripalgpt.log")
-file_handler.setFormatter(Formatter("[%(levelname)s] %(asctime)s\n" + "%(message)s"))
-file_handler.setLevel(logging.ERROR)
-logger.addHandler(file_handler)
+
+# ---Streamingの方式---
+# "callback": LLMのtokenをcallbackから直接Queueに流す(default)
+# "astream_log": astream_logのRunLogPatchを整形して取り出す(従来の方式)
+StreamMode = Literal["callback", "astream_log"]
+STREAM_MODE: StreamMode = os.environ.get("TRIPAL_STREAM_MODE", "callback")  # type: ignore[assignment]
+
+# ---Agentの1ターンの予算---
+# 使い切った場合は、Toolを呼び出さずに、それまでのToolの結果から回答する
+# LLMの呼び出し回数の上限(最後の回答を含む)
+AGENT_MAX_ITERATIONS = int(os.environ.get("TRIPAL_AGENT_MAX_ITERATIONS", "4"))
+# Toolの呼び出し回数の上限
+AGENT_MAX_TOOL_CALLS = int(os.environ.get("TRIPAL_AGENT_MAX_TOOL_CALLS", "6"))
+# Toolを呼び出せる時間の上限(秒)。超えた後は、最後の回答の生成のみ行う
+AGENT_MAX_EXECUTION_TIME = float(os.environ.get("TRIPAL_AGENT_MAX_EXECUTION_TIME", "30.0"))
+# 時間の予算を使い切った後の、最後の回答の生成にかける時間(秒)
+# AgentExecutorのmax_execution_timeは、AGENT_MAX_EXECUTION_TIMEにこれを足したものにする
+AGENT_FINAL_ANSWER_TIME = float(os.environ.get("TRIPAL_AGENT_FINAL_ANSWER_TIME", "15.0"))
+
+# 予算を使い切り、LLMでも回答できなかった場合に、Toolの結果の一覧に付ける文章
+PARTIAL_ANSWER_HEADER = "時間内に全ては調べきれなかったため、ここまでに見つかった情報をお伝えします。"
+PARTIAL_ANSWER_EMPTY = (
+    "申し訳ありません。時間内に情報を見つけられませんでした。"
+    "目的地・日程・予算などの条件を変えて、もう一度お試しください。"
+)
+PARTIAL_ANSWER_HEADINGS = {
+    "Location_Information": "観光スポット・レストラン",
+    "Reservation_Information": "宿泊施設",
+}
+# 一覧に載せる、1つのToolの結果あたりの件数
+PARTIAL_ANSWER_MAX_ITEMS = 5
+# AgentExecutorがmax_iterationsで止めた場合の出力の先頭
+AGENT_STOPPED_PREFIX = "Agent stopped due to"
+
+# Toolの結果(文字列)が失敗を示すものかどうかの判定に使う、先頭の文字列
+TOOL_FAILURE_PREFIXES = (
+    "[ToolException]",
+    "情報が取得出来ませんでした",
+    "検索したい場所を入力してください",
+)
+# 時間の予算を使い切ったため、途中で止めたToolの結果
+TOOL_TIMEOUT_OUTPUT = "情報が取得出来ませんでした。時間内に応答がありませんでした。"
+
+# このターンでToolを呼び出せる期限(time.monotonic())
+# Toolは全てのセッションで共有しているので、ターンごとの期限はcontextvarで渡す
+_tool_deadline: contextvars.ContextVar[float | None] = contextvars.ContextVar(
+    "tool_deadline", default=None
+)
 
 # ------------------------------- #
 
 
-class TriPalGPT:
+# Toolsのエラーハンドリングする関数
+def _handle_tool_error(error: ToolException) -> str:
+    error_msg = f"""
+        [ToolException]
+        The following errors occurred during tool execution:\n
+        {error.args[0]}\n
+        Please try another tool or let the user type again!
     """
-    Azure Chat OpenAI による旅行の計画を提案するクラス
+    # errorをログに出力
+    logger.exception(error_msg)
+
+    return error_msg
+
+
+# Toolとして呼び出す関数を作成する
+def _tool_function(name: str, func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    Toolの関数に、出力の整形(不要な値の除去・token数の制限)と所要時間の計測を加える
+
+    :param name: Toolの名前
+    :param func: Toolの関数(非同期版)
+    """
+    tool_function = track_tool(name, is_failure=_is_failed_tool_output)(
+        shape_output(name)(func)
+    )
+    return _with_deadline(tool_function)
+
+
+def _with_deadline(func: Callable[..., Any]) -> Callable[..., Any]:
+    """
+    非同期版のToolの関数を、このターンの期限(_tool_deadline)までで止めるようにする
+
+    期限を過ぎた場合は、失敗を示す結果を返します。その後agentは、それまでの結果から回答します。
+
+    :param func: Toolの関数(非同期版)
+    """
+
+    @functools.wraps(func)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
+        deadline = _tool_deadline.get()
+        if deadline is None:
+            return await func(*args, **kwargs)
+        try:
+            return await asyncio.wait_for(
+                func(*args, **kwargs), timeout=max(deadline - time.monotonic(), 0)
+            )
+        except TimeoutError:
+            logger.warning(f"[Tool Timeout] {func.__name__} {kwargs}")
+            return TOOL_TIMEOUT_OUTPUT
+
+    return wrapper
+
+
+class _TokenQueueHandler(AsyncCallbackHandler):
+    """
+    LLMが生成したtokenを、そのままasyncio.Queueに流すcallback handler
+
+    astream_logのようにrun logを作成・diffしないため、tokenごとのコストが小さくなります。
+    """
+
+    def __init__(self, queue: asyncio.Queue[str | None]) -> None:
+        self._queue = queue
+
+    async def on_llm_new_token(self, token: str, **kwargs: Any) -> None:
+        # tool callの引数などは空白のtokenとして流れてくるので無視する
+        if token != "":
+            self._queue.put_nowait(token)
+
+
+def _count_llm_rounds(intermediate_steps: list[tuple[AgentAction, Any]]) -> int:
+    """
+    Toolを呼び出したLLMの応答の数を数える
+
+    1回の応答で複数のToolを呼び出した場合、それらのactionは同じmessageを持っています。
+
+    :param intermediate_steps: AgentExecutorの途中経過
+    """
+    messages = {
+        id(action.message_log[0]) if getattr(action, "message_log", None) else id(action)
+        for action, _ in intermediate_steps
+    }
+    return len(messages)
+
+
+def _is_failed_tool_output(output: Any) -> bool:
+    """
+    Toolの結果が、agentに失敗を伝えるもの(エラー・検索結果なし)かどうか
+
+    :param output: Toolの結果(整形後)
+    """
+    if isinstance(output, dict):
+        return "Error" in output
+    if isinstance(output, str):
+        return output.lstrip().startswith(TOOL_FAILURE_PREFIXES)
+    return False
+
+
+def _count_tool_failures(
+    intermediate_steps: list[tuple[AgentAction, Any]]
+) -> tuple[int, int]:
+    """
+    1ターンのToolの呼び出しのうち、失敗した数と、失敗したToolを呼び直した数を数える
+
+    :param intermediate_steps: AgentExecutorの途中経過
+    """
+    failures = 0
+    retries = 0
+    failed_tools: set[str] = set()
+    for action, output in intermediate_steps:
+        if action.tool in failed_tools:
+            retries += 1
+        if _is_failed_tool_output(output):
+            failures += 1
+            failed_tools.add(action.tool)
+        else:
+            failed_tools.discard(action.tool)
+    return failures, retries
+
+
+def _exhausted_budget(agent_input: dict[str, Any]) -> str | None:
+    """
+    Agentの1ターンの予算のうち、使い切ったものの名前を返す。残っていればNone
+
+    次のLLMの呼び出しの前に確認します。
+    1回の応答で複数のToolが呼び出された場合は、上限を超えた分も実行されます。
+    実行中のToolは、期限を過ぎると_with_deadline()で止められます。
+
+    :param agent_input: Agentの入力(intermediate_stepsと、期限のdeadlineを含む)
+    """
+    intermediate_steps = agent_input["intermediate_steps"]
+    if not intermediate_steps:
+        return None
+    if _count_llm_rounds(intermediate_steps) + 1 >= AGENT_MAX_ITERATIONS:
+        return "iterations"
+    if len(intermediate_steps) >= AGENT_MAX_TOOL_CALLS:
+        return "tool_calls"
+    deadline = agent_input.get("deadline")
+    if deadline is not None and time.monotonic() >= deadline:
+        return "time"
+    return None
+
+
+def _record_budget_exhausted(agent_input: dict[str, Any]) -> dict[str, Any]:
+    budget = _exhausted_budget(agent_input)
+    AGENT_BUDGET_EXHAUSTED_TOTAL.inc(budget=budget)
+    common_logger.info(
+        "agent_budget_exhausted",
+        extra={"budget": budget, "tool_calls": len(agent_input["intermediate_steps"])},
+    )
+    return agent_input
+
+
+def _partial_answer(agent_input: dict[str, Any]) -> AgentFinish:
+    """
+    LLMを使わずに、それまでのToolの結果(見つかった場所の名前)の一覧から回答を作成する
+
+    予算を使い切った後の回答の生成にも失敗した場合に利用します。
+
+    :param agent_input: Agentの入力
+    """
+    sections: list[str] = []
+    for action, output in agent_input["intermediate_steps"]:
+        if not isinstance(output, dict) or _is_failed_tool_output(output):
+            continue
+        names = [
+            name
+            for name, info in output.items()
+            if isinstance(info, dict) and name != "data_freshness"
+        ][:PARTIAL_ANSWER_MAX_ITEMS]
+        if names:
+            heading = PARTIAL_ANSWER_HEADINGS.get(action.tool, action.tool)
+            sections.append(f"**{heading}**\n" + "\n".join(f"- {name}" for name in names))
+
+    if not sections:
+        output_text = PARTIAL_ANSWER_EMPTY
+    else:
+        output_text = "\n\n".join([PARTIAL_ANSWER_HEADER, *sections])
+    return AgentFinish(return_values={"output": output_text}, log=output_text)
+
+
+class _TurnMetrics:
+    """
+    1ターン分の、最初のtokenまでの時間・所要時間・秒間token数を記録する
+    """
+
+    def __init__(self) -> None:
+        self.start = time.perf_counter()
+        # "llm" | "cache"
+        self.source = "llm"
+        # LLMで応答した場合の振り分け先(cacheから応答した場合はNone)
+        self.route: Route | None = None
+        self.tokens = 0
+        self.first_token_at: float | None = None
+
+    def on_token(self) -> None:
+        if self.first_token_at is None:
+            self.first_token_at = time.perf_counter()
+            TURN_FIRST_TOKEN_SECONDS.observe(
+                self.first_token_at - self.start, source=self.source
+            )
+            if self.route is not None:
+                ROUTE_FIRST_TOKEN_SECONDS.observe(
+                    self.first_token_at - self.start, route=self.route
+                )
+        self.tokens += 1
+
+    def finish(self, status: str) -> None:
+        TURNS_TOTAL.inc(source=self.source, status=status)
+        if status != "ok":
+            return
+        end = time.perf_counter()
+        TURN_DURATION_SECONDS.observe(end - self.start, source=self.source)
+        if self.route is not None:
+            ROUTE_TURN_SECONDS.observe(end - self.start, route=self.route)
+            ROUTE_COMPLETION_TOKENS.observe(self.tokens, route=self.route)
+        if self.first_token_at is not None and end > self.first_token_at:
+            TURN_TOKENS_PER_SECOND.observe(
+                self.tokens / (end - self.first_token_at), source=self.source
+            )
+
+
+class TriPalEngine:
+    """
+    全てのWebSocketセッションで共有する、LLM client・prompt・Toolsを保持するクラス
+
+    AzureChatOpenAIは内部にkeep-aliveなHTTP connection poolを持っているため、
+    プロセスで1つだけ作成し、接続ごとのTLS handshakeや初期化処理を省きます。
+    会話の状態は持たないので、複数のセッションから同時に利用できます。
     """
 
     def __init__(self) -> None:
 
-        self._model_16k = AzureChatOpenAI(
+        self.model_16k = AzureChatOpenAI(
             openai_api_key=os.environ.get("AZURE_OPENAI_API_KEY"),  # API key
             deployment_name=os.environ.get(
                 "AZURE_OPENAI_API_DEPLOYMENT"
@@ -69,7 +361,26 @@ class TriPalGPT:
             streaming=True,
         )
 
-        self._prompt = ChatPromptTemplate.from_messages(
+        # 雑談や確認の質問に答える、Toolなしの速いmodel
+        # deploymentを指定しない場合は、16kと同じdeploymentを利用する
+        self.model_fast = AzureChatOpenAI(
+            openai_api_key=os.environ.get("AZURE_OPENAI_API_KEY"),  # API key
+            deployment_name=os.environ.get(
+                "AZURE_OPENAI_API_FAST_DEPLOYMENT",
+                default=os.environ.get("AZURE_OPENAI_API_DEPLOYMENT"),
+            ),  # deployment name
+            azure_endpoint=os.environ.get("AZURE_OPENAI_API_BASE"),  # endpoint (URL)
+            openai_api_version=os.environ.get(
+                "AZURE_OPENAI_API_VERSION", default="2024-02-15-preview"
+            ),  # API version
+            model_name=os.environ.get("AZURE_OPENAI_API_FAST_MODEL", default="gpt-35-turbo"),
+            openai_api_type="azure",  # API type
+            model_version="1.0.0",
+            temperature=1.0,
+            streaming=True,
+        )
+
+        self.prompt = ChatPromptTemplate.from_messages(
             [
                 # prompt injection対策
                 ("system", prompt_injection_defense()),
@@ -84,80 +395,223 @@ class TriPalGPT:
             ]
         )
 
-        # メモリーの初期化
-        self._memory = ConversationBufferMemory(
-            memory_key="chat_history", return_messages=True
+        # 予算を使い切った後の回答に使うprompt(Toolの結果の後に、回答を指示する)
+        self.final_prompt = ChatPromptTemplate.from_messages(
+            [
+                *self.prompt.messages,
+                ("system", get_budget_exhausted_prompt()),
+            ]
         )
 
         # function callingで利用するツールの初期化
-        # Toolsのエラーハンドリングする関数
-        def _handle_error(error: ToolException) -> str:
-            error_msg = f"""
-                [ToolException]
-                The following errors occurred during tool execution:\n
-                {error.args[0]}\n
-                Please try another tool or let the user type again!
-            """
-            # errorをログに出力
-            logger.exception(error_msg)
-
-            return error_msg
-
-        self._tools = [
+        # AgentExecutorは非同期で実行するので、coroutine(非同期版)のみを渡す
+        self.tools = [
             # 提案機能
             StructuredTool.from_function(
                 name="Location_Information",
-                func=get_trip_suggestions_info,
+                coroutine=_tool_function(
+                    "Location_Information", aget_trip_suggestions_info
+                ),
                 description=get_trip_suggestion_desc(),
                 args_schema=TravelProposalSchema,
-                handle_tool_error=_handle_error,
+                handle_tool_error=_handle_tool_error,
             ),
             StructuredTool.from_function(
                 name="Reservation_Information",
-                func=get_reserve_location,
+                coroutine=_tool_function(
+                    "Reservation_Information", aget_reserve_location
+                ),
                 description=get_trip_reservation_desc(),
                 args_schema=TravelReservationSchema,
-                handle_tool_error=_handle_error,
+                handle_tool_error=_handle_tool_error,
             ),
         ]
 
+        # Toolで定義した関数を、tool calling(tools=)で利用できるように変換する
+        # 毎ターン変換し直さないように、ここで一度だけ作成する
+        self.openai_tools = [convert_to_openai_tool(t) for t in self.tools]
+
+        # AgentExecutorもプロセスで1つだけ作成し、全てのセッションで使い回す
+        self.agent_executor = self._create_agent_executor()
+
+        # 古い履歴を要約するChain
+        self.summarizer = self._create_summarizer()
+
+        # 雑談や確認の質問に答えるChainと、ターンごとにmodelを振り分けるrouter
+        self.chat_chain = self._create_chat_chain()
+        self.router = ModelRouter(classifier=self._create_router_classifier())
+
+    # 履歴と入力以外の、毎ターン変わらない部分のtoken数(system promptとToolの定義)
+    # tokenizerの読み込みでEngineの作成を待たせないように、最初のターンで数える
+    @functools.cached_property
+    def static_prompt_tokens(self) -> dict[Route, int]:
+        return {
+            "agent": count_text_tokens(
+                prompt_injection_defense()
+                + get_system_prompt()
+                + json.dumps(self.openai_tools, ensure_ascii=False)
+            ),
+            "chat": count_text_tokens(prompt_injection_defense() + get_chat_prompt()),
+        }
+
     # AgentExecutorの作成
     def _create_agent_executor(self) -> AgentExecutor:
         """
         LangChainのLCELを利用して、AgentExecutor(Chain)を作成する。
 
-        Tools(Function calling)付きのChainになっています。
+        Tools(tool calling)付きのChainになっています。
+        1回の応答で複数のToolが呼び出された場合(parallel tool calls)、
+        AgentExecutorはそれらを同時に実行するため、LLMの往復が減ります。
+        (parallel tool callsには、1106以降のmodelのdeploymentが必要です)
+        1ターンのLLMの呼び出し回数・Toolの呼び出し回数・時間には予算があり、
+        使い切った場合は、Toolを呼び出さずにそれまでのToolの結果から回答します。
+        会話の履歴はセッションごとに異なるため、Chainには持たせず、
+        実行時に入力の"chat_history"として渡します。
         """
-        history = self._memory.load_memory_variables
-
-        # Toolで定義した関数を、Function callingで利用できるように変換する
-        model_with_tools = self._model_16k.bind(
-            functions=[convert_to_openai_function(t) for t in self._tools]
+        model_with_tools = self.model_16k.bind(tools=self.openai_tools)
+        # 予算を使い切った後は、Toolを呼び出せないようにして回答させる
+        # (toolsは同じものを渡し、それまでのtool callのmessageをそのまま使えるようにする)
+        model_without_tools = self.model_16k.bind(
+            tools=self.openai_tools, tool_choice="none"
         )
 
-        agent = (
-            {
-                "input": lambda x: x["input"],
-                "agent_scratchpad": lambda x: format_to_openai_function_messages(
-                    x["intermediate_steps"]
-                ),
-                # history(x)["chat_history"]は、memory.load_memory_variablesの戻り値の中から、historyの値を取り出す
-                # 詳細は"https://python.langchain.com/docs/expression_language/cookbook/memory"を参照
-                "chat_history": lambda x: history(x)["chat_history"],
-            }
-            | self._prompt
-            | model_with_tools
-            | OpenAIFunctionsAgentOutputParser()
+        # 予算を使い切った場合の、それまでのToolの結果から回答するChain
+        # 回答の生成に失敗した場合は、Toolの結果の一覧をそのまま返す
+        final_answer = (
+            RunnableLambda(_record_budget_exhausted)
+            | self.final_prompt
+            | model_without_tools
+            | OpenAIToolsAgentOutputParser()
+        ).with_fallbacks([RunnableLambda(_partial_answer)])
+
+        agent = {
+            "input": lambda x: x["input"],
+            "agent_scratchpad": lambda x: format_to_openai_tool_messages(
+                x["intermediate_steps"]
+            ),
+            # 履歴は実行時に渡されたものをそのまま利用する
+            "chat_history": lambda x: x["chat_history"],
+            # 予算の確認に利用する
+            "intermediate_steps": lambda x: x["intermediate_steps"],
+            "deadline": lambda x: x.get("deadline"),
+        } | RunnableBranch(
+            (lambda x: _exhausted_budget(x) is not None, final_answer),
+            self.prompt | model_with_tools | OpenAIToolsAgentOutputParser(),
         )
 
         agent_executor = AgentExecutor.from_agent_and_tools(
             agent=agent,
-            tools=self._tools,
+            tools=self.tools,
+            # Toolの呼び出しと結果も履歴に保存するため、途中経過も返す
+            return_intermediate_steps=True,
+            # 予算はagentの中で確認する。これらはagentが止まらなかった場合の保険
+            max_iterations=AGENT_MAX_ITERATIONS + 1,
+            max_execution_time=AGENT_MAX_EXECUTION_TIME + AGENT_FINAL_ANSWER_TIME,
             # verbose=True,  # 途中経過を表示(debug用)
         )
 
         return agent_executor
 
+    # 要約用のChainの作成
+    def _create_summarizer(self) -> Runnable:
+        """
+        これまでの要約と古いターンから、新しい要約を作成するChainを作成する。
+        """
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", get_summary_prompt()),
+                (
+                    "human",
+                    "Existing summary:\n{summary}\n\nNew conversation lines:\n{conversation}",
+                ),
+            ]
+        )
+        return prompt | self.model_16k.bind(temperature=0) | StrOutputParser()
+
+    # 雑談用のChainの作成
+    def _create_chat_chain(self) -> Runnable:
+        """
+        Toolを持たない、速いmodelで応答するChainを作成する。
+
+        挨拶・お礼や、前の応答についての確認の質問など、Toolが不要なターンで利用します。
+        Toolの定義とagent_scratchpadがない分、promptが短く、LLMの往復も1回で済みます。
+        """
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                # prompt injection対策
+                ("system", prompt_injection_defense()),
+                ("system", get_chat_prompt()),
+                MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+        return prompt | self.model_fast | StrOutputParser()
+
+    # LLMでmodelを振り分けるChainの作成
+    def _create_router_classifier(self) -> Runnable:
+        """
+        最後の発言を"agent"か"chat"に分類するChainを作成する(TRIPAL_ROUTER=llmの場合に利用)
+        """
+        prompt = ChatPromptTemplate.from_messages(
+            [
+                ("system", get_router_prompt()),
+                MessagesPlaceholder(variable_name="chat_history"),
+                ("human", "{input}"),
+            ]
+        )
+        return (
+            prompt
+            | self.model_fast.bind(temperature=0, max_tokens=2)
+            | StrOutputParser()
+        )
+
+
+# プロセス全体で共有するEngine
+_engine: TriPalEngine | None = None
+
+
+def get_tripal_engine() -> TriPalEngine:
+    """
+    プロセス全体で共有するTriPalEngineを取得する。
+
+    初回呼び出し時にのみ作成し、以降は同じインスタンスを返します。
+    """
+    global _engine
+    if _engine is None:
+        _engine = TriPalEngine()
+    return _engine
+
+
+class TriPalGPT:
+    """
+    Azure Chat OpenAI による旅行の計画を提案するクラス
+
+    1つのWebSocketセッションにつき1つ作成し、会話の履歴のみを保持します。
+    LLM clientやToolsは、共有のTriPalEngineのものを利用します。
+    storeを渡した場合は、毎ターンの始めに履歴を読み込み、終わりに保存します。
+    """
+
+    def __init__(
+        self,
+        engine: TriPalEngine | None = None,
+        stream_mode: StreamMode | None = None,
+        cache: ResponseCache | None = None,
+        session_id: str | None = None,
+        store: SessionStore | None = None,
+    ) -> None:
+
+        self._engine = engine if engine is not None else get_tripal_engine()
+        self._stream_mode = stream_mode if stream_mode is not None else STREAM_MODE
+        self._response_cache = cache if cache is not None else response_cache
+        self.session_id = session_id
+        self._store = store
+
+        # メモリーの初期化
+        # token数が上限を超えたら、古い履歴は要約にまとめる
+        self._memory = TokenBudgetMemory(
+            summarizer=self._engine.summarizer, on_summarized=self._persist_memory
+        )
+
     # streaming可能なgeneratorを返す
     def _fetch_astream_log(self, user_input: str) -> AsyncIterator[RunLogPatch]:
         """
@@ -165,9 +619,9 @@ class TriPalGPT:
 
         :param user_input: ユーザーからの入力
         """
-        # Chainの作成
-        chain = self._create_agent_executor()
-        user_input_dict = {"input": user_input}
+        # 共有のChainを利用し、このセッションの履歴を入力として渡す
+        chain = self._engine.agent_executor
+        user_input_dict = self._create_chain_input(user_input)
 
         try:
             # Chainを実行する。出力形式はStreaming
@@ -178,15 +632,90 @@ class TriPalGPT:
 
             raise RuntimeError("chainを実行出来ませんでした。 Please try again!") from e
 
+    # Chainに渡す入力を作成する
+    def _create_chain_input(
+        self, user_input: str, route: Route = "agent"
+    ) -> dict[str, Any]:
+        """
+        ユーザーの入力と、このセッションの履歴からChainの入力を作成する。
+
+        :param user_input: ユーザーからの入力
+        :param route: 応答するmodelの振り分け先
+        """
+        chat_history = self._load_memory()
+
+        # 履歴が長くなっても、promptのtoken数が増え続けていないかを確認するためのlog
+        history_tokens = self._memory.prompt_tokens()
+        input_tokens = count_text_tokens(user_input)
+        prompt_tokens = (
+            self._engine.static_prompt_tokens[route] + history_tokens + input_tokens
+        )
+        ROUTE_PROMPT_TOKENS.observe(prompt_tokens, route=route)
+        common_logger.info(
+            "prompt_tokens",
+            extra={
+                "route": route,
+                "prompt_tokens": prompt_tokens,
+                "history_tokens": history_tokens,
+                "input_tokens": input_tokens,
+                "memory": self._memory.stats(),
+            },
+        )
+
+        chain_input: dict[str, Any] = {"input": user_input, "chat_history": chat_history}
+        if route == "agent":
+            # Toolを呼び出せる期限
+            # agentは次のLLMの呼び出しの前に、Toolは実行中に確認する
+            deadline = time.monotonic() + AGENT_MAX_EXECUTION_TIME
+            chain_input["deadline"] = deadline
+            _tool_deadline.set(deadline)
+        return chain_input
+
+    # 履歴を取得する
+    def _load_memory(self) -> list[BaseMessage]:
+        """
+        このセッションの会話の履歴を取得する。
+        """
+        return self._memory.load_messages()
+
+    # SessionStoreから履歴を読み込む
+    async def _restore_memory(self) -> None:
+        """
+        SessionStoreに保存されている、このセッションの履歴を読み込む。
+
+        別のworkerやnodeで保存された履歴も、ここで読み込まれます。
+        """
+        if self._store is None or self.session_id is None:
+            return
+        state = await self._store.load(self.session_id)
+        if state is not None:
+            self._memory.load_dict(state)
+
+    # SessionStoreに履歴を保存する
+    async def _persist_memory(self) -> None:
+        """
+        このセッションの履歴をSessionStoreに保存する。
+        """
+        if self._store is None or self.session_id is None:
+            return
+        await self._store.save(self.session_id, self._memory.to_dict())
+
     # 履歴を保存する
-    def _save_memory(self, user_input: str, final_output: str) -> None:
+    def _save_memory(
+        self,
+        user_input: str,
+        final_output: str,
+        intermediate_steps: list[tuple[AgentAction, str]] | None = None,
+    ) -> None:
         """
-        ユーザーの入力と最終的な出力を履歴に保存する。
+        ユーザーの入力と最終的な出力、Toolの呼び出しと結果を履歴に保存する。
 
         :param user_input: ユーザーからの入力
         :param final_output: 保存する最終的な出力
+        :param intermediate_steps: AgentExecutorの途中経過(Toolの呼び出しと結果)
         """
-        self._memory.save_context({"input": user_input}, {"output": final_output})
+        tool_messages = format_to_openai_tool_messages(intermediate_steps or [])
+        self._memory.save_turn(user_input, final_output, tool_messages)
 
     # 応答を整形する
     def _format_astream_log(self, data: RunLogPatch) -> None | dict[str, str]:
@@ -225,12 +754,10 @@ class TriPalGPT:
         # patternに合致しない場合はNoneを返す
         return None
 
-    # 応答を取得する
-    async def get_async_generator_output(
-        self, user_input: str
-    ) -> AsyncGenerator[str, None]:
+    # astream_logを利用して応答を取得する(従来の方式)
+    async def _astream_log_output(self, user_input: str) -> AsyncGenerator[str, None]:
         """
-        ユーザーの入力をLLMに渡して、streaming形式のasync generatorを取得する。
+        astream_logのlogを整形して、tokenを1つずつ返すasync generator。
 
         :param user_input: ユーザーからの入力
         """
@@ -253,11 +780,165 @@ class TriPalGPT:
 
             yield format_res["stream_res"]
 
+    # callbackを利用して応答を取得する
+    async def _astream_callback_output(
+        self, user_input: str
+    ) -> AsyncGenerator[str, None]:
+        """
+        LLMのtokenをcallbackからQueueに受け取り、1つずつ返すasync generator。
+
+        Chainはbackgroundのtaskとして実行し、終了したらQueueにNoneを入れて知らせます。
+
+        :param user_input: ユーザーからの入力
+        """
+        chain = self._engine.agent_executor
+        user_input_dict = self._create_chain_input(user_input)
+
+        queue: asyncio.Queue[str | None] = asyncio.Queue()
+        handler = _TokenQueueHandler(queue)
+
+        async def _run_chain() -> dict[str, Any]:
+            try:
+                return await chain.ainvoke(
+                    input=user_input_dict, config={"callbacks": [handler]}
+                )
+            finally:
+                # 終了の合図
+                queue.put_nowait(None)
+
+        task = asyncio.create_task(_run_chain())
+        streamed: list[str] = []
+        try:
+            while (token := await queue.get()) is not None:
+                streamed.append(token)
+                yield token
+
+            result = await task
+        except Exception as e:
+            # エラーをログに出力
+            logger.exception(f"[Chain Error] chainを実行出来ませんでした。\n{e}")
+
+            raise RuntimeError("chainを実行出来ませんでした。 Please try again!") from e
+        finally:
+            # generatorが途中で閉じられた場合は、Chainも止める
+            if not task.done():
+                task.cancel()
+
+        # Toolを呼び出したLLMの応答の数 + 最終的な応答を生成した1回
+        intermediate_steps = result.get("intermediate_steps") or []
+
+        # LLMを使わずに回答した場合(予算を使い切った後の回答の生成に失敗した、
+        # またはAgentExecutorに止められた)は、tokenが流れていないのでここで返す
+        output: str = result["output"]
+        if output.startswith(AGENT_STOPPED_PREFIX):
+            output = _partial_answer({"intermediate_steps": intermediate_steps}).return_values[
+                "output"
+            ]
+        if not "".join(streamed).endswith(output):
+            yield f"\n\n{output}" if streamed else output
+        AGENT_ITERATIONS.observe(_count_llm_rounds(intermediate_steps) + 1)
+        failures, retries = _count_tool_failures(intermediate_steps)
+        TURN_TOOL_FAILURES.observe(failures)
+        TURN_TOOL_RETRIES.observe(retries)
+        if intermediate_steps:
+            common_logger.info(
+                "agent_tool_calls",
+                extra={
+                    "tool_calls": len(intermediate_steps),
+                    "tool_failures": failures,
+                    "tool_retries": retries,
+                },
+            )
+
+        # 履歴を保存
+        self._save_memory(user_input, output, intermediate_steps)
+
+    # Toolなしの速いmodelで応答を取得する
+    async def _chat_output(self, user_input: str) -> AsyncGenerator[str, None]:
+        """
+        雑談用のChainの応答を、tokenを1つずつ返すasync generator。
+
+        :param user_input: ユーザーからの入力
+        """
+        chain = self._engine.chat_chain
+        user_input_dict = self._create_chain_input(user_input, route="chat")
+
+        chunks: list[str] = []
+        try:
+            async for token in chain.astream(user_input_dict):
+                if token != "":
+                    chunks.append(token)
+                    yield token
+        except Exception as e:
+            # エラーをログに出力
+            logger.exception(f"[Chain Error] chainを実行出来ませんでした。\n{e}")
+
+            raise RuntimeError("chainを実行出来ませんでした。 Please try again!") from e
+
+        # 履歴を保存
+        self._save_memory(user_input, "".join(chunks))
 
-# import asyncio
-# async def main():
-#     async for output in TriPalGPT("aaaaa").get_async_generator_output(user_input="北海道のアクティビティを教えて"):
-#         print(output, end="")
+    # 応答を取得する
+    async def get_async_generator_output(
+        self, user_input: str
+    ) -> AsyncGenerator[str, None]:
+        """
+        ユーザーの入力をLLMに渡して、streaming形式のasync generatorを取得する。
 
-# if __name__ == "__main__":
-#     asyncio.run(main())
+        :param user_input: ユーザーからの入力
+        """
+        turn = _TurnMetrics()
+        prefetch = SpeculativePrefetch()
+        status = "error"
+        try:
+            # 他のworkerで更新されているかもしれないので、毎ターン読み込む
+            await self._restore_memory()
+
+            # 最初の発言であれば、cacheした応答をそのまま返す
+            cache_key = self._response_cache.make_key(user_input, self._load_memory())
+            if cache_key is not None:
+                cached = self._response_cache.get(cache_key)
+                if cached is not None:
+                    turn.source = "cache"
+                    async for token in self._response_cache.replay(cached):
+                        turn.on_token()
+                        yield token
+                    # 履歴を保存
+                    self._save_memory(user_input, cached.output)
+                    await self._persist_memory()
+                    status = "ok"
+                    return
+
+            # 雑談や確認の質問は、Toolなしの速いmodelで応答する
+            turn.route = await self._engine.router.route(user_input, self._load_memory())
+            if turn.route == "chat":
+                generator = self._chat_output(user_input)
+            else:
+                # LLMがToolを選んでいる間に、呼び出されそうな検索をcacheに入れておく
+                prefetch.start(user_input)
+
+                if self._stream_mode == "astream_log":
+                    generator = self._astream_log_output(user_input)
+                else:
+                    generator = self._astream_callback_output(user_input)
+
+            tokens: list[str] = []
+            async for token in generator:
+                if cache_key is not None:
+                    tokens.append(token)
+                turn.on_token()
+                yield token
+
+            await self._persist_memory()
+
+            # 最後まで応答できた場合のみcacheする
+            if cache_key is not None:
+                self._response_cache.put(cache_key, tokens)
+            status = "ok"
+        except (GeneratorExit, asyncio.CancelledError):
+            # clientの切断などで、途中で閉じられた
+            status = "cancelled"
+            raise
+        finally:
+            prefetch.cancel()
+            turn.finish(status)
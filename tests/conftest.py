@@ -0,0 +1,12 @@
+import os
+import sys
+import tempfile
+
+# テスト対象のmodule(src/)をimportできるようにする
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "src"))
+
+# cache・snapshot・logのfileを、src/の下に作らない
+_TMP_DIR = tempfile.mkdtemp(prefix="tripal-test-")
+os.environ.setdefault("TRIPAL_CACHE_DB", "")
+os.environ.setdefault("TRIPAL_POI_SNAPSHOT", "")
+os.environ.setdefault("TRIPAL_LOG_FILE", os.path.join(_TMP_DIR, "tripal.log"))
@@ -0,0 +1,91 @@
+import asyncio
+
+import pytest
+
+from admission import AdmissionController, AdmissionRejected
+
+
+def test_admits_in_arrival_order_and_reports_positions():
+    controller = AdmissionController("test_order", max_concurrent=1, max_queue=2, wait_timeout=1.0)
+    order: list[str] = []
+    positions: dict[str, list[int]] = {"b": [], "c": []}
+
+    async def run(name: str, hold: asyncio.Event | None = None) -> None:
+        async def on_position(position: int) -> None:
+            positions[name].append(position)
+
+        async with controller.acquire(on_position=on_position):
+            order.append(name)
+            if hold is not None:
+                await hold.wait()
+
+    async def main() -> None:
+        holds = {"a": asyncio.Event(), "b": asyncio.Event()}
+        first = asyncio.create_task(run("a", holds["a"]))
+        await asyncio.sleep(0)
+        others = [asyncio.create_task(run("b", holds["b"])), asyncio.create_task(run("c"))]
+        await asyncio.sleep(0.01)
+        assert (controller.active, controller.waiting) == (1, 2)
+
+        holds["a"].set()
+        await asyncio.sleep(0.01)
+        assert (controller.active, controller.waiting) == (1, 1)
+        holds["b"].set()
+        await asyncio.gather(first, *others)
+
+    asyncio.run(main())
+    assert order == ["a", "b", "c"]
+    assert positions == {"b": [1], "c": [2, 1]}
+    assert (controller.active, controller.waiting) == (0, 0)
+
+
+def test_rejects_when_the_queue_is_full():
+    controller = AdmissionController("test_full", max_concurrent=1, max_queue=0, wait_timeout=1.0)
+
+    async def main() -> None:
+        async with controller.acquire():
+            with pytest.raises(AdmissionRejected) as e:
+                async with controller.acquire():
+                    pass
+            assert e.value.reason == "queue_full"
+
+    asyncio.run(main())
+    assert controller.stats()["rejected_full"] == 1
+
+
+def test_rejects_after_the_wait_timeout_and_frees_the_queue():
+    controller = AdmissionController("test_timeout", max_concurrent=1, max_queue=1, wait_timeout=0.01)
+
+    async def main() -> None:
+        async with controller.acquire():
+            with pytest.raises(AdmissionRejected) as e:
+                async with controller.acquire():
+                    pass
+            assert e.value.reason == "timeout"
+            assert controller.waiting == 0
+
+    asyncio.run(main())
+    assert controller.stats()["rejected_timeout"] == 1
+    assert controller.active == 0
+
+
+def test_cancelled_waiter_does_not_take_a_slot():
+    controller = AdmissionController("test_cancel", max_concurrent=1, max_queue=2, wait_timeout=1.0)
+
+    async def wait_for_slot() -> None:
+        async with controller.acquire():
+            pass
+
+    async def main() -> None:
+        async with controller.acquire():
+            waiter = asyncio.create_task(wait_for_slot())
+            await asyncio.sleep(0)
+            waiter.cancel()
+            await asyncio.wait([waiter])
+            assert controller.waiting == 0
+        # 切断した人の分の枠が残っていないこと
+        async with controller.acquire():
+            assert controller.active == 1
+
+    asyncio.run(main())
+    assert controller.active == 0
@@ -0,0 +1,116 @@
+import asyncio
+import time
+
+import pytest
+from langchain_core.agents import AgentAction, AgentActionMessageLog
+from langchain_core.messages import AIMessage
+
+import tripalgpt
+from metrics import AGENT_BUDGET_EXHAUSTED_TOTAL
+from tripalgpt import (
+    PARTIAL_ANSWER_EMPTY,
+    PARTIAL_ANSWER_HEADER,
+    TOOL_TIMEOUT_OUTPUT,
+    _exhausted_budget,
+    _is_failed_tool_output,
+    _partial_answer,
+    _record_budget_exhausted,
+    _with_deadline,
+)
+
+
+@pytest.fixture(autouse=True)
+def budget(monkeypatch):
+    monkeypatch.setattr(tripalgpt, "AGENT_MAX_ITERATIONS", 3)
+    monkeypatch.setattr(tripalgpt, "AGENT_MAX_TOOL_CALLS", 3)
+
+
+def _round(*tools: str) -> list[AgentActionMessageLog]:
+    """
+    1回のLLMの応答で、複数のToolを呼び出したaction
+    """
+    message = AIMessage(content="")
+    return [
+        AgentActionMessageLog(tool=tool, tool_input={}, log="", message_log=[message])
+        for tool in tools
+    ]
+
+
+def test_budget_remains_before_any_tool_call():
+    assert _exhausted_budget({"intermediate_steps": [], "deadline": time.monotonic() - 1}) is None
+
+
+def test_counts_parallel_tool_calls_as_one_iteration():
+    steps = [(action, {}) for action in _round("Location_Information", "Reservation_Information")]
+    assert _exhausted_budget({"intermediate_steps": steps}) is None
+
+    steps += [(action, {}) for action in _round("Location_Information")]
+    # 2回のLLMの応答 + 回答の1回で、上限の3回に達する
+    assert _exhausted_budget({"intermediate_steps": steps}) == "iterations"
+
+
+def test_exhausts_tool_calls_and_time(monkeypatch):
+    monkeypatch.setattr(tripalgpt, "AGENT_MAX_ITERATIONS", 10)
+    steps = [(action, {}) for action in _round("a", "b", "c")]
+    assert _exhausted_budget({"intermediate_steps": steps}) == "tool_calls"
+
+    steps = steps[:1]
+    assert _exhausted_budget({"intermediate_steps": steps, "deadline": time.monotonic() + 60}) is None
+    assert _exhausted_budget({"intermediate_steps": steps, "deadline": time.monotonic() - 1}) == "time"
+
+
+def test_records_which_budget_was_exhausted():
+    key = AGENT_BUDGET_EXHAUSTED_TOTAL._key({"budget": "time"})
+    before = AGENT_BUDGET_EXHAUSTED_TOTAL._values.get(key, 0)
+    agent_input = {
+        "intermediate_steps": [(AgentAction(tool="a", tool_input={}, log=""), {})],
+        "deadline": time.monotonic() - 1,
+    }
+
+    assert _record_budget_exhausted(agent_input) is agent_input
+    assert AGENT_BUDGET_EXHAUSTED_TOTAL._values[key] == before + 1
+
+
+def test_detects_failed_tool_outputs():
+    assert _is_failed_tool_output({"Error": "Server Error"})
+    assert _is_failed_tool_output("\n  [ToolException]\n  ...")
+    assert _is_failed_tool_output(TOOL_TIMEOUT_OUTPUT)
+    assert not _is_failed_tool_output({"浅草寺": {"address": "東京都台東区"}})
+    assert not _is_failed_tool_output("浅草寺は東京都台東区にあります。")
+
+
+def test_partial_answer_lists_the_places_found_so_far(monkeypatch):
+    monkeypatch.setattr(tripalgpt, "PARTIAL_ANSWER_MAX_ITEMS", 2)
+    location, reservation, failed = _round(
+        "Location_Information", "Reservation_Information", "Location_Information"
+    )
+    steps = [
+        (location, {"浅草寺": {}, "東京タワー": {}, "上野公園": {}, "data_freshness": {}}),
+        (reservation, {"Error": "Server Error"}),
+        (failed, TOOL_TIMEOUT_OUTPUT),
+    ]
+
+    output = _partial_answer({"intermediate_steps": steps}).return_values["output"]
+
+    assert output == f"{PARTIAL_ANSWER_HEADER}\n\n**観光スポット・レストラン**\n- 浅草寺\n- 東京タワー"
+
+
+def test_partial_answer_apologizes_when_nothing_was_found():
+    steps = [(action, TOOL_TIMEOUT_OUTPUT) for action in _round("Location_Information")]
+    assert _partial_answer({"intermediate_steps": steps}).return_values["output"] == PARTIAL_ANSWER_EMPTY
+
+
+def test_stops_tools_at_the_turn_deadline():
+    @_with_deadline
+    async def tool(delay: float) -> str:
+        await asyncio.sleep(delay)
+        return "done"
+
+    async def main() -> list[str]:
+        # 期限のないターンでは、そのまま待つ
+        results = [await tool(0)]
+        tripalgpt._tool_deadline.set(time.monotonic() + 0.05)
+        results += [await tool(0), await tool(10)]
+        return results
+
+    assert asyncio.run(main()) == ["done", "done", TOOL_TIMEOUT_OUTPUT]
@@ -0,0 +1,70 @@
+import pytest
+
+from func_call_tools.area_index import (
+    canonical_romaji,
+    find_areas,
+    lookup_area,
+    normalize_keyword,
+    normalize_pref_code,
+)
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("Fukuoka", "hukuoka"),
+        ("hukuoka", "hukuoka"),
+        ("Tōkyō-to", "tokyo"),
+        ("toukyou", "tokyo"),
+    ],
+)
+def test_canonical_romaji_absorbs_spelling_variants(text, expected):
+    assert canonical_romaji(text) == expected
+
+
+@pytest.mark.parametrize(
+    ("text", "expected"),
+    [
+        ("東京都", "tokyo"),
+        ("福岡", "hukuoka"),
+        ("fukuoka", "hukuoka"),
+        ("Kanagawa Ken", "kanagawa"),
+        ("ＴＯＫＹＯ", "tokyo"),
+        ("函館", "hokkaido"),
+        ("アトランティス", ""),
+        ("", ""),
+    ],
+)
+def test_normalize_pref_code(text, expected):
+    assert normalize_pref_code(text) == expected
+
+
+def test_lookup_area_prefers_prefectures():
+    area = lookup_area("京都府")
+    assert area is not None and area.is_prefecture and area.pref_code == "kyoto"
+
+
+def test_find_areas_counts_the_longest_name_once_in_order():
+    assert find_areas("東京都と京都") == [("東京", "tokyo"), ("京都", "kyoto")]
+    assert find_areas("大阪と札幌と那覇", limit=None) == [
+        ("大阪", "osaka"),
+        ("札幌", "hokkaido"),
+        ("那覇", "okinawa"),
+    ]
+    assert find_areas("大阪と札幌と東京", limit=1) == [("大阪", "osaka")]
+
+
+@pytest.mark.parametrize(
+    ("keyword", "expected"),
+    [
+        ("東京にあるホテル", ("東京 ホテル", "tokyo")),
+        ("hakodate ryokan", ("函館 旅館", "hokkaido")),
+        # 区切れない語も、含まれる地名が1つの都道府県なら推測する
+        ("札幌と函館の宿", ("札幌と函館の宿", "hokkaido")),
+        # 複数の都道府県が含まれる場合は決めない
+        ("東京と大阪のホテル", ("東京と大阪のホテル", "")),
+        ("ホテルニューオータニ", ("ホテルニューオータニ", "")),
+    ],
+)
+def test_normalize_keyword(keyword, expected):
+    assert normalize_keyword(keyword) == expected
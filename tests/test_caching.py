@@ -0,0 +1,40 @@
+import asyncio
+
+from caching import MISSING, TieredCache, TTLCache, normalize_key
+
+
+def test_normalize_key_ignores_width_case_and_spaces():
+    assert normalize_key("ＴＯＫＹＯ　 タワー", "Attractions") == normalize_key("tokyo タワー", "attractions")
+    assert normalize_key("a", "b") != normalize_key("a b")
+
+
+def test_ttl_cache_expires_and_evicts_least_recently_used():
+    cache = TTLCache(maxsize=2, ttl=60)
+    cache.set("a", 1)
+    cache.set("b", 2)
+    assert cache.get("a") == 1  # "b"が最も古くなる
+    cache.set("c", 3)
+
+    assert cache.get("b") is MISSING
+    assert cache.get("a") == 1
+    assert cache.evictions == 1
+
+    cache.set("d", 4, ttl=0)
+    assert cache.get("d") is MISSING
+    assert cache.expirations == 1
+
+
+def test_tiered_cache_returns_copies_and_reads_back_from_disk(tmp_path):
+    db_path = str(tmp_path / "cache.sqlite3")
+    cache = TieredCache("test_tiered", ttl=60, db_path=db_path)
+    cache.set("key", {"names": ["浅草寺"]})
+
+    value = cache.get("key")
+    value["names"].append("changed")
+    assert cache.get("key") == {"names": ["浅草寺"]}
+
+    # 別プロセスの再起動を想定して、新しいcacheからSQLiteの値を読む
+    restarted = TieredCache("test_tiered", ttl=60, db_path=db_path)
+    assert asyncio.run(restarted.aget("key")) == {"names": ["浅草寺"]}
+    assert restarted.stats()["disk_hits"] == 1
+    assert asyncio.run(restarted.aget("missing")) is MISSING
@@ -0,0 +1,156 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import SystemMessage
+
+import chat_memory
+from chat_memory import TokenBudgetMemory
+
+# 1ターン(userとAIのmessage)のtoken数: (4 + 10) * 2
+TURN_TOKENS = 28
+
+
+@pytest.fixture(autouse=True)
+def count_characters(monkeypatch):
+    # tokenizerを読み込まずに済むように、文字数をtoken数として数える
+    monkeypatch.setattr(chat_memory, "count_text_tokens", len)
+
+
+class _Summarizer:
+    """
+    受け取った会話を記録し、呼び出した回数を要約として返すsummarizer
+    """
+
+    def __init__(self, error: Exception | None = None) -> None:
+        self.error = error
+        self.inputs: list[dict[str, str]] = []
+        self.gate: asyncio.Event | None = None
+
+    async def ainvoke(self, inputs: dict[str, str]) -> str:
+        self.inputs.append(inputs)
+        if self.gate is not None:
+            await self.gate.wait()
+        if self.error is not None:
+            raise self.error
+        return f"summary {len(self.inputs)}"
+
+
+def _save_turns(memory: TokenBudgetMemory, count: int) -> None:
+    for i in range(count):
+        memory.save_turn(f"question {i}", f"answer {i:>3}")
+
+
+def test_keeps_turns_within_the_budget():
+    memory = TokenBudgetMemory(summarizer=_Summarizer(), token_budget=TURN_TOKENS * 2)
+    _save_turns(memory, 2)
+
+    assert memory.history_tokens() == TURN_TOKENS * 2
+    assert [m.content for m in memory.load_messages()] == [
+        "question 0", "answer   0", "question 1", "answer   1",
+    ]
+
+
+def test_summarizes_old_turns_in_the_background():
+    summarizer = _Summarizer()
+    summarized = []
+
+    async def on_summarized() -> None:
+        summarized.append(memory.summary)
+
+    memory = TokenBudgetMemory(
+        summarizer=summarizer, token_budget=TURN_TOKENS * 2, on_summarized=on_summarized
+    )
+
+    async def main() -> None:
+        _save_turns(memory, 3)
+        # 要約が出来上がるまでは、古いターンもそのままpromptに含める
+        assert len(memory.load_messages()) == 6
+        assert memory.summarizing
+        await memory.wait_summary()
+
+    asyncio.run(main())
+
+    messages = memory.load_messages()
+    assert isinstance(messages[0], SystemMessage)
+    assert messages[0].content.endswith("summary 1")
+    assert [m.content for m in messages[1:]] == [
+        "question 1", "answer   1", "question 2", "answer   2",
+    ]
+    assert summarizer.inputs == [
+        {"summary": "(none)", "conversation": "human: question 0\nai: answer   0"}
+    ]
+    assert summarized == ["summary 1"]
+    assert memory.stats()["pending_turns"] == 0
+
+
+def test_keeps_old_turns_when_the_summary_fails():
+    memory = TokenBudgetMemory(
+        summarizer=_Summarizer(error=RuntimeError("boom")), token_budget=TURN_TOKENS
+    )
+
+    async def main() -> None:
+        _save_turns(memory, 2)
+        await memory.wait_summary()
+
+    asyncio.run(main())
+    assert memory.summary == ""
+    assert len(memory.load_messages()) == 4
+    assert memory.stats()["pending_turns"] == 1
+
+
+def test_drops_old_turns_without_a_summarizer():
+    memory = TokenBudgetMemory(summarizer=None, token_budget=TURN_TOKENS)
+    _save_turns(memory, 3)
+
+    assert [m.content for m in memory.load_messages()] == ["question 2", "answer   2"]
+
+
+def test_restores_from_a_dict_and_summarizes_pending_turns():
+    async def main() -> TokenBudgetMemory:
+        source = TokenBudgetMemory(summarizer=None, token_budget=TURN_TOKENS)
+        source.summary = "earlier"
+        _save_turns(source, 1)
+        state = source.to_dict()
+        state["pending"] = state["turns"]
+
+        restored = TokenBudgetMemory(summarizer=_Summarizer(), token_budget=TURN_TOKENS)
+        restored.load_dict(state)
+        assert restored.summarizing
+        await restored.wait_summary()
+        return restored
+
+    restored = asyncio.run(main())
+    assert restored.summary == "summary 1"
+    assert [m.content for m in restored.load_messages()[1:]] == ["question 0", "answer   0"]
+
+
+def test_does_not_reload_while_summarizing():
+    summarizer = _Summarizer()
+    memory = TokenBudgetMemory(summarizer=summarizer, token_budget=TURN_TOKENS)
+
+    async def main() -> None:
+        summarizer.gate = asyncio.Event()
+        _save_turns(memory, 2)
+        await asyncio.sleep(0)
+        # 別のworkerが保存した、要約前の古い状態
+        memory.load_dict({"summary": "", "turns": [], "pending": []})
+        summarizer.gate.set()
+        await memory.wait_summary()
+
+    asyncio.run(main())
+    assert memory.summary == "summary 1"
+    assert [m.content for m in memory.load_messages()[1:]] == ["question 1", "answer   1"]
+
+
+def test_counts_characters_when_the_tokenizer_cannot_be_loaded(monkeypatch):
+    monkeypatch.undo()
+
+    def get_encoding(name: str):
+        raise OSError("offline")
+
+    monkeypatch.setattr(chat_memory.tiktoken, "get_encoding", get_encoding)
+    monkeypatch.setattr(chat_memory, "_encoding", None)
+    monkeypatch.setattr(chat_memory, "_encoding_retry_at", 0.0)
+
+    assert chat_memory.count_text_tokens("東京のホテル") == 6
+    assert chat_memory._encoding_retry_at > 0
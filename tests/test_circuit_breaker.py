@@ -0,0 +1,111 @@
+import asyncio
+import itertools
+import time
+
+import httpx
+import pytest
+
+import http_client
+from http_client import AsyncResilientTransport, CircuitBreaker, UpstreamUnavailableError
+
+_hosts = (f"breaker-{i}.test" for i in itertools.count())
+
+
+def _open_breaker(reset_timeout: float = 0.0) -> CircuitBreaker:
+    breaker = CircuitBreaker(next(_hosts), failure_threshold=2, reset_timeout=reset_timeout)
+    breaker.record_failure()
+    breaker.record_failure()
+    return breaker
+
+
+def test_opens_after_consecutive_failures():
+    breaker = CircuitBreaker(next(_hosts), failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    assert breaker.acquire() == (True, False)
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.acquire() == (False, False)
+
+
+def test_success_resets_the_failure_count():
+    breaker = CircuitBreaker(next(_hosts), failure_threshold=2, reset_timeout=60)
+    breaker.record_failure()
+    breaker.record_success()
+    breaker.record_failure()
+
+    assert breaker.state == "closed"
+
+
+def test_half_open_lets_only_one_probe_through():
+    breaker = _open_breaker()
+
+    assert breaker.acquire() == (True, True)
+    assert breaker.state == "half_open"
+    assert breaker.acquire() == (False, False)
+
+    breaker.record_success()
+    assert breaker.state == "closed"
+
+
+def test_failed_probe_opens_again():
+    breaker = _open_breaker(reset_timeout=60)
+    # reset_timeout秒経ったことにする
+    breaker._opened_at = time.monotonic() - 60
+
+    assert breaker.acquire() == (True, True)
+    breaker.record_failure()
+
+    assert breaker.state == "open"
+    assert breaker.acquire() == (False, False)
+
+
+def test_released_probe_lets_the_next_request_probe():
+    breaker = _open_breaker()
+    assert breaker.acquire() == (True, True)
+
+    breaker.release_probe()
+
+    assert breaker.state == "open"
+    assert breaker.acquire() == (True, True)
+
+
+def test_cancelled_probe_does_not_leave_the_breaker_half_open(monkeypatch):
+    breaker = _open_breaker()
+    monkeypatch.setitem(http_client._breakers, breaker.host, breaker)
+
+    async def hang(request: httpx.Request) -> httpx.Response:
+        await asyncio.sleep(60)
+        return httpx.Response(200)
+
+    async def main() -> None:
+        transport = AsyncResilientTransport(httpx.MockTransport(hang))
+        request = httpx.Request("GET", f"https://{breaker.host}/")
+        task = asyncio.create_task(transport.handle_async_request(request))
+        await asyncio.sleep(0.01)
+        assert breaker.state == "half_open"
+        task.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await task
+
+    asyncio.run(main())
+    assert breaker.state == "open"
+    assert breaker.acquire() == (True, True)
+
+
+def test_open_breaker_fails_without_sending(monkeypatch):
+    breaker = _open_breaker(reset_timeout=60)
+    monkeypatch.setitem(http_client._breakers, breaker.host, breaker)
+    sent = []
+
+    async def handler(request: httpx.Request) -> httpx.Response:
+        sent.append(request)
+        return httpx.Response(200)
+
+    async def main() -> None:
+        transport = AsyncResilientTransport(httpx.MockTransport(handler))
+        with pytest.raises(UpstreamUnavailableError):
+            await transport.handle_async_request(httpx.Request("GET", f"https://{breaker.host}/"))
+
+    asyncio.run(main())
+    assert sent == []
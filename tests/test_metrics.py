@@ -0,0 +1,60 @@
+import asyncio
+
+from metrics import TOOL_DURATION_SECONDS, Counter, Histogram, render_metrics, track_tool
+
+
+def _count(tool: str, status: str) -> float:
+    key = TOOL_DURATION_SECONDS._key({"tool": tool, "status": status})
+    counts = TOOL_DURATION_SECONDS._values.get(key)
+    return sum(counts[:-1]) if counts else 0
+
+
+def test_track_tool_labels_failed_outputs_as_errors():
+    @track_tool("test_sync_tool", is_failure=lambda output: "Error" in output)
+    def tool(ok: bool) -> dict:
+        return {"name": "浅草寺"} if ok else {"Error": "Server Error"}
+
+    tool(True)
+    tool(False)
+
+    assert _count("test_sync_tool", "ok") == 1
+    assert _count("test_sync_tool", "error") == 1
+
+
+def test_track_tool_labels_exceptions_and_cancellation():
+    @track_tool("test_async_tool")
+    async def tool(action: str) -> str:
+        if action == "raise":
+            raise ValueError(action)
+        if action == "cancel":
+            raise asyncio.CancelledError
+        return action
+
+    async def main() -> None:
+        assert await tool("ok") == "ok"
+        for action, error in (("raise", ValueError), ("cancel", asyncio.CancelledError)):
+            try:
+                await tool(action)
+            except error:
+                pass
+
+    asyncio.run(main())
+    assert _count("test_async_tool", "ok") == 1
+    assert _count("test_async_tool", "error") == 1
+    assert _count("test_async_tool", "cancelled") == 1
+
+
+def test_render_metrics_uses_the_prometheus_text_format():
+    counter = Counter("test_requests_total", "Requests.", ("path",))
+    histogram = Histogram("test_latency_seconds", "Latency.", buckets=(0.1, 1.0))
+    counter.inc(path='/chat"')
+    histogram.observe(0.5)
+
+    text = render_metrics()
+
+    assert '# TYPE test_requests_total counter' in text
+    assert 'test_requests_total{path="/chat\\""} 1' in text
+    assert 'test_latency_seconds_bucket{le="0.1"} 0' in text
+    assert 'test_latency_seconds_bucket{le="1"} 1' in text
+    assert 'test_latency_seconds_bucket{le="+Inf"} 1' in text
+    assert "test_latency_seconds_count 1" in text
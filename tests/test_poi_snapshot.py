@@ -0,0 +1,68 @@
+import os
+import time
+
+from caching import normalize_key
+from func_call_tools.poi_snapshot import POISnapshot, SnapshotEntry, write_snapshot
+
+
+def _entry(loc_search: str, age: float = 0.0) -> tuple[str, SnapshotEntry]:
+    key = normalize_key(loc_search, "", "ja")
+    return key, SnapshotEntry(
+        loc_search=loc_search,
+        category="",
+        fetched_at=time.time() - age,
+        locations=[(f"{loc_search}の名所", {"name": f"{loc_search}の名所", "address": loc_search})],
+    )
+
+
+def test_write_and_read_back(tmp_path):
+    path = str(tmp_path / "poi_snapshot.bin")
+    entries = [_entry(name) for name in ("東京", "京都", "沖縄", "札幌")]
+
+    assert write_snapshot(path, entries) == 4
+
+    snapshot = POISnapshot(path, max_age=3600, recheck=0)
+    for key, entry in entries:
+        assert snapshot.get(key) == entry
+    assert snapshot.get(normalize_key("大阪", "", "ja")) is None
+    assert sorted(key for key, _ in snapshot.entries()) == sorted(key for key, _ in entries)
+    assert snapshot.stats()["entries"] == 4
+
+
+def test_stale_entries_are_not_used(tmp_path):
+    path = str(tmp_path / "poi_snapshot.bin")
+    fresh_key, _ = fresh = _entry("東京", age=10)
+    stale_key, _ = stale = _entry("京都", age=7200)
+    write_snapshot(path, [fresh, stale])
+
+    snapshot = POISnapshot(path, max_age=3600, recheck=0)
+
+    assert snapshot.get(fresh_key) is not None
+    assert snapshot.get(stale_key) is None
+
+
+def test_missing_or_invalid_file(tmp_path):
+    path = str(tmp_path / "poi_snapshot.bin")
+    key, _ = _entry("東京")
+
+    assert POISnapshot(path, recheck=0).get(key) is None
+    assert POISnapshot("", recheck=0).get(key) is None
+
+    with open(path, "wb") as f:
+        f.write(b"not a snapshot" * 4)
+    assert POISnapshot(path, recheck=0).get(key) is None
+
+
+def test_reloads_a_replaced_file(tmp_path):
+    path = str(tmp_path / "poi_snapshot.bin")
+    tokyo_key, _ = tokyo = _entry("東京")
+    kyoto_key, _ = kyoto = _entry("京都")
+    write_snapshot(path, [tokyo])
+    snapshot = POISnapshot(path, max_age=3600, recheck=0)
+    assert snapshot.get(kyoto_key) is None
+
+    write_snapshot(path, [tokyo, kyoto])
+    # 同じ時刻に書き換えられても、別のfileとして検知できるようにする
+    os.utime(path, ns=(time.time_ns(), time.time_ns() + 1_000_000))
+
+    assert snapshot.get(kyoto_key) is not None
@@ -0,0 +1,114 @@
+import asyncio
+
+import pytest
+
+import prefetch
+from prefetch import SpeculativePrefetch
+
+
+Calls = list[tuple[str, tuple[str, ...]]]
+
+
+def _fake_prefetch(calls: Calls, target: str, result=1, delay: float = 0.0):
+    """
+    呼び出しを記録し、delay秒後にresultを返す(例外ならraiseする)先読みの関数を作る
+    """
+
+    async def fetch(*args: str):
+        calls.append((target, args))
+        await asyncio.sleep(delay)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    return fetch
+
+
+@pytest.fixture
+def calls(monkeypatch) -> Calls:
+    calls: Calls = []
+    monkeypatch.setattr(prefetch, "PREFETCH_ENABLED", True)
+    monkeypatch.setattr(prefetch, "aprefetch_reserve_location", _fake_prefetch(calls, "rakuten"))
+    monkeypatch.setattr(
+        prefetch, "aprefetch_trip_suggestions", _fake_prefetch(calls, "tripadvisor")
+    )
+    return calls
+
+
+def _run(*user_inputs: str) -> SpeculativePrefetch:
+    speculative = SpeculativePrefetch()
+
+    async def main() -> None:
+        for user_input in user_inputs:
+            speculative.start(user_input)
+        await asyncio.gather(*speculative._tasks)
+
+    asyncio.run(main())
+    return speculative
+
+
+def test_prefetches_hotels_when_the_user_asks_for_lodging(calls):
+    _run("沖縄のホテルを探して")
+
+    assert calls == [("rakuten", ("沖縄", "okinawa"))]
+
+
+def test_prefetches_locations_otherwise(calls):
+    _run("京都に行きたい")
+
+    assert calls == [("tripadvisor", ("京都",))]
+
+
+def test_makes_one_call_per_turn(calls):
+    _run("東京と大阪と札幌の観光地")
+
+    assert calls == [("tripadvisor", ("東京",))]
+
+
+def test_does_nothing_without_an_area_or_when_disabled(calls, monkeypatch):
+    _run("おすすめの旅行先は？")
+    monkeypatch.setattr(prefetch, "PREFETCH_ENABLED", False)
+    _run("京都に行きたい")
+
+    assert calls == []
+
+
+def test_errors_do_not_reach_the_turn(calls, monkeypatch):
+    monkeypatch.setattr(
+        prefetch,
+        "aprefetch_trip_suggestions",
+        _fake_prefetch(calls, "tripadvisor", ValueError("boom")),
+    )
+
+    _run("京都に行きたい")
+
+    assert calls == [("tripadvisor", ("京都",))]
+    assert prefetch._inflight == 0
+
+
+def test_cancel_stops_unfinished_prefetches(calls, monkeypatch):
+    monkeypatch.setattr(
+        prefetch, "aprefetch_trip_suggestions", _fake_prefetch(calls, "tripadvisor", delay=60)
+    )
+    speculative = SpeculativePrefetch()
+
+    async def main() -> list[asyncio.Task]:
+        speculative.start("京都に行きたい")
+        tasks = list(speculative._tasks)
+        await asyncio.sleep(0)
+        speculative.cancel()
+        await asyncio.wait(tasks)
+        return tasks
+
+    tasks = asyncio.run(main())
+    assert all(task.cancelled() for task in tasks)
+    assert prefetch._inflight == 0
+
+
+def test_skips_when_too_many_prefetches_are_running(calls, monkeypatch):
+    monkeypatch.setattr(prefetch, "PREFETCH_MAX_INFLIGHT", 0)
+
+    speculative = _run("京都に行きたい")
+
+    assert calls == []
+    assert speculative._tasks == []
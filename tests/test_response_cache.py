@@ -0,0 +1,67 @@
+import asyncio
+from types import SimpleNamespace
+
+from response_cache import ResponseCache
+
+
+def _cache(**kwargs) -> ResponseCache:
+    return ResponseCache(**{"enabled": True, "ttl": 60, "maxsize": 8, "max_tokens": 5, **kwargs})
+
+
+def test_make_key_only_for_the_first_message():
+    cache = _cache()
+    history = [SimpleNamespace(type="human", content="こんにちは")]
+
+    assert cache.make_key("こんにちは", []) is not None
+    assert cache.make_key("こんにちは", history) is None
+    assert cache.make_key("！？", []) is None
+    assert _cache(enabled=False).make_key("こんにちは", []) is None
+
+
+def test_make_key_ignores_trailing_punctuation_and_width():
+    cache = _cache()
+
+    assert cache.make_key("こんにちは！", []) == cache.make_key("こんにちは", [])
+    assert cache.make_key("ＨＥＬＬＯ?", []) == cache.make_key("hello", [])
+    assert cache.make_key("沖縄に行きたい", []) != cache.make_key("北海道に行きたい", [])
+
+
+def test_put_get_and_replay():
+    cache = _cache()
+    key = cache.make_key("こんにちは", [])
+    assert cache.get(key) is None
+
+    cache.put(key, ["こん", "にちは", "！"])
+    entry = cache.get(key)
+
+    assert entry.output == "こんにちは！"
+    assert entry.hits == 1
+
+    async def replay() -> list[str]:
+        return [token async for token in cache.replay(entry)]
+
+    assert asyncio.run(replay()) == ["こん", "にちは", "！"]
+
+
+def test_skips_empty_and_long_responses():
+    cache = _cache()
+    key = cache.make_key("こんにちは", [])
+
+    cache.put(key, [])
+    cache.put(key, ["t"] * 6)
+
+    assert cache.get(key) is None
+    assert (cache.stores, cache.skipped) == (0, 2)
+
+
+def test_stats_do_not_contain_the_user_input():
+    cache = _cache()
+    key = cache.make_key("山田太郎です。090-1234-5678に連絡ください", [])
+    cache.put(key, ["はい"])
+    cache.get(key)
+
+    stats = cache.stats()
+
+    assert stats["entries"][0]["hits"] == 1
+    assert "山田" not in repr(stats)
+    assert "連絡" not in repr(stats)
@@ -0,0 +1,80 @@
+import asyncio
+
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage
+
+from router import ModelRouter, classify_heuristic
+
+OFFER = [
+    HumanMessage(content="浅草の観光スポットを教えて"),
+    AIMessage(content="浅草寺や仲見世通りがおすすめです。ホテルも調べましょうか？"),
+]
+ANSWER = [
+    HumanMessage(content="浅草の観光スポットを教えて"),
+    AIMessage(content="浅草寺や仲見世通りがおすすめです。"),
+]
+
+
+@pytest.mark.parametrize(
+    ("user_input", "expected"),
+    [
+        ("こんにちは！", "chat"),
+        ("ありがとうございました😊", "chat"),
+        ("hi", "chat"),
+        ("history", None),
+        ("今の説明をもう少し分かりやすく", "chat"),
+        ("東京", "agent"),
+        ("温泉に行きたい", "agent"),
+        ("あ" * 31, "agent"),
+    ],
+)
+def test_classify_heuristic(user_input, expected):
+    assert classify_heuristic(user_input) == expected
+
+
+@pytest.mark.parametrize("user_input", ["はい", "うん！", "OK", "了解です", "お願いします"])
+def test_acknowledgement_of_an_offer_goes_to_the_agent(user_input):
+    assert classify_heuristic(user_input, OFFER) == "agent"
+    assert classify_heuristic(user_input, ANSWER) == "chat"
+    assert classify_heuristic(user_input) == "chat"
+
+
+def test_acknowledgement_skips_tool_call_messages():
+    history = [
+        *OFFER,
+        HumanMessage(content="はい"),
+        AIMessage(content="", additional_kwargs={"tool_calls": [{"id": "call_0"}]}),
+    ]
+
+    assert classify_heuristic("了解", history) == "agent"
+
+
+class _Classifier:
+    def __init__(self, answer: str = "chat", delay: float = 0.0) -> None:
+        self.answer = answer
+        self.delay = delay
+        self.calls = 0
+
+    async def ainvoke(self, inputs: dict) -> str:
+        self.calls += 1
+        await asyncio.sleep(self.delay)
+        return self.answer
+
+
+def test_router_uses_the_classifier_only_when_the_rules_cannot_decide():
+    classifier = _Classifier("chat")
+    router = ModelRouter(mode="llm", classifier=classifier)
+
+    assert asyncio.run(router.route("東京のホテル", [])) == "agent"
+    assert classifier.calls == 0
+    assert asyncio.run(router.route("最近どう", [])) == "chat"
+    assert classifier.calls == 1
+
+
+def test_router_falls_back_to_the_agent(monkeypatch):
+    monkeypatch.setattr("router.ROUTER_LLM_TIMEOUT", 0.01)
+
+    assert asyncio.run(ModelRouter(mode="heuristic").route("最近どう", [])) == "agent"
+    assert asyncio.run(ModelRouter(mode="off").route("こんにちは", [])) == "agent"
+    slow = ModelRouter(mode="llm", classifier=_Classifier("chat", delay=1.0))
+    assert asyncio.run(slow.route("最近どう", [])) == "agent"
@@ -0,0 +1,105 @@
+import asyncio
+
+import pytest
+
+from session_store import (
+    InMemorySessionStore,
+    RedisSessionStore,
+    SQLiteSessionStore,
+    create_session_store,
+)
+
+STATE = {"summary": "東京旅行の相談", "turns": [], "pending": []}
+
+
+class _FakeRedis:
+    """
+    RedisSessionStoreのテスト用の、dictに保存するclient
+    """
+
+    def __init__(self) -> None:
+        self.data: dict[str, str] = {}
+        self.expires: dict[str, int | None] = {}
+
+    async def get(self, name: str) -> str | None:
+        return self.data.get(name)
+
+    async def set(self, name: str, value: str, ex: int | None = None) -> None:
+        self.data[name] = value
+        self.expires[name] = ex
+
+    async def delete(self, *names: str) -> None:
+        for name in names:
+            self.data.pop(name, None)
+
+
+@pytest.fixture(params=["memory", "sqlite", "redis"])
+def store(request, tmp_path):
+    if request.param == "memory":
+        return InMemorySessionStore(ttl=60)
+    if request.param == "sqlite":
+        return SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl=60)
+    return RedisSessionStore(_FakeRedis(), ttl=60)
+
+
+def test_save_load_and_delete(store):
+    async def main() -> None:
+        assert await store.load("session") is None
+        await store.save("session", STATE)
+        assert await store.load("session") == STATE
+        assert await store.load("other") is None
+        await store.delete("session")
+        assert await store.load("session") is None
+
+    asyncio.run(main())
+
+
+def test_loaded_state_is_a_copy(store):
+    async def main() -> None:
+        await store.save("session", STATE)
+        state = await store.load("session")
+        state["summary"] = "changed"
+        assert await store.load("session") == STATE
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("kind", ["memory", "sqlite"])
+def test_expired_sessions_are_not_loaded(kind, tmp_path):
+    if kind == "memory":
+        store = InMemorySessionStore(ttl=0)
+    else:
+        store = SQLiteSessionStore(str(tmp_path / "sessions.sqlite3"), ttl=0)
+
+    async def main() -> None:
+        await store.save("session", STATE)
+        assert await store.load("session") is None
+
+    asyncio.run(main())
+
+
+def test_sqlite_store_is_shared_between_workers(tmp_path):
+    path = str(tmp_path / "sessions.sqlite3")
+
+    async def main() -> None:
+        await SQLiteSessionStore(path, ttl=60).save("session", STATE)
+        assert await SQLiteSessionStore(path, ttl=60).load("session") == STATE
+
+    asyncio.run(main())
+
+
+def test_redis_store_sets_the_ttl_and_prefix():
+    client = _FakeRedis()
+
+    asyncio.run(RedisSessionStore(client, ttl=90.5, prefix="test:").save("session", STATE))
+
+    assert list(client.data) == ["test:session"]
+    assert client.expires["test:session"] == 90
+
+
+def test_create_session_store():
+    # SQLiteのfileは、初めて読み書きするときに作成される
+    assert isinstance(create_session_store("memory"), InMemorySessionStore)
+    assert isinstance(create_session_store("sqlite"), SQLiteSessionStore)
+    with pytest.raises(ValueError):
+        create_session_store("postgres")
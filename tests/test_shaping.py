@@ -0,0 +1,79 @@
+import pytest
+
+from func_call_tools import shaping
+from func_call_tools.shaping import shape_tool_output
+
+
+@pytest.fixture(autouse=True)
+def count_characters(monkeypatch):
+    # tokenizerを読み込まずに済むように、文字数をtoken数として数える
+    monkeypatch.setattr(shaping, "count_text_tokens", len)
+
+
+def test_drops_placeholders_and_empty_values():
+    output = {
+        "浅草寺": {
+            "name": "浅草寺",
+            "address": "住所なし",
+            "phone": "",
+            "hours": None,
+            "photos": [],
+            "website": "https://www.senso-ji.jp/",
+        }
+    }
+
+    shaped, report = shape_tool_output(output, token_budget=10_000)
+
+    assert shaped == {"浅草寺": {"name": "浅草寺", "website": "https://www.senso-ji.jp/"}}
+    assert report.dropped_fields == 4
+    assert report.tokens_saved > 0
+
+
+def test_truncates_long_text_but_not_urls():
+    url = "https://example.com/" + "a" * 50
+    output = {"spot": {"description": "あ" * 30, "url": url}}
+
+    shaped, report = shape_tool_output(output, token_budget=10_000, text_max_chars=10)
+
+    assert shaped["spot"]["description"] == "あ" * 10 + "…"
+    assert shaped["spot"]["url"] == url
+    assert report.truncated_fields == 1
+
+
+def test_keeps_instructions_to_the_ai_whole():
+    output = {
+        "Error": "Service Unavailable",
+        "Message to AI": "The hotel search service is temporarily unavailable. "
+        "Do not retry this tool now; answer with the information you already have.",
+    }
+
+    shaped, report = shape_tool_output(output, token_budget=10_000, text_max_chars=20)
+
+    assert shaped == output
+    assert report.truncated_fields == 0
+
+
+def test_drops_trailing_items_over_budget_but_keeps_one():
+    output = {f"spot{i}": {"description": "x" * 50} for i in range(3)}
+
+    shaped, report = shape_tool_output(output, token_budget=100)
+    assert list(shaped) == ["spot0"]
+    assert report.dropped_items == 2
+
+    shaped, _ = shape_tool_output(output, token_budget=1)
+    assert list(shaped) == ["spot0"]
+
+
+def test_passes_through_text_output():
+    shaped, report = shape_tool_output("情報が取得出来ませんでした。", token_budget=1)
+
+    assert shaped == "情報が取得出来ませんでした。"
+    assert report.tokens_saved == 0
+
+
+def test_does_not_modify_the_tool_output():
+    output = {"spot": {"name": "浅草寺", "address": "住所なし"}}
+
+    shape_tool_output(output, token_budget=10_000)
+
+    assert output == {"spot": {"name": "浅草寺", "address": "住所なし"}}
@@ -0,0 +1,73 @@
+import asyncio
+
+from caching import SingleFlight
+
+
+def test_single_flight_coalesces_concurrent_calls():
+    flight = SingleFlight("test_coalesce")
+    calls = 0
+
+    async def fetch():
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return calls
+
+    async def main():
+        return await asyncio.gather(*(flight.do("key", fetch) for _ in range(5)))
+
+    assert asyncio.run(main()) == [1] * 5
+    assert calls == 1
+    assert flight.stats() == {"leaders": 1, "followers": 4, "abandoned": 0, "inflight": 0}
+
+
+def test_single_flight_keeps_running_while_another_caller_waits():
+    flight = SingleFlight("test_partial_cancel")
+    cancelled = False
+
+    async def fetch():
+        nonlocal cancelled
+        try:
+            await asyncio.sleep(0.05)
+            return "ok"
+        except asyncio.CancelledError:
+            cancelled = True
+            raise
+
+    async def main():
+        first = asyncio.create_task(flight.do("key", fetch))
+        second = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        first.cancel()
+        return await second
+
+    assert asyncio.run(main()) == "ok"
+    assert not cancelled
+
+
+def test_single_flight_cancels_the_call_when_the_last_caller_leaves():
+    flight = SingleFlight("test_abandon")
+    started = 0
+    cancelled = 0
+
+    async def fetch():
+        nonlocal started, cancelled
+        started += 1
+        try:
+            await asyncio.sleep(0.05)
+            return started
+        except asyncio.CancelledError:
+            cancelled += 1
+            raise
+
+    async def main():
+        caller = asyncio.create_task(flight.do("key", fetch))
+        await asyncio.sleep(0)
+        caller.cancel()
+        await asyncio.wait([caller])
+        # 止めている途中のtaskには相乗りせず、新しく実行する
+        return await flight.do("key", fetch)
+
+    assert asyncio.run(main()) == 2
+    assert cancelled == 1
+    assert flight.stats()["abandoned"] == 1
@@ -0,0 +1,76 @@
+import asyncio
+
+import pytest
+
+from stream_sender import send_coalesced
+
+
+async def _tokens(tokens: list[str], delay: float = 0.0, error: Exception | None = None):
+    for token in tokens:
+        if delay:
+            await asyncio.sleep(delay)
+        yield token
+    if error is not None:
+        raise error
+
+
+def _run(tokens, **kwargs) -> tuple[list[str], object]:
+    frames: list[str] = []
+
+    async def send(frame: str) -> None:
+        frames.append(frame)
+
+    stats = asyncio.run(send_coalesced(send, tokens, **kwargs))
+    return frames, stats
+
+
+def test_coalesces_tokens_that_arrive_within_the_flush_interval():
+    frames, stats = _run(_tokens(["こん", "にち", "は"]), flush_interval=1.0)
+
+    assert frames == ["こんにちは"]
+    assert (stats.tokens, stats.frames, stats.bytes) == (3, 1, len("こんにちは".encode()))
+    assert stats.first_frame is not None
+
+
+def test_splits_frames_at_max_frame_bytes():
+    frames, stats = _run(_tokens(["ab", "cd", "ef"]), flush_interval=1.0, max_frame_bytes=4)
+
+    assert frames == ["abcd", "ef"]
+    assert stats.frames == 2
+
+
+def test_sends_each_token_when_the_flush_interval_is_zero():
+    frames, _ = _run(_tokens(["a", "b", "c"], delay=0.01), flush_interval=0)
+
+    assert frames == ["a", "b", "c"]
+
+
+def test_raises_receiver_errors_after_sending_what_arrived():
+    frames: list[str] = []
+
+    async def send(frame: str) -> None:
+        frames.append(frame)
+
+    with pytest.raises(ValueError):
+        asyncio.run(send_coalesced(send, _tokens(["a"], error=ValueError("boom")), flush_interval=0))
+    assert frames == ["a"]
+
+
+def test_closes_the_token_iterator_when_sending_fails():
+    closed = False
+
+    async def tokens():
+        nonlocal closed
+        try:
+            while True:
+                yield "a"
+                await asyncio.sleep(0.001)
+        finally:
+            closed = True
+
+    async def send(frame: str) -> None:
+        raise ConnectionError("disconnected")
+
+    with pytest.raises(ConnectionError):
+        asyncio.run(send_coalesced(send, tokens(), flush_interval=0))
+    assert closed